@@ -0,0 +1,577 @@
+"""بنچمارک آفلاین ربات روی یک Bot API جعلی
+
+یک سرور محلی نقش api.telegram.org را بازی می‌کند (با تاخیر و 429 قابل تنظیم)
+و طوفان‌های مصنوعی /start <code> و دکمه‌ی بررسی عضویت روی هندلرهای واقعی main.py
+اجرا می‌شوند. خروجی: آپدیت بر ثانیه، p50/p99 و تعداد فراخوانی API به ازای هر آپدیت،
+و گزارش راه‌اندازی main.py (زمان import و تاخیر اولین آپدیت).
+
+    python bench.py                      # میانه‌ی ۳ اجرا و مقایسه با bench_baseline.json
+    python bench.py --mode polling       # تحویل آپدیت‌ها از getUpdates
+    python bench.py --update-baseline    # ثبت میانه‌ی فعلی به‌عنوان مبنا
+    python bench.py --repeat 1           # یک اجرای سریع (با مبنای ۳تایی مقایسه نمی‌شود)
+
+اگر نتیجه از مبنا بدتر شود (بیش از tolerance، یا SCENARIO_TOLERANCE برای سناریوهای پرنوسان)
+با کد خروج 1 تمام می‌شود.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+from collections import Counter
+from urllib.parse import parse_qs
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(BENCH_DIR, "bench_baseline.json")
+OUTPUT_FILE = os.path.join(BENCH_DIR, "bench_output.txt")
+
+BENCH_TOKEN = "123456:bench"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+CHANNELS = {"bench_one": -1001, "bench_two": -1002}
+VIDEO_CODE = "BENCHV"
+PACKAGE_CODE = "BENCHP"
+PACKAGE_FILES = 10
+
+# متدهای کنترلی در «API به ازای هر آپدیت» شمرده نمی‌شوند
+CONTROL_METHODS = {"getMe", "getUpdates", "setWebhook", "deleteWebhook"}
+# مراحل راه‌اندازی که با مبنا مقایسه می‌شوند؛ بقیه به زمان سناریوها وابسته‌اند
+STARTUP_COMPARED = ("import", "first_update_handler")
+STARTUP_SLACK = 0.1
+# کاربر /start تنهای قبل از سناریوها (بیرون از بازه‌ی شناسه‌ی کاربران سناریوها)
+COLD_USER = 99
+# تک‌اجرای check_storm بین اجراها تا دو برابر نوسان دارد؛ گیت روی میانه‌ی چند اجراست
+BENCH_REPEAT = 3
+# حداقل tolerance زمان‌ها و upd/s هر سناریو؛ از بازه‌ی میانه‌های ۳تایی در ۷ اجرای seedدار:
+# start_video تا ~۵۵٪ و check_storm تا ~۳۵٪ جابه‌جا می‌شوند، بقیه زیر ۲۰٪
+SCENARIO_TOLERANCE = {"start_video": 0.6, "check_storm": 0.5}
+
+# ===== Bot API جعلی =====
+class StubBotAPI:
+    """سرور Bot API جعلی که در thread و event loop جداگانه اجرا می‌شود"""
+
+    def __init__(self, latency=0.03, jitter=0.01, rate_429=0.0, retry_after=1, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        # جدا از random سراسری که main.py هم (برای ساخت کد) مصرفش می‌کند
+        self._random = random.Random(seed)
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.throttled = 0
+        self.joined = set()
+        self._message_id = 0
+        self._updates = []
+        self._update_event = None
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self.url = None
+
+    def _build_app(self):
+        from fastapi import FastAPI, Request
+        from fastapi.responses import JSONResponse
+
+        stub = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+
+        @stub.post("/bot{token}/{method}")
+        async def bot_method(token: str, method: str, request: Request):
+            params = await self._params(request)
+            self.calls[method] += 1
+            if method == "getUpdates":
+                return JSONResponse({"ok": True, "result": await self._get_updates(params)})
+            if self.latency or self.jitter:
+                await asyncio.sleep(max(0.0, self._random.gauss(self.latency, self.jitter)))
+            if self.rate_429 and method not in CONTROL_METHODS and self._random.random() < self.rate_429:
+                self.throttled += 1
+                return JSONResponse(status_code=429, content={
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after}
+                })
+            return JSONResponse({"ok": True, "result": self._result(method, params)})
+
+        return stub
+
+    @staticmethod
+    async def _params(request):
+        body = await request.body()
+        if request.headers.get("content-type", "").startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+    def _next_message(self, chat_id, **extra):
+        self._message_id += 1
+        try:
+            chat = {"id": int(chat_id), "type": "private", "first_name": "user"}
+        except (TypeError, ValueError):
+            chat = {"id": -1000, "type": "channel", "username": str(chat_id).lstrip("@")}
+        return {"message_id": self._message_id, "date": int(time.time()), "chat": chat,
+                "from": BOT_USER, **extra}
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getChatMember":
+            user_id = int(params.get("user_id", 0))
+            status = "member" if user_id in self.joined else "left"
+            return {"status": status, "user": {"id": user_id, "is_bot": False, "first_name": "user"}}
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            return [self._next_message(params.get("chat_id")) for _ in media]
+        if method in ("sendMessage", "sendVideo", "sendPhoto", "sendDocument", "editMessageText",
+                      "editMessageCaption", "copyMessage", "forwardMessage"):
+            message = self._next_message(params.get("chat_id", 0), text=params.get("text", ""))
+            if method == "copyMessage":
+                return {"message_id": message["message_id"]}
+            return message
+        return True
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        timeout = float(params.get("timeout", 0) or 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._update_event.clear()
+            try:
+                await asyncio.wait_for(self._update_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    def push_updates(self, updates):
+        """صف کردن آپدیت برای getUpdates (از thread دیگر)"""
+        def push():
+            self._updates.extend(updates)
+            self._update_event.set()
+        self._loop.call_soon_threadsafe(push)
+
+    def start(self):
+        import uvicorn
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        config = uvicorn.Config(self._build_app(), host="127.0.0.1", port=port,
+                                log_level="error", access_log=False, lifespan="off")
+        self._server = uvicorn.Server(config)
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._update_event = asyncio.Event()
+            self._loop.call_soon(ready.set)
+            self._loop.run_until_complete(self._server.serve())
+
+        self._thread = threading.Thread(target=run, name="stub-bot-api", daemon=True)
+        self._thread.start()
+        ready.wait()
+        while not self._server.started:
+            time.sleep(0.01)
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.should_exit = True
+            self._thread.join(timeout=5)
+
+# ===== ساخت آپدیت‌های مصنوعی =====
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+
+def start_update(update_id, user_id, code):
+    text = f"/start {code}"
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": f"u{user_id}"},
+        "from": _user(user_id), "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}]
+    }}
+
+def check_update(update_id, user_id, code):
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": _user(user_id), "chat_instance": str(user_id),
+        "data": f"check_{code}",
+        "message": {
+            "message_id": update_id, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"u{user_id}"},
+            "from": BOT_USER, "text": "🔒 لطفاً در کانال‌ها عضو شو:"
+        }
+    }}
+
+def join_update(update_id, user_id, username):
+    return {"update_id": update_id, "chat_member": {
+        "chat": {"id": CHANNELS[username], "type": "channel", "username": username},
+        "from": _user(user_id), "date": int(time.time()),
+        "old_chat_member": {"status": "left", "user": _user(user_id)},
+        "new_chat_member": {"status": "member", "user": _user(user_id)}
+    }}
+
+# ===== اجرای سناریوها =====
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+class Bench:
+    def __init__(self, main, application, stub, mode, concurrency):
+        self.main = main
+        self.application = application
+        self.stub = stub
+        self.mode = mode
+        self.concurrency = concurrency
+        self._update_id = 0
+        self._submitted = {}
+        self._latencies = []
+        self._errors = 0
+        self._remaining = 0
+        self._done = None
+        self._client = None
+
+        # زمان پایان هر آپدیت از خود process_update گرفته می‌شود تا در هر سه حالت یکسان باشد
+        process_update = application.process_update
+
+        async def timed_process_update(update):
+            try:
+                await process_update(update)
+            finally:
+                started = self._submitted.pop(getattr(update, "update_id", None), None)
+                if started is not None:
+                    self._latencies.append(time.perf_counter() - started)
+                    self._remaining -= 1
+                    if self._remaining <= 0:
+                        self._done.set()
+
+        application.process_update = timed_process_update
+        application.add_error_handler(self._on_error)
+
+    async def _on_error(self, update, context):
+        self._errors += 1
+        logging.debug(f"خطای هندلر در bench: {context.error}")
+
+    def next_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    async def start(self):
+        await self.application.initialize()
+        await self.application.post_init(self.application)
+        if self.mode == "direct":
+            return
+        await self.application.start()
+        if self.mode == "polling":
+            await self.application.updater.start_polling(poll_interval=0, timeout=1)
+        else:
+            import httpx
+            self.main._bot_applications["default"] = self.application
+            self._client = httpx.AsyncClient(transport=httpx.ASGITransport(app=self.main.app),
+                                             base_url="http://bench")
+
+    async def stop(self):
+        if self._client:
+            await self._client.aclose()
+        if self.application.updater and self.application.updater.running:
+            await self.application.updater.stop()
+        if self.application.running:
+            await self.application.stop()
+        await self.application.shutdown()
+        await self.application.post_shutdown(self.application)
+
+    async def _submit(self, payloads):
+        from telegram import Update
+
+        if self.mode == "polling":
+            for payload in payloads:
+                self._submitted[payload["update_id"]] = time.perf_counter()
+            self.stub.push_updates(payloads)
+            return
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        headers = {}
+        if self.main.WEBHOOK_SECRET:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.main.WEBHOOK_SECRET
+
+        async def submit(payload):
+            async with semaphore:
+                self._submitted[payload["update_id"]] = time.perf_counter()
+                if self.mode == "webhook":
+                    response = await self._client.post(f"/{self.main.WEBHOOK_PATH}", json=payload, headers=headers)
+                    response.raise_for_status()
+                else:
+                    try:
+                        await self.application.process_update(Update.de_json(payload, self.application.bot))
+                    except Exception:
+                        pass
+
+        await asyncio.gather(*(submit(p) for p in payloads))
+
+    async def phase(self, payloads, timeout):
+        """ارسال یک دسته آپدیت و انتظار تا پردازش کامل همه"""
+        self._latencies = []
+        self._errors = 0
+        self._remaining = len(payloads)
+        self._done = asyncio.Event()
+        before = Counter(self.stub.calls)
+        started = time.perf_counter()
+        await self._submit(payloads)
+        await asyncio.wait_for(self._done.wait(), timeout)
+        elapsed = time.perf_counter() - started
+        calls = Counter(self.stub.calls)
+        calls.subtract(before)
+        calls = {method: n for method, n in calls.items() if n > 0}
+        api_calls = sum(n for method, n in calls.items() if method not in CONTROL_METHODS)
+        return {
+            "updates": len(payloads),
+            "seconds": round(elapsed, 3),
+            "updates_per_s": round(len(payloads) / elapsed, 2),
+            "p50_ms": round(_percentile(self._latencies, 50) * 1000, 1),
+            "p99_ms": round(_percentile(self._latencies, 99) * 1000, 1),
+            "api_calls_per_update": round(api_calls / max(len(payloads), 1), 3),
+            "api_calls": dict(sorted(calls.items())),
+            "errors": self._errors
+        }
+
+    async def cold_start(self, timeout):
+        """یک /start تنها قبل از سناریوها تا اولین آپدیت بدون ازدحام اندازه‌گیری شود"""
+        return await self.phase([start_update(self.next_id(), COLD_USER, VIDEO_CODE)], timeout)
+
+    async def scenario_start_video(self, users, timeout):
+        """کاربران عضو، /start یک ویدیوی تکی"""
+        self.stub.joined.update(users)
+        return await self.phase([start_update(self.next_id(), uid, VIDEO_CODE) for uid in users], timeout)
+
+    async def scenario_start_package(self, users, timeout):
+        """کاربران عضو، /start یک پکیج ۱۰تایی (sendMediaGroup)"""
+        self.stub.joined.update(users)
+        return await self.phase([start_update(self.next_id(), uid, PACKAGE_CODE) for uid in users], timeout)
+
+    async def scenario_check_button(self, users, timeout):
+        """کاربر غیرعضو /start می‌زند، عضو می‌شود و دکمه‌ی بررسی را می‌زند؛ فقط مرحله‌ی آخر اندازه‌گیری می‌شود"""
+        await self.phase([start_update(self.next_id(), uid, VIDEO_CODE) for uid in users], timeout)
+        self.stub.joined.update(users)
+        joins = [join_update(self.next_id(), uid, name) for uid in users for name in CHANNELS]
+        await self.phase(joins, timeout)
+        return await self.phase([check_update(self.next_id(), uid, VIDEO_CODE) for uid in users], timeout)
+
+    async def scenario_check_storm(self, users, timeout):
+        """کاربر غیرعضو پشت‌سرهم دکمه‌ی بررسی را می‌زند (کش منفی عضویت)
+
+        سه ضربه‌ی هر کاربر کنار هم ارسال می‌شوند تا دومی و سومی همیشه وقتی
+        اولی در جریان است برسند؛ با ترتیب دور به دور، افتادن تکرارها در پنجره‌ی
+        debounce به سرعت اجرا بستگی داشت و p50 بین اجراها چند برابر می‌شد.
+        """
+        await self.phase([start_update(self.next_id(), uid, VIDEO_CODE) for uid in users], timeout)
+        presses = [check_update(self.next_id(), uid, VIDEO_CODE) for uid in users for _ in range(3)]
+        return await self.phase(presses, timeout)
+
+SCENARIOS = ["start_video", "start_package", "check_button", "check_storm"]
+
+def _configure_environment(workdir):
+    """main.py با فایل‌های نسبی کار می‌کند، پس در پوشه‌ی موقت و با تنظیمات bench بارگذاری می‌شود"""
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "CHANNEL_ID": "@bench_one",
+        "CHANNEL_USERNAME": "bench_one",
+        "SECOND_CHANNEL_USERNAME": "bench_two",
+        "ADMIN_ID": "1",
+        "STATE_BACKEND": "memory",
+        "RUN_MODE": "polling"
+    })
+    os.chdir(workdir)
+    if BENCH_DIR not in sys.path:
+        sys.path.insert(0, BENCH_DIR)
+
+async def run(args):
+    import main
+
+    main._prepare_storage()
+    main.put_video(VIDEO_CODE, "bench-video")
+    main.put_video(PACKAGE_CODE, {"type": "package", "files": [f"bench-video-{i}" for i in range(PACKAGE_FILES)]})
+
+    # حذف‌های خودکار ۲۰ ثانیه‌ای وسط سناریوی بعدی شلیک می‌شدند و نتایج را پرنوسان می‌کردند؛
+    # برای bench بیرون از بازه‌ی اندازه‌گیری زمان‌بندی می‌شوند
+    deletions = main.default_tenant.deletions
+    schedule = deletions.schedule
+    deletions.schedule = lambda chat_id, message_id, delay=None: schedule(chat_id, message_id, 3600)
+
+    stub = StubBotAPI(args.latency_ms / 1000, args.jitter_ms / 1000, args.rate_429, args.retry_after,
+                      seed=args.seed).start()
+    application = main.build_application(base_url=stub.url)
+    bench = Bench(main, application, stub, args.mode, args.concurrency)
+    results = {}
+    try:
+        await bench.start()
+        await bench.cold_start(args.timeout)
+        for index, name in enumerate(args.scenarios):
+            users = range(100000 * (index + 1), 100000 * (index + 1) + args.users)
+            logging.warning(f"⏱ سناریو {name} ({args.users} کاربر، حالت {args.mode})")
+            results[name] = await getattr(bench, f"scenario_{name}")(users, args.timeout)
+    finally:
+        await bench.stop()
+        stub.stop()
+        main._close_storage()
+    return results, main.startup_report.stats()
+
+def _median(values):
+    return round(statistics.median(values), 4)
+
+def median_results(runs):
+    """میانه‌ی هر عدد بین چند اجرا؛ p50 سناریوهای پرازدحام بین اجراها نوسان دارد"""
+    results = {}
+    for name, first in runs[0][0].items():
+        samples = [run_results[name] for run_results, _ in runs]
+        merged = {}
+        for key, value in first.items():
+            if key == "api_calls":
+                merged[key] = {method: _median([r[key].get(method, 0) for r in samples]) for method in value}
+            else:
+                merged[key] = _median([r[key] for r in samples])
+        results[name] = merged
+    startup = {phase: _median([run_startup[phase] for _, run_startup in runs]) for phase in runs[0][1]}
+    return results, startup
+
+# ===== گزارش و مقایسه با مبنا =====
+def format_report(config, results, startup):
+    lines = [f"bench: {json.dumps(config, sort_keys=True)}",
+             "startup: " + ", ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in startup.items()),
+             f"{'scenario':<16}{'upd/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'api/upd':>10}{'errors':>8}"]
+    for name, r in results.items():
+        lines.append(f"{name:<16}{r['updates_per_s']:>10}{r['p50_ms']:>10}{r['p99_ms']:>10}"
+                     f"{r['api_calls_per_update']:>10}{r['errors']:>8}")
+        lines.append(f"{'':<16}{json.dumps(r['api_calls'])}")
+    return "\n".join(lines)
+
+def compare(config, results, startup, baseline, tolerance):
+    """لیست پسرفت‌ها نسبت به مبنا؛ مبنای با تنظیمات متفاوت مقایسه نمی‌شود"""
+    if baseline.get("config") != config:
+        logging.warning("⚠️ تنظیمات این اجرا با مبنا فرق دارد؛ مقایسه انجام نشد")
+        return []
+    regressions = []
+    base_startup = baseline.get("startup", {})
+    for phase in STARTUP_COMPARED:
+        if phase in startup and phase in base_startup \
+                and startup[phase] > base_startup[phase] * (1 + tolerance) + STARTUP_SLACK:
+            regressions.append(f"startup: {phase} {startup[phase] * 1000:.0f}ms > {base_startup[phase] * 1000:.0f}ms")
+    for name, r in results.items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        # تعداد فراخوانی API نوسان ندارد و همیشه با tolerance عمومی سنجیده می‌شود
+        timing = max(tolerance, SCENARIO_TOLERANCE.get(name, 0.0))
+        if r["updates_per_s"] < base["updates_per_s"] * (1 - timing):
+            regressions.append(f"{name}: updates/s {r['updates_per_s']} < {base['updates_per_s']}")
+        for key in ("p50_ms", "p99_ms", "api_calls_per_update"):
+            # کف مطلق کوچک تا نوسان چند میلی‌ثانیه‌ای پسرفت حساب نشود
+            slack = 0.05 if key == "api_calls_per_update" else 5.0
+            allowed = tolerance if key == "api_calls_per_update" else timing
+            if r[key] > base[key] * (1 + allowed) + slack:
+                regressions.append(f"{name}: {key} {r[key]} > {base[key]}")
+        if r["errors"] > base.get("errors", 0):
+            regressions.append(f"{name}: errors {r['errors']} > {base.get('errors', 0)}")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="بنچمارک آفلاین ربات روی Bot API جعلی")
+    parser.add_argument("--mode", choices=["direct", "webhook", "polling"], default="direct")
+    parser.add_argument("--users", type=int, default=150)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=30)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--output", default=OUTPUT_FILE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=BENCH_REPEAT,
+                        help="تعداد اجرا (هر کدام در پروسه‌ی جدا)؛ میانه گزارش و مقایسه می‌شود")
+    parser.add_argument("--raw", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def run_once(args):
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        cwd = os.getcwd()
+        _configure_environment(workdir)
+        try:
+            return asyncio.run(run(args))
+        finally:
+            os.chdir(cwd)
+
+def run_repeated(argv, repeat, seed):
+    """هر اجرا در پروسه‌ی تازه تا import و حالت main.py از اجرای قبلی نماند"""
+    runs = []
+    with tempfile.TemporaryDirectory(prefix="bench-runs-") as tmp:
+        for i in range(repeat):
+            raw = os.path.join(tmp, f"run{i}.json")
+            subprocess.run([sys.executable, os.path.abspath(__file__), *argv, "--repeat", "1",
+                            "--seed", str(seed + i), "--raw", raw],
+                           check=True, stdout=subprocess.DEVNULL)
+            with open(raw, encoding="utf-8") as f:
+                data = json.load(f)
+            runs.append((data["scenarios"], data["startup"]))
+    return median_results(runs)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    random.seed(args.seed)
+    config = {
+        "mode": args.mode,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "latency_ms": args.latency_ms,
+        "jitter_ms": args.jitter_ms,
+        "rate_429": args.rate_429,
+        "scenarios": args.scenarios,
+        "repeat": args.repeat
+    }
+
+    if args.repeat > 1:
+        results, startup = run_repeated(argv, args.repeat, args.seed)
+    else:
+        results, startup = run_once(args)
+    if args.raw:
+        with open(args.raw, "w", encoding="utf-8") as f:
+            json.dump({"scenarios": results, "startup": startup}, f)
+        return 0
+
+    report = format_report(config, results, startup)
+    print(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "startup": startup, "scenarios": results}, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"✅ مبنا در {args.baseline} ذخیره شد")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("ℹ️ فایل مبنا وجود ندارد؛ با --update-baseline بسازید")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(config, results, startup, baseline, args.tolerance)
+    for line in regressions:
+        print(f"❌ پسرفت: {line}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,7 @@
+# شروع import برای گزارش زمان راه‌اندازی؛ قبل از همه‌ی importهای دیگر
+import time
+STARTUP_BEGAN = time.perf_counter()
+
 import apscheduler.util
 import pytz
 
@@ -18,38 +22,174 @@ import random
 import string
 import logging
 import threading
-import time
-import gc
+import sys
+import bisect
+import functools
+import contextvars
+import fcntl
+import signal
+from collections import deque, OrderedDict
+from itertools import islice
+from contextlib import contextmanager
+import heapq
+import queue
+import traceback
+import hashlib
+import math
+import glob
+import sqlite3
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
 # بارگذاری از فایل .env
 from dotenv import load_dotenv
 load_dotenv()
 
-from flask import Flask
-app = Flask(__name__)
+# ===== حالت اجرا (polling یا webhook) =====
+RUN_MODE = os.getenv("RUN_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+HTTP_HOST = os.getenv("HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("PORT", "8000"))
+# راه‌اندازی سریع: کاربران در پس‌زمینه لود می‌شوند و ربات زودتر آپدیت می‌گیرد
+FAST_START = os.getenv("FAST_START", "0") == "1"
 
-@app.route("/")
-def hello():
-    return "سلام شومبول طلای من رباتت فعاله❤️😁"
+from contextlib import asynccontextmanager
 
-@app.route("/keep-alive")
-def keep_alive():
-    activity_monitor.record_activity()
-    return "✅ Bot is awake!"
+# اپلیکیشن‌های PTB در حالت webhook به تفکیک نام ربات؛ در حالت polling خالی می‌ماند
+_bot_applications = {}
+
+def _webhook_path(name):
+    """ربات پیش‌فرض همان مسیر قبلی را دارد و بقیه /<WEBHOOK_PATH>/<name>"""
+    return WEBHOOK_PATH if name == "default" else f"{WEBHOOK_PATH}/{name}"
+
+@asynccontextmanager
+async def _lifespan(api):
+    applications = dict(_bot_applications)
+    owned = False
+    if not applications and RUN_MODE == "webhook" and any(t.token for t in tenants.values()):
+        # اجرا مستقیم با gunicorn/uvicorn (مثلاً چند worker) بدون main()
+        _prepare_storage()
+        applications = build_applications()
+        _bot_applications.update(applications)
+        owned = True
+    if not applications:
+        yield
+        return
+    started = []
+    try:
+        for name, application in applications.items():
+            await application.initialize()
+            started.append(application)
+            if application.post_init:
+                await application.post_init(application)
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}/{_webhook_path(name)}",
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+                # با چند worker، راه‌اندازی یک worker نباید آپدیت‌های بقیه را دور بریزد
+                drop_pending_updates=not SHARED_STATE,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+            await application.start()
+        yield
+    finally:
+        for application in reversed(started):
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+        if owned:
+            _close_storage()
+
+def create_http_app():
+    """اپ FastAPI برای webhook و مسیرهای health
+
+    import کردن fastapi نزدیک به نیمی از زمان بالا آمدن است و در حالت polling
+    لازم نیست، پس اپ فقط با اولین دسترسی به main.app ساخته می‌شود.
+    """
+    from fastapi import FastAPI, Request, Response
+    from fastapi.responses import PlainTextResponse, JSONResponse
+
+    app = FastAPI(lifespan=_lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+
+    @app.get("/", response_class=PlainTextResponse)
+    def hello():
+        return "سلام شومبول طلای من رباتت فعاله❤️😁"
+
+    @app.get("/keep-alive", response_class=PlainTextResponse)
+    def keep_alive():
+        # سرویس‌های ping بیرونی فقط کد وضعیت را می‌بینند؛ loop گیرکرده بیدار حساب نمی‌شود
+        if loop_monitor.responsive() is False:
+            return PlainTextResponse("🧊 event loop is stalled", status_code=503)
+        return "✅ Bot is awake!"
+
+    @app.post(f"/{WEBHOOK_PATH}")
+    @app.post(f"/{WEBHOOK_PATH}/{{name}}")
+    async def telegram_webhook(request: Request, name: str = "default"):
+        """دریافت آپدیت از تلگرام و تحویل به صف PTB همان ربات"""
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return Response(status_code=403)
+        application = _bot_applications.get(name)
+        if application is None:
+            return Response(status_code=503)
+        await application.update_queue.put(Update.de_json(await request.json(), application.bot))
+        return Response(status_code=200)
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def metrics_endpoint():
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-@app.route("/health")
-def health_check():
-    return {
-        "status": "active" if activity_monitor.check_health() else "sleeping",
-        "last_activity": activity_monitor.last_activity
-    }
+    @app.get("/health")
+    def health_check():
+        # عمداً همگام است تا در threadpool اجرا شود و وقتی loop گیر کرده هم جواب بدهد
+        responsive = loop_monitor.responsive()
+        body = {
+            "status": {True: "ok", False: "stalled", None: "starting"}[responsive],
+            "loop": loop_monitor.stats(),
+            "startup": startup_report.stats(),
+            "last_activity": activity_monitor.last_activity,
+            "membership_cache": membership_cache.stats(),
+            "membership_index": membership_index.stats(),
+            "user_gate": user_gate.stats(),
+            "updates": update_scheduler.stats(),
+            "http": {name: pool.stats() for name, pool in http_pools.items()},
+            "bots": {
+                name: {
+                    "deletions": tenant.deletions.stats(),
+                    "outbound": tenant.outbound.stats(),
+                    "state": tenant.state.stats(),
+                    "receipts": tenant.receipts.stats()
+                }
+                for name, tenant in tenants.items()
+            }
+        }
+        return JSONResponse(body, status_code=503 if responsive is False else 200)
+
+    return app
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+def __getattr__(name):
+    # uvicorn main:app و bench.py اپ را از همین مسیر می‌گیرند
+    if name == "app":
+        app = globals()["app"] = create_http_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaVideo
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
+import httpx
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     ContextTypes,
     filters,
     Defaults
@@ -63,37 +203,325 @@ class ActivityMonitor:
     def record_activity(self):
         self.last_activity = time.time()
 
-    def check_health(self):
-        return time.time() - self.last_activity < 120
-
 activity_monitor = ActivityMonitor()
 
-# ===== تابع keep-alive داخلی =====
-def internal_keep_alive():
-    """ارسال پیام‌های داخلی برای فعال نگه داشتن ربات"""
-    while True:
+# ===== متریک‌ها (فرمت متنی Prometheus) =====
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+RECEIPT_BUCKETS = (60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600, 24 * 3600)
+
+class Metrics:
+    """رجیستری ساده‌ی counter/gauge/histogram بدون وابستگی خارجی
+
+    مقادیری که از قبل در کلاس‌های دیگر شمرده می‌شوند (کش‌ها، صف‌ها) با
+    collectorها درست قبل از رندر خوانده می‌شوند.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._values = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self._meta[name] = (kind, help_text, buckets or LATENCY_BUCKETS)
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, self._labels(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, self._labels(labels))
+        buckets = self._meta[name][2]
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def collector(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _fmt_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        pairs = []
+        for key, value in items:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+            pairs.append(f'{key}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+
+    def render(self):
+        for fn in self._collectors:
+            try:
+                fn(self)
+            except Exception as e:
+                logging.debug(f"خطا در collector متریک: {e}")
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, buckets) in sorted(self._meta.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "histogram":
+                    for (hname, labels), (counts, total, count) in sorted(self._histograms.items()):
+                        if hname != name:
+                            continue
+                        for bound, n in zip(buckets, counts):
+                            lines.append(f"{name}_bucket{self._fmt_labels(labels, [('le', bound)])} {n}")
+                        lines.append(f"{name}_bucket{self._fmt_labels(labels, [('le', '+Inf')])} {count}")
+                        lines.append(f"{name}_sum{self._fmt_labels(labels)} {total}")
+                        lines.append(f"{name}_count{self._fmt_labels(labels)} {count}")
+                else:
+                    for (vname, labels), value in sorted(self._values.items()):
+                        if vname == name:
+                            lines.append(f"{name}{self._fmt_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("bot_handler_duration_seconds", "histogram", "Handler latency")
+metrics.describe("bot_handler_errors_total", "counter", "Handler exceptions by type")
+metrics.describe("bot_handler_api_calls", "histogram", "Bot API calls made per handler invocation", COUNT_BUCKETS)
+metrics.describe("bot_updates_in_flight", "gauge", "Updates currently being handled")
+metrics.describe("bot_api_request_duration_seconds", "histogram", "Bot API call latency (excluding queue wait)")
+metrics.describe("bot_api_errors_total", "counter", "Bot API call errors by method and type")
+metrics.describe("bot_outbound_wait_seconds", "histogram", "Time spent waiting in the outbound queue")
+metrics.describe("bot_outbound_queue_depth", "gauge", "Outbound queue depth by priority")
+metrics.describe("bot_membership_cache_total", "counter", "Membership cache lookups by result")
+metrics.describe("bot_membership_index_total", "counter", "Membership index lookups by result")
+metrics.describe("bot_content_lookups_total", "counter", "Content store lookups by source")
+metrics.describe("bot_state_entries", "gauge", "Conversation state entries per namespace")
+metrics.describe("bot_state_bytes", "gauge", "Approximate conversation state bytes per namespace")
+metrics.describe("bot_write_behind_pending", "gauge", "Mutations waiting for the next flush")
+metrics.describe("bot_deletions_pending", "gauge", "Scheduled message deletions")
+metrics.describe("bot_deletion_lag_seconds", "histogram", "Delay between a deletion deadline and the delete call")
+metrics.describe("bot_update_wait_seconds", "histogram", "Time updates wait for a handler slot by class")
+metrics.describe("bot_updates_shed_total", "counter", "Updates dropped under overload by class and reason")
+metrics.describe("bot_update_queue_depth", "gauge", "Updates waiting for a handler slot by class")
+metrics.describe("bot_user_gate_total", "counter", "Per-user gate decisions for /start and check taps")
+metrics.describe("bot_loop_lag_seconds", "histogram", "Event loop scheduling lag")
+metrics.describe("bot_loop_stalls_total", "counter", "Event loop stalls longer than the threshold")
+metrics.describe("bot_loop_pending_tasks", "gauge", "Tasks alive on the event loop")
+metrics.describe("bot_startup_seconds", "gauge", "Seconds from module import start to each startup phase")
+metrics.describe("bot_http_pool_wait_seconds", "histogram", "Time Bot API calls wait for a free connection by pool")
+metrics.describe("bot_http_pool_timeouts_total", "counter", "Bot API calls dropped because a connection pool stayed full")
+metrics.describe("bot_http_pool_in_flight", "gauge", "Bot API calls holding a connection by pool")
+metrics.describe("bot_http_pool_waiting", "gauge", "Bot API calls waiting for a connection by pool")
+metrics.describe("bot_http_pool_size", "gauge", "Connection pool size by pool")
+metrics.describe("bot_receipts_pending", "gauge", "Payment receipts waiting for admin review")
+metrics.describe("bot_receipts_total", "counter", "Payment receipt events")
+metrics.describe("bot_receipt_delivery_seconds", "histogram", "Time from receipt submission to package delivery", RECEIPT_BUCKETS)
+
+# شمارنده‌ی فراخوانی‌های API در هر آپدیت؛ لیست است تا taskهای فرزند هم همان را ببینند
+_api_calls = contextvars.ContextVar("api_calls", default=None)
+# استخر HTTP فراخوانی جاری؛ OutboundDispatcher برای ارسال‌های پس‌زمینه عوضش می‌کند
+_request_pool = contextvars.ContextVar("request_pool", default="interactive")
+# رباتی که آپدیت جاری مال آن است (در حالت چند-رباتی)؛ taskهای فرزند هم همان را می‌بینند
+_current_tenant = contextvars.ContextVar("tenant", default=None)
+
+def instrument_handler(callback):
+    """اندازه‌گیری زمان، خطا و تعداد فراخوانی API برای هر هندلر"""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        calls = [0]
+        token = _api_calls.set(calls)
+        tenant_token = _current_tenant.set(context.application.bot_data.get("tenant"))
+        metrics.inc("bot_updates_in_flight", 1)
+        start = time.perf_counter()
         try:
-            if not activity_monitor.check_health():
-                logging.warning("🔔 Wake-up call sent to bot")
-            activity_monitor.record_activity()
-            time.sleep(45)
+            return await callback(update, context)
+        except StateBusyError as e:
+            # worker دیگری قفل نوشتن state.db را نگه داشته؛ به جای خطا، پیام «شلوغ است»
+            metrics.inc("bot_handler_errors_total", handler=name, exception=type(e).__name__)
+            logging.warning(f"⏳ قفل وضعیت مشترک ({e}) در {name}؛ پیام شلوغی ارسال شد")
+            try:
+                await send_busy_notice(context.bot, update)
+            except Exception as notice_error:
+                logging.warning(f"خطا در ارسال پیام شلوغی: {notice_error}")
         except Exception as e:
-            logging.error(f"Keep-alive error: {e}")
-            time.sleep(60)
-
-# ===== تابع پاکسازی خودکار =====
-def auto_cleanup():
-    """پاکسازی هر 5 دقیقه"""
-    while True:
-        time.sleep(300)
-        try:
-            global _pending_users, _user_state, _admin_temp_packages, _pending_payments, _payment_receipts
-            for data_dict in [_pending_users, _user_state, _admin_temp_packages, _pending_payments, _payment_receipts]:
-                if len(data_dict) > 200:
-                    data_dict.clear()
-            gc.collect()
-        except:
-            pass
+            metrics.inc("bot_handler_errors_total", handler=name, exception=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe("bot_handler_duration_seconds", elapsed, handler=name)
+            # chat_member (عضو شدن/رفتن از کانال) پیام کاربر نیست؛ مسیر سرد فقط با پیام و دکمه سنجیده می‌شود
+            if isinstance(update, Update) and (update.message or update.callback_query):
+                startup_report.first_update(elapsed)
+            metrics.observe("bot_handler_api_calls", calls[0], handler=name)
+            metrics.inc("bot_updates_in_flight", -1)
+            _current_tenant.reset(tenant_token)
+            _api_calls.reset(token)
+
+    return wrapper
+
+# ===== مانیتور تاخیر event loop =====
+LOOP_MONITOR_INTERVAL = 0.25
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "1.0"))
+LOOP_TASKS_EVERY = 4
+# thread نگهبان فعلی؛ سطح ماژول تا post_init دوباره (چند ربات، یا شروع مجدد) نگهبان دوم نسازد
+_loop_watchdog = None
+
+class LoopMonitor:
+    """اندازه‌گیری واقعی پاسخ‌گویی event loop به جای heartbeat
+
+    یک task داخل loop هر LOOP_MONITOR_INTERVAL ثانیه بیدار می‌شود و تاخیر
+    بیدار شدنش را ثبت می‌کند. یک thread نگهبان اگر ببیند آخرین تیک بیش از
+    LOOP_LAG_THRESHOLD ثانیه قدیمی است، stack همان لحظه‌ی thread حلقه را
+    برمی‌دارد تا کد مسدودکننده (مثلاً نوشتن همگام فایل) معلوم شود.
+    """
+
+    def __init__(self, interval=LOOP_MONITOR_INTERVAL, threshold=LOOP_LAG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.last_tick = None
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.pending_tasks = 0
+        self.stalls = 0
+        self.last_stall = None
+        self._task = None
+        self._stop = threading.Event()
+        self._loop_thread_id = None
+
+    async def _run(self):
+        ticks = 0
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            self.last_tick = now
+            self.lag_last = lag
+            self.lag_max = max(self.lag_max, lag)
+            metrics.observe("bot_loop_lag_seconds", lag)
+            if lag > self.threshold and self.last_stall and self.last_stall.get("open"):
+                self.last_stall["open"] = False
+                self.last_stall["duration"] = round(lag + self.interval, 3)
+                logging.warning(f"🐢 event loop {lag:.2f} ثانیه مسدود بود")
+            ticks += 1
+            if ticks % LOOP_TASKS_EVERY == 0:
+                # all_tasks فقط از داخل خود loop امن است
+                self.pending_tasks = len(asyncio.all_tasks())
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            last_tick = self.last_tick
+            if last_tick is None:
+                continue
+            stalled_for = time.monotonic() - last_tick
+            if stalled_for <= self.threshold + self.interval:
+                continue
+            if self.last_stall and self.last_stall.get("open") and self.last_stall["tick"] == last_tick:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            self.stalls += 1
+            self.last_stall = {"at": time.time(), "tick": last_tick, "open": True,
+                               "duration": round(stalled_for, 3), "stack": stack}
+            metrics.inc("bot_loop_stalls_total")
+            logging.error(f"🧊 event loop بیش از {stalled_for:.1f} ثانیه پاسخ نداده؛ stack:\n{stack}")
+
+    def responsive(self):
+        if self.last_tick is None:
+            return None
+        return time.monotonic() - self.last_tick <= self.threshold + self.interval
+
+    def start(self):
+        global _loop_watchdog
+        self._loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if _loop_watchdog is not None and _loop_watchdog.is_alive():
+            return
+        self._stop.clear()
+        _loop_watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        _loop_watchdog.start()
+
+    async def stop(self):
+        global _loop_watchdog
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if _loop_watchdog is not None:
+            # تا start بعدی نگهبانِ در حال خروج را زنده نبیند
+            await asyncio.get_running_loop().run_in_executor(None, _loop_watchdog.join)
+            _loop_watchdog = None
+
+    def stats(self):
+        stall = None
+        if self.last_stall:
+            stall = {k: v for k, v in self.last_stall.items() if k != "tick"}
+        return {
+            "responsive": self.responsive(),
+            "tick_age": round(time.monotonic() - self.last_tick, 3) if self.last_tick else None,
+            "lag_last_ms": round(self.lag_last * 1000, 1),
+            "lag_max_ms": round(self.lag_max * 1000, 1),
+            "pending_tasks": self.pending_tasks,
+            "stalls": self.stalls,
+            "last_stall": stall
+        }
+
+loop_monitor = LoopMonitor()
+
+# ===== گزارش زمان راه‌اندازی =====
+class StartupReport:
+    """زمان هر مرحله‌ی راه‌اندازی نسبت به شروع import این ماژول
+
+    import: پایان import؛ storage: آماده شدن فایل‌ها و دیتابیس‌ها؛ ready: اولین
+    ربات آماده‌ی دریافت آپدیت؛ first_update: پایان اولین آپدیت و
+    first_update_handler مدت خود آن هندلر (هزینه‌ی مسیر سرد)؛ caches: گرم شدن
+    کش‌ها در پس‌زمینه. هر مرحله فقط یک بار ثبت می‌شود.
+    """
+
+    def __init__(self, began):
+        self.began = began
+        self.phases = {}
+
+    def mark(self, phase, seconds=None):
+        if phase in self.phases:
+            return False
+        if seconds is None:
+            seconds = time.perf_counter() - self.began
+        self.phases[phase] = round(seconds, 4)
+        metrics.set("bot_startup_seconds", seconds, phase=phase)
+        return True
+
+    def first_update(self, handler_seconds):
+        if self.mark("first_update"):
+            self.mark("first_update_handler", handler_seconds)
+            logging.warning(f"🚀 راه‌اندازی: {self.summary()}")
+
+    def summary(self):
+        return ", ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in self.phases.items())
+
+    def stats(self):
+        return dict(self.phases)
+
+startup_report = StartupReport(STARTUP_BEGAN)
 
 # ===== تنظیمات بهینه‌شده =====
 logging.basicConfig(
@@ -115,455 +543,3825 @@ except (ValueError, TypeError):
     ADMIN_ID = 0
     logging.warning("⚠️ ADMIN_ID معتبر نیست")
 
+# ===== چند ربات در یک پروسه =====
+BOTS_CONFIG_FILE = os.getenv("BOTS_CONFIG", "bots.json")
+TENANT_DATA_DIR = "data"
+
 # ===== فایل‌های ذخیره‌سازی بهینه =====
 VIDEO_DB_FILE = "videos.json"
+VIDEO_SQLITE_FILE = "videos.db"
 USERS_FILE = "users.json"
+USERS_SNAPSHOT_FILE = "users.bin"
+USERS_LOG_FILE = "users.log"
+USERS_COMPACT_THRESHOLD = 2000
+# حالت چند worker: کاربران تأییدشده تا این مدت بدون کوئری SQLite شناخته می‌شوند
+USERS_KNOWN_TTL = 600
+USERS_KNOWN_MAX = 200000
+FLUSH_INTERVAL = 2.0
+FLUSH_THRESHOLD = 100
 
-# ===== کش در حافظه برای کاهش I/O =====
-_videos_cache = None
-_users_cache = None
-_user_state = {}
-_pending_users = {}
-_admin_temp_packages = {}
-_pending_payments = {}
-_payment_receipts = {}
-
-# ===== مدیریت حافظه و ذخیره‌سازی بهینه =====
-def _ensure_files():
-    """ایجاد فایل‌های ضروری با مصرف کمینه"""
-    try:
-        if not os.path.exists(VIDEO_DB_FILE):
-            with open(VIDEO_DB_FILE, "w", encoding="utf-8") as f:
-                json.dump({}, f, ensure_ascii=False)
-        if not os.path.exists(USERS_FILE):
-            with open(USERS_FILE, "w", encoding="utf-8") as f:
-                json.dump([], f)
-    except Exception as e:
-        logging.warning(f"خطا در ایجاد فایل‌ها: {e}")
+# ===== کش عضویت کانال =====
+MEMBER_CACHE_POSITIVE_TTL = int(os.getenv("MEMBER_CACHE_POSITIVE_TTL", "600"))
+MEMBER_CACHE_NEGATIVE_TTL = int(os.getenv("MEMBER_CACHE_NEGATIVE_TTL", "10"))
+MEMBER_CACHE_MAX_SIZE = 50000
+MEMBER_INDEX_SNAPSHOT_FILE = "members.json"
+MEMBER_INDEX_LOG_FILE = "members.log"
+MEMBER_INDEX_COMPACT_THRESHOLD = 5000
+# عضویتی که این مدت تأیید نشده دوباره از API پرسیده می‌شود (رویداد left ممکن است وقتی ربات خاموش بوده از دست رفته باشد)
+MEMBER_INDEX_TTL = 12 * 3600
 
-def load_videos():
-    """لود ویدیوها با کش کردن"""
-    global _videos_cache
-    if _videos_cache is not None:
-        return _videos_cache.copy()
-    try:
-        with open(VIDEO_DB_FILE, "r", encoding="utf-8") as f:
-            _videos_cache = json.load(f)
-        return _videos_cache.copy()
-    except Exception as e:
-        logging.error(f"خطا در لود ویدیوها: {e}")
-        return {}
+# ===== حذف خودکار ویدیوها =====
+AUTO_DELETE_SECONDS = 20
+DELETE_JOURNAL_FILE = "pending_deletes.json"
+DELETE_BATCH_WINDOW = 0.5
 
-def save_videos(data):
-    """ذخیره ویدیوها با بهینه‌سازی"""
-    global _videos_cache
-    try:
-        with open(VIDEO_DB_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        _videos_cache = data.copy()
-    except Exception as e:
-        logging.error(f"خطا در ذخیره ویدیوها: {e}")
+# ===== محدودیت نرخ ارسال =====
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = ["interactive", "normal", "background"]
+OUTBOUND_GLOBAL_RATE = 30
+OUTBOUND_CHAT_RATE = 1
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_SCAN_LIMIT = 50
+# هر چندمین مجوز به قدیمی‌ترین درخواست صف‌ها می‌رسد تا حذف‌ها و برادکست پشت پاسخ‌ها گرسنه نمانند
+OUTBOUND_FAIR_EVERY = 5
+# deleteMessage در سقف ~۳۰ پیام در ثانیه‌ی ارسال حساب نمی‌شود؛ حذف‌ها خط و سطل جدای خودشان را دارند
+OUTBOUND_DELETE_RATE = 20
 
-def load_users():
-    """لود کاربران با کش کردن"""
-    global _users_cache
-    if _users_cache is not None:
-        return _users_cache.copy()
-    try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            _users_cache = json.load(f)
-        return _users_cache.copy()
-    except Exception as e:
-        logging.error(f"خطا در لود کاربران: {e}")
-        return []
+# ===== اتصال HTTP به Bot API =====
+# getUpdates استخر خودش را دارد (یک اتصال برای هر ربات)؛ ارسال‌های پس‌زمینه هم جدا هستند
+HTTP_VERSION = os.getenv("HTTP_VERSION", "1.1")
+HTTP_POOL_INTERACTIVE = int(os.getenv("HTTP_POOL_INTERACTIVE", "64"))
+HTTP_POOL_BACKGROUND = int(os.getenv("HTTP_POOL_BACKGROUND", "16"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 5
+HTTP_WRITE_TIMEOUT = 5
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "10"))
+# read timeout متدهایی که با ۵ ثانیه‌ی پیش‌فرض زیر بار قطع می‌شدند (write آن‌ها را خود PTB ۲۰ ثانیه می‌گذارد)
+HTTP_METHOD_TIMEOUTS = {
+    "sendVideo": 30,
+    "sendDocument": 30,
+    "sendPhoto": 20,
+    "sendMediaGroup": 60,
+    "copyMessage": 15,
+    "forwardMessage": 15,
+    "getFile": 15,
+    **json.loads(os.getenv("HTTP_METHOD_TIMEOUTS", "{}"))
+}
 
-def save_users(data):
-    """ذخیره کاربران با بهینه‌سازی"""
-    global _users_cache
-    try:
-        with open(USERS_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
-        _users_cache = data.copy()
-    except Exception as e:
-        logging.error(f"خطا در ذخیره کاربران: {e}")
+# ===== برادکست =====
+BROADCAST_STATE_FILE = "broadcast.json"
+BROADCAST_CHUNK_SIZE = 200
+BROADCAST_CONCURRENCY = 25
+BROADCAST_PROGRESS_INTERVAL = 15
+USERS_LOADING_TEXT = "⏳ لیست کاربران هنوز در حال بارگذاری است؛ چند ثانیه دیگر دوباره امتحان کن."
 
-def generate_code(length=6):
-    """کد کوتاه‌تر برای صرفه‌جویی"""
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+# ===== صف فیش‌های پرداخت =====
+RECEIPTS_DB_FILE = "receipts.db"
+RECEIPT_PAGE_SIZE = 5
+RECEIPT_DELIVERY_CONCURRENCY = 10
+RECEIPT_NOTIFY_INTERVAL = 60
 
-def add_user(user_id):
-    """افزودن کاربر با بهینه‌سازی"""
-    users = load_users()
-    if user_id not in users:
-        users.append(user_id)
-        save_users(users)
+# ===== آمار استفاده =====
+ANALYTICS_DB_FILE = "analytics.db"
+ANALYTICS_FLUSH_INTERVAL = 60
+ANALYTICS_HLL_PRECISION = 12
+ANALYTICS_MEMORY_DAYS = 2
+ANALYTICS_RETENTION_DAYS = 35
+ANALYTICS_TOP_CODES = 10
+ANALYTICS_DAY_OFFSET = 3 * 3600 + 1800
 
-# ===== بررسی عضویت بهینه‌شده =====
-async def is_member(chat_id, user_id, context):
-    """بررسی عضویت با هندلینگ خطا"""
-    try:
-        member = await context.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-        return member.status in ["member", "administrator", "creator"]
-    except Exception as e:
-        logging.warning(f"خطا در بررسی عضویت {user_id}: {e}")
-        return False
+# ===== هماهنگی درخواست‌های هر کاربر =====
+USER_DEBOUNCE_SECONDS = 2.0
+USER_GATE_MAX_ENTRIES = 50000
+USER_GATE_CHECKING_TEXT = "⏳ در حال بررسی..."
+USER_GATE_INFLIGHT_TEXT = "⏳ درخواست قبلی‌ات در حال انجام است؛ چند لحظه صبر کن."
+USER_GATE_DEBOUNCED_TEXT = "✅ این درخواست همین الان انجام شد؛ نتیجه را بالاتر ببین."
 
-# ===== پنل ادمین بهینه‌شده =====
-async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    activity_monitor.record_activity()
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("❌ فقط ادمین دسترسی دارد.")
-        return
+# ===== زمان‌بندی آپدیت‌های ورودی =====
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+UPDATE_CLASS_ADMIN = 0
+UPDATE_CLASS_CALLBACK = 1
+UPDATE_CLASS_START = 2
+UPDATE_CLASS_OTHER = 3
+UPDATE_CLASS_NAMES = ["admin", "callback", "start", "other"]
+# سقف صف هر کلاس؛ صف ادمین محدود نمی‌شود
+UPDATE_QUEUE_LIMITS = [None, 500, 1000, 200]
+UPDATE_MAX_WAIT = 20
+UPDATE_ADMIT_SLACK = 256
+UPDATE_BUSY_NOTICE_TTL = 30
+UPDATE_BUSY_TEXT = "⏳ ربات الان خیلی شلوغ است، چند ثانیه دیگر دوباره امتحان کن."
 
-    keyboard = [
-        [InlineKeyboardButton("📤 آپلود ویدیو", callback_data="upload_video"),
-         InlineKeyboardButton("📦 آپلود پکیج", callback_data="upload_package")],
-        [InlineKeyboardButton("💳 پکیج پولی", callback_data="upload_paid_package")]
-    ]
-    await update.message.reply_text("پنل مدیریت:", reply_markup=InlineKeyboardMarkup(keyboard))
+# ===== وضعیت گفتگوها (TTL + LRU) =====
+STATE_SWEEP_INTERVAL = 5
+STATE_SWEEP_BATCH = 200
+# memory: فقط یک پروسه | sqlite: وضعیت مشترک برای چند worker پشت یک webhook
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", "state.db")
+# سقف انتظار event loop برای قفل نوشتن SQLite (بقیه‌ی نوشتن‌ها در thread جدا انجام می‌شوند)
+STATE_LOOP_BUSY_TIMEOUT = float(os.getenv("STATE_LOOP_BUSY_TIMEOUT", "0.25"))
+STATE_WRITE_RETRY_DELAY = 0.5
+SHARED_STATE = STATE_BACKEND == "sqlite"
 
-async def handle_admin_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    activity_monitor.record_activity()
-    query = update.callback_query
-    await query.answer()
+def _approx_size(key, value):
+    size = sys.getsizeof(key) + sys.getsizeof(value)
+    if isinstance(value, (list, tuple, set)):
+        size += sum(sys.getsizeof(item) for item in value)
+    elif isinstance(value, dict):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+    return size
 
-    if query.from_user.id != ADMIN_ID:
-        await query.edit_message_text("❌ فقط ادمین دسترسی دارد.")
-        return
+class StateNamespace:
+    """دیکشنری محدود با TTL برای هر ورودی و حذف LRU
 
-    user_id = query.from_user.id
-    data = query.data or ""
+    ورودی‌های منقضی هنگام دسترسی (lazy) و توسط sweeper به صورت تدریجی حذف
+    می‌شوند. وقتی تعداد یا حجم از سقف گذشت فقط قدیمی‌ترین ورودی‌ها حذف
+    می‌شوند، نه کل دیکشنری.
+    """
 
-    if data == "upload_video":
-        _user_state[user_id] = "uploading"
-        await query.edit_message_text("🎬 لطفاً ویدیو رو ارسال کن شومبول طلا.")
+    def __init__(self, name, ttl, max_entries, max_bytes=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
 
-    elif data == "upload_package":
-        _user_state[user_id] = "uploading_package"
-        _admin_temp_packages[user_id] = []
-        keyboard = [
-            [InlineKeyboardButton("✅ پایان و ثبت پکیج", callback_data="finish_package"),
-             InlineKeyboardButton("❌ لغو", callback_data="cancel_upload")]
-        ]
-        await query.edit_message_text(
-            "📦 اکنون ویدیوها را یکی‌یکی ارسال کن (حداکثر 8). پس از اتمام 'پایان و ثبت پکیج' را بزن.",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    def _drop(self, key):
+        value, expires, size = self._data.pop(key)
+        self.bytes -= size
+        return value
 
-    elif data == "upload_paid_package":
-        _user_state[user_id] = "uploading_paid_package"
-        _admin_temp_packages[user_id] = []
-        keyboard = [
-            [InlineKeyboardButton("✅ پایان و ثبت پکیج پولی", callback_data="finish_paid_package"),
-             InlineKeyboardButton("❌ لغو", callback_data="cancel_upload")]
-        ]
-        await query.edit_message_text(
-            "💳 حالا ویدیوهای پکیج ویژه رو یکی‌یکی بفرست (حداکثر 8). بعد 'پایان و ثبت پکیج پولی' رو بزن.",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    def _live(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            return None
+        self._data.move_to_end(key)
+        # مقدارهای list/dict ممکن است درجا تغییر کرده باشند
+        size = _approx_size(key, entry[0])
+        if size != entry[2]:
+            self.bytes += size - entry[2]
+            self._data[key] = (entry[0], entry[1], size)
+        return entry
 
-    elif data == "finish_package":
-        temp = _admin_temp_packages.get(user_id, [])
-        if not temp:
-            await query.edit_message_text("⚠️ هیچ ویدیویی برای ثبت وجود ندارد.")
-            return
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self._drop(key)
+        size = _approx_size(key, value)
+        self._data[key] = (value, time.monotonic() + self.ttl, size)
+        self.bytes += size
+        while len(self._data) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes):
+            self._drop(next(iter(self._data)))
+            self.evictions += 1
 
-        code = generate_code()
-        vids = load_videos()
-        vids[code] = {"type": "package", "files": temp.copy()}
-        save_videos(vids)
-        link = f"https://t.me/{context.bot.username}?start={code}"
-        _user_state.pop(user_id, None)
-        _admin_temp_packages.pop(user_id, None)
-        await query.edit_message_text(f"✅ پکیج ذخیره شد! ({len(temp)} ویدیو)\n🔗 لینک: {link}")
+    def __getitem__(self, key):
+        entry = self._live(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[0]
 
-    elif data == "finish_paid_package":
-        temp = _admin_temp_packages.get(user_id, [])
-        if not temp:
-            await query.edit_message_text("⚠️ هیچ ویدیویی برای ثبت وجود ندارد.")
-            return
+    def __delitem__(self, key):
+        if self._live(key) is None:
+            raise KeyError(key)
+        self._drop(key)
 
-        code = generate_code()
-        vids = load_videos()
-        vids[code] = {
-            "type": "paid",
-            "files": temp.copy(),
-            "price": 99000,
-            "card": "6037991775906427",
-            "currency": "IRR"
-        }
-        save_videos(vids)
-        link = f"https://t.me/{context.bot.username}?start={code}"
-        _user_state.pop(user_id, None)
-        _admin_temp_packages.pop(user_id, None)
-        await query.edit_message_text(f"✅ پکیج پولی ذخیره شد! ({len(temp)} ویدیو)\n🔗 لینک: {link}\nقیمت: ۹۹٬۰۰۰ تومان\nکارت: 6037991775906427")
+    def __contains__(self, key):
+        return self._live(key) is not None
 
-    elif data == "cancel_upload":
-        _user_state.pop(user_id, None)
-        _admin_temp_packages.pop(user_id, None)
-        await query.edit_message_text("❌ آپلود کنسل شد.")
+    def __len__(self):
+        return len(self._data)
 
-# ===== دریافت ویدیو از ادمین با بهینه‌سازی =====
-MAX_PACKAGE_SIZE = 8
+    def get(self, key, default=None):
+        entry = self._live(key)
+        return default if entry is None else entry[0]
 
-async def handle_video_from_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    activity_monitor.record_activity()
-    user = update.effective_user
-    if user.id != ADMIN_ID:
-        return
+    def pop(self, key, *default):
+        if self._live(key) is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return self._drop(key)
 
-    video = update.message.video or update.message.document
-    if not video:
-        await update.message.reply_text("فیلمتو بفرس دودول طلا😁😘.")
-        return
+    def setdefault(self, key, default=None):
+        entry = self._live(key)
+        if entry is not None:
+            return entry[0]
+        self[key] = default
+        return default
 
-    file_id = video.file_id
-    state = _user_state.get(user.id)
+    def append(self, key, item):
+        """افزودن به لیستِ یک کلید و برگرداندن لیست جدید"""
+        return self.extend(key, [item])
 
-    if state == "uploading":
-        code = generate_code()
-        vids = load_videos()
-        vids[code] = file_id
-        save_videos(vids)
-        link = f"https://t.me/{context.bot.username}?start={code}"
-        await update.message.reply_text(f"✅ ذخیره شد!\n🔗 لینک: {link}")
-        _user_state.pop(user.id, None)
-        return
+    def extend(self, key, new_items):
+        items = list(self.get(key) or [])
+        items.extend(new_items)
+        self[key] = items
+        return items
 
-    if state == "uploading_package":
-        tmp = _admin_temp_packages.setdefault(user.id, [])
-        if len(tmp) >= MAX_PACKAGE_SIZE:
-            await update.message.reply_text(f"⚠️ حداکثر {MAX_PACKAGE_SIZE} ویدیو.")
-            return
-        tmp.append(file_id)
-        await update.message.reply_text(f"ویدیو دریافت شد ({len(tmp)}/{MAX_PACKAGE_SIZE}).")
-        return
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
 
-    if state == "uploading_paid_package":
-        tmp = _admin_temp_packages.setdefault(user.id, [])
-        if len(tmp) >= MAX_PACKAGE_SIZE:
-            await update.message.reply_text(f"⚠️ حداکثر {MAX_PACKAGE_SIZE} ویدیو.")
-            return
-        tmp.append(file_id)
-        await update.message.reply_text(f"ویدیوی پکیج پولی دریافت شد ({len(tmp)}/{MAX_PACKAGE_SIZE}).")
-        return
+    def sweep(self, limit):
+        """بررسی حداکثر limit ورودی از قدیمی‌ترین‌ها و حذف منقضی‌ها"""
+        now = time.monotonic()
+        expired = [key for key, (_, expires, _) in islice(self._data.items(), limit) if expires <= now]
+        for key in expired:
+            self._drop(key)
+        self.expirations += len(expired)
+        return len(expired)
 
-# ===== هندل فرمان /start بهینه‌شده =====
-async def start_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    activity_monitor.record_activity()
-    user = update.effective_user
-    if not user:
-        return
+    def stats(self):
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
 
-    add_user(user.id)
-    args = context.args
+_MISSING = object()
 
-    if not args:
-        await update.message.reply_text("سلام عزیزم برای دریافت ویدیو ها، عضو دو کانال شو.")
-        return
+class SQLiteStateNamespace:
+    """همان رابط StateNamespace روی جدول مشترک SQLite
 
-    code = args[0]
-    vids = load_videos()
+    زمان انقضا با ساعت دیواری ذخیره می‌شود تا بین پروسه‌ها معنی داشته باشد.
+    LRU بر اساس آخرین نوشتن است و حذف‌های سقف تعداد/حجم در sweep انجام می‌شود.
+    pop با DELETE ... RETURNING اتمیک است، پس فقط یکی از workerها یک کلید را برمی‌دارد.
 
-    if code not in vids:
-        await update.message.reply_text("❌ لینک نامعتبر است.")
-        return
+    نوشتن و حذف ساده روی event loop منتظر قفل SQLite نمی‌مانند: مقدار در _local
+    (دیده‌شدن فوری در همین پروسه) ثبت و در thread نویسنده‌ی backend نوشته می‌شود.
+    عملیات خواندن-تغییر-نوشتن (pop/extend/setdefault) همگام‌اند ولی حداکثر
+    STATE_LOOP_BUSY_TIMEOUT منتظر قفل می‌مانند و بعد StateBusyError می‌دهند.
+    """
 
-    entry = vids[code]
+    def __init__(self, backend, name, ttl, max_entries, max_bytes=None):
+        self.backend = backend
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self.expirations = 0
+        self.entries = 0
+        self.bytes = 0
+        self._local = {}
+        self._local_lock = threading.Lock()
+        self._seq = 0
 
-    # اگر پکیج پولی است -> درخواست فیش از کاربر
-    if isinstance(entry, dict) and entry.get("type") == "paid":
-        card = entry.get("card", "6037991775906427")
-        price = entry.get("price", 99000)
-        _pending_payments[user.id] = code
-        await update.message.reply_text(
-            f"🔒 این پکیج پولی است.\nلطفاً مبلغ {price:,} تومان را به کارت {card} واریز کنید و فیش واریزی را همین‌جا ارسال کنید.\nبلافاصله پس از تایید تراکنش توسط ادمین، پکیج ویژه در اختیار شما قرار خواهد گرفت."
+    @staticmethod
+    def _k(key):
+        return json.dumps(key)
+
+    def _row(self, conn, key):
+        return conn.execute(
+            "SELECT value FROM state WHERE ns = ? AND key = ? AND expires > ?",
+            (self.name, self._k(key), time.time())
+        ).fetchone()
+
+    def _write(self, conn, key, payload):
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO state (ns, key, value, expires, size, touched) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.name, self._k(key), payload, now + self.ttl, len(payload), now)
         )
-        return
 
-    # ادامه‌ی بررسی عضویت برای پکیج‌های رایگان یا ویدیوی تکی
-    user_id = user.id
-    is_in_first, is_in_second = await asyncio.gather(
-        is_member(CHANNEL_ID, user_id, context),
-        is_member(f"@{SECOND_CHANNEL_USERNAME}", user_id, context)
-    )
+    def _store(self, conn, key, payload):
+        """اجرای یک نوشتن صف‌شده در thread نویسنده؛ payload=None یعنی حذف"""
+        if payload is None:
+            conn.execute("DELETE FROM state WHERE ns = ? AND key = ?", (self.name, self._k(key)))
+        else:
+            self._write(conn, key, payload)
 
-    if not (is_in_first and is_in_second):
-        _pending_users[user_id] = code
-        buttons = []
-        if not is_in_first:
-            buttons.append([InlineKeyboardButton("📢 سکسولوژی", url=f"https://t.me/{CHANNEL_USERNAME}")])
-        if not is_in_second:
-            buttons.append([InlineKeyboardButton("📢 سکسی لند", url=f"https://t.me/{SECOND_CHANNEL_USERNAME}")])
-        buttons.append([InlineKeyboardButton("✅ بررسی عضویت", callback_data=f"check_{code}")])
-        await update.message.reply_text("🔒 لطفاً در کانال‌ها عضو شو:", reply_markup=InlineKeyboardMarkup(buttons))
-        return
+    def _defer(self, key, payload):
+        with self._local_lock:
+            self._seq += 1
+            self._local[key] = (self._seq, payload)
+            seq = self._seq
+        self.backend.defer(self, seq, key, payload)
 
-    await _deliver_content(update, context, code, vids)
+    def _settle(self, key, seq):
+        """بعد از commit؛ فقط اگر نوشتن جدیدتری برای همین کلید در صف نباشد"""
+        with self._local_lock:
+            entry = self._local.get(key)
+            if entry is not None and entry[0] == seq:
+                del self._local[key]
 
-async def _deliver_content(update: Update, context: ContextTypes.DEFAULT_TYPE, code: str, vids: dict):
-    """تحویل محتوا با مدیریت خطا"""
-    entry = vids.get(code)
-    if not entry:
-        await update.message.reply_text("❌ محتوای مورد نظر یافت نشد.")
-        return
+    def _pending(self, key):
+        """(seq, payload) نوشتنی که هنوز به SQLite نرسیده یا None"""
+        with self._local_lock:
+            return self._local.get(key)
 
-    try:
-        if isinstance(entry, dict) and entry.get("type") == "package":
-            await send_package(update, context, entry.get("files", []))
-        else:
-            await send_video(update, context, entry)
-    except Exception as e:
-        logging.error(f"خطا در ارسال محتوا: {e}")
-        await update.message.reply_text("❌ خطا در ارسال محتوا. لطفاً مجدداً تلاش کنید.")
+    def _locked(self, fn):
+        try:
+            return fn()
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e) or "busy" in str(e):
+                raise StateBusyError(self.name) from e
+            raise
 
-# ===== دکمه بررسی عضویت بهینه‌شده =====
-async def handle_check_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    activity_monitor.record_activity()
-    query = update.callback_query
-    user_id = query.from_user.id
-    await query.answer()
+    def get(self, key, default=None):
+        pending = self._pending(key)
+        if pending is not None:
+            return default if pending[1] is None else json.loads(pending[1])
+        with self.backend.lock:
+            row = self._row(self.backend.conn, key)
+        return json.loads(row[0]) if row else default
 
-    if user_id not in _pending_users:
-        await query.edit_message_text("❌ لینک پیدا نشد یا منقضی شده.")
-        return
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
 
-    code = _pending_users[user_id]
-    vids = load_videos()
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
 
-    if code not in vids:
-        await query.edit_message_text("❌ لینک معتبر نیست.")
-        return
+    def __setitem__(self, key, value):
+        self._defer(key, json.dumps(value, ensure_ascii=False))
 
-    is_in_first, is_in_second = await asyncio.gather(
-        is_member(CHANNEL_ID, user_id, context),
-        is_member(f"@{SECOND_CHANNEL_USERNAME}", user_id, context)
-    )
+    def __delitem__(self, key):
+        self.pop(key)
 
-    if not (is_in_first and is_in_second):
-        buttons = []
-        if not is_in_first:
-            buttons.append([InlineKeyboardButton("📢 سکسولوژی", url=f"https://t.me/{CHANNEL_USERNAME}")])
-        if not is_in_second:
-            buttons.append([InlineKeyboardButton("📢 سکسی لند", url=f"https://t.me/{SECOND_CHANNEL_USERNAME}")])
-        buttons.append([InlineKeyboardButton("✅ بررسی مجدد", callback_data=f"check_{code}")])
-        await query.edit_message_text("⛔ هنوز عضویت کامل نشده.", reply_markup=InlineKeyboardMarkup(buttons))
-        return
+    def __len__(self):
+        with self.backend.lock:
+            return self.backend.conn.execute(
+                "SELECT COUNT(*) FROM state WHERE ns = ? AND expires > ?", (self.name, time.time())
+            ).fetchone()[0]
 
-    del _pending_users[user_id]
-    try:
-        await context.bot.delete_message(chat_id=query.message.chat.id, message_id=query.message.message_id)
-    except:
-        pass
+    def pop(self, key, *default):
+        pending = self._pending(key)
+        if pending is not None:
+            # آخرین نوشتن همین پروسه هنوز در صف است؛ حذفش هم پشت همان در صف می‌رود
+            self._defer(key, None)
+            if pending[1] is not None:
+                return json.loads(pending[1])
+            row = None
+        else:
+            def delete():
+                with self.backend.lock:
+                    return self.backend.conn.execute(
+                        "DELETE FROM state WHERE ns = ? AND key = ? RETURNING value, expires", (self.name, self._k(key))
+                    ).fetchone()
+            row = self._locked(delete)
+        if row is None or row[1] <= time.time():
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return json.loads(row[0])
 
-    await _deliver_content(Update(update.update_id, message=query.message), context, code, vids)
+    def _update(self, key, fn):
+        """read-modify-write اتمیک؛ fn مقدار فعلی (یا _MISSING) را می‌گیرد و (مقدار جدید، خروجی) می‌دهد"""
+        pending = self._pending(key)
+        if pending is not None:
+            value, result = fn(_MISSING if pending[1] is None else json.loads(pending[1]))
+            if value is not _MISSING:
+                self[key] = value
+            return result
 
-# ===== ارسال ویدیو با مدیریت خطا =====
-async def send_video(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: str):
-    try:
-        msg = await update.message.reply_video(
-            file_id,
-            caption="🎥 ❌ویدیو تا ۲۰ ثانیه قابل مشاهده است❌."
-        )
-        asyncio.create_task(_del_after(context, msg.chat.id, msg.message_id, 20))
-    except Exception as e:
-        logging.error(f"خطا در ارسال ویدیو: {e}")
-        try:
-            msg = await context.bot.send_video(
-                chat_id=update.message.chat.id,
-                video=file_id,
-                caption="🎥 ویدیو تا ۲۰ ثانیه قابل مشاهده است."
-            )
-            asyncio.create_task(_del_after(context, msg.chat.id, msg.message_id, 20))
-        except Exception as e2:
-            logging.error(f"خطای دوم در ارسال ویدیو: {e2}")
-            await update.message.reply_text("❌ خطا در ارسال ویدیو.")
+        def transaction():
+            with self.backend.transaction() as conn:
+                row = self._row(conn, key)
+                value, result = fn(json.loads(row[0]) if row else _MISSING)
+                if value is not _MISSING:
+                    self._write(conn, key, json.dumps(value, ensure_ascii=False))
+            return result
+        return self._locked(transaction)
 
-async def _del_after(context, chat_id, message_id, delay):
-    """حذف پیام پس از تاخیر"""
-    await asyncio.sleep(delay)
-    try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-    except Exception as e:
-        logging.debug(f"خطا در حذف پیام: {e}")
+    def setdefault(self, key, default=None):
+        return self._update(key, lambda current: (default, default) if current is _MISSING else (_MISSING, current))
 
-# ===== ارسال پکیج بهینه‌شده =====
-async def send_package(update: Update, context: ContextTypes.DEFAULT_TYPE, files: list):
-    if not files:
-        await update.message.reply_text("❌ پکیج خالی یا منقضی شده.")
+    def append(self, key, item):
+        return self.extend(key, [item])
+
+    def extend(self, key, new_items):
+        """read-modify-write اتمیک تا آپلودهای هم‌زمان در چند worker گم نشوند"""
+        def add(current):
+            items = [] if current is _MISSING else current
+            items.extend(new_items)
+            return items, items
+        return self._update(key, add)
+
+    def clear(self):
+        with self._local_lock:
+            self._local.clear()
+        with self.backend.lock:
+            self.backend.conn.execute("DELETE FROM state WHERE ns = ?", (self.name,))
+
+    def sweep(self, limit):
+        with self.backend.transaction(background=True) as conn:
+            expired = conn.execute(
+                "DELETE FROM state WHERE ns = ? AND key IN "
+                "(SELECT key FROM state WHERE ns = ? AND expires <= ? LIMIT ?)",
+                (self.name, self.name, time.time(), limit)
+            ).rowcount
+            count, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM state WHERE ns = ?", (self.name,)
+            ).fetchone()
+            over = max(0, count - self.max_entries)
+            if self.max_bytes and size > self.max_bytes:
+                over = max(over, 1)
+            evicted = 0
+            if over:
+                evicted = conn.execute(
+                    "DELETE FROM state WHERE ns = ? AND key IN "
+                    "(SELECT key FROM state WHERE ns = ? ORDER BY touched LIMIT ?)",
+                    (self.name, self.name, min(over, limit))
+                ).rowcount
+        self.expirations += expired
+        self.evictions += evicted
+        self.entries, self.bytes = count - evicted, size
+        return expired
+
+    def stats(self):
+        # از آخرین sweep؛ /health نباید منتظر قفل SQLite بماند
+        return {
+            "entries": self.entries,
+            "bytes": self.bytes,
+            "pending_writes": len(self._local),
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+class MemoryStateBackend:
+    """وضعیت داخل همین پروسه (پیش‌فرض)"""
+    shared = False
+
+    def namespace(self, name, ttl, max_entries, max_bytes=None):
+        return StateNamespace(name, ttl, max_entries, max_bytes)
+
+class StateBusyError(Exception):
+    """قفل نوشتن SQLite مشترک در STATE_LOOP_BUSY_TIMEOUT آزاد نشد"""
+
+class SQLiteStateBackend:
+    """وضعیت مشترک بین چند پروسه روی یک فایل SQLite در حالت WAL
+
+    دو اتصال جدا دارد: conn برای دسترسی‌های کوتاه هندلرها روی event loop (با
+    busy timeout کوتاه) و background_conn برای نوشتن‌های صف‌شده‌ی namespaceها،
+    flush رجیستری و sweep که در thread اجرا می‌شوند و ممکن است تا ۱۰ ثانیه منتظر
+    قفل نوشتن worker دیگری بمانند. خواندن‌ها در WAL منتظر نویسنده نمی‌شوند.
+    """
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.background_lock = threading.RLock()
+        self._conn = None
+        self._background_conn = None
+        self._ops = queue.Queue()
+        self._writer = None
+
+    def connect(self, timeout=10):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "expires REAL NOT NULL, size INTEGER NOT NULL, touched REAL NOT NULL, "
+            "PRIMARY KEY (ns, key)) WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS state_expires ON state (ns, expires)")
+        conn.execute("CREATE INDEX IF NOT EXISTS state_touched ON state (ns, touched)")
+        conn.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY)")
+        # ساختن جدول‌ها (یک بار هنگام شروع) با timeout کامل؛ بعد از آن سقف خود اتصال
+        conn.execute(f"PRAGMA busy_timeout = {int(timeout * 1000)}")
+        return conn
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            with self.lock:
+                if self._conn is None:
+                    self._conn = self.connect(timeout=STATE_LOOP_BUSY_TIMEOUT)
+        return self._conn
+
+    @property
+    def background_conn(self):
+        if self._background_conn is None:
+            with self.background_lock:
+                if self._background_conn is None:
+                    self._background_conn = self.connect()
+        return self._background_conn
+
+    @contextmanager
+    def transaction(self, background=False):
+        with self.background_lock if background else self.lock:
+            conn = self.background_conn if background else self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def namespace(self, name, ttl, max_entries, max_bytes=None):
+        return SQLiteStateNamespace(self, name, ttl, max_entries, max_bytes)
+
+    def defer(self, ns, seq, key, payload):
+        if self._writer is None:
+            with self.background_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name="state-writer", daemon=True)
+                    self._writer.start()
+        self._ops.put((ns, seq, key, payload))
+
+    def _write_loop(self):
+        """نوشتن‌های صف‌شده، هر دسته در یک تراکنش؛ در خطا دسته دوباره تلاش می‌شود"""
+        batch, stopping = [], False
+        while batch or not stopping:
+            if not batch:
+                batch.append(self._ops.get())
+            while True:
+                try:
+                    batch.append(self._ops.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [op for op in batch if op is not None]
+                if not batch:
+                    break
+            try:
+                with self.transaction(background=True) as conn:
+                    for ns, _, key, payload in batch:
+                        ns._store(conn, key, payload)
+            except Exception as e:
+                logging.error(f"خطا در نوشتن وضعیت مشترک ({len(batch)} مورد): {e}")
+                if stopping:
+                    break
+                time.sleep(STATE_WRITE_RETRY_DELAY)
+                continue
+            for ns, seq, key, _ in batch:
+                ns._settle(key, seq)
+            batch = []
+
+    def close(self):
+        if self._writer is not None:
+            self._ops.put(None)
+            self._writer.join()
+            self._writer = None
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        with self.background_lock:
+            if self._background_conn is not None:
+                self._background_conn.close()
+                self._background_conn = None
+
+class StateStore:
+    def __init__(self, backend):
+        self.backend = backend
+        self.namespaces = {}
+        self._task = None
+
+    def namespace(self, name, ttl, max_entries, max_bytes=None):
+        ns = self.namespaces[name] = self.backend.namespace(name, ttl, max_entries, max_bytes)
+        return ns
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(STATE_SWEEP_INTERVAL)
+            for ns in self.namespaces.values():
+                if self.backend.shared:
+                    # sweep اشتراکی تراکنش نوشتن دارد و ممکن است منتظر worker دیگری بماند
+                    await asyncio.get_running_loop().run_in_executor(None, ns.sweep, STATE_SWEEP_BATCH)
+                else:
+                    ns.sweep(STATE_SWEEP_BATCH)
+                # یک namespace در هر قدم تا event loop طولانی اشغال نشود
+                await asyncio.sleep(0)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {name: ns.stats() for name, ns in self.namespaces.items()}
+
+# ===== لایه‌ی نوشتن پس‌زمینه (write-behind) =====
+def _atomic_write(path, payload):
+    """نوشتن اتمیک: فایل موقت + fsync + rename"""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _atomic_write_json(path, data):
+    _atomic_write(path, json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+def _worker_file(path):
+    """در حالت چند worker هر پروسه ژورنال خودش را دارد (name.<pid>.ext)"""
+    if not SHARED_STATE:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{os.getpid()}{ext}"
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _claim_orphan_files(path):
+    """ژورنال workerهای مرده (و فایل حالت تک‌پروسه) را با rename اتمیک برمی‌دارد"""
+    root, ext = os.path.splitext(path)
+    candidates = [path] if os.path.exists(path) else []
+    for candidate in glob.glob(f"{glob.escape(root)}.*{ext}"):
+        pid = candidate[len(root) + 1:len(candidate) - len(ext)]
+        if pid.isdigit() and int(pid) != os.getpid() and not _pid_alive(int(pid)):
+            candidates.append(candidate)
+    claimed = []
+    for candidate in candidates:
+        target = f"{candidate}.claimed-{os.getpid()}"
+        try:
+            os.rename(candidate, target)
+        except FileNotFoundError:
+            # worker دیگری زودتر برداشته
+            continue
+        claimed.append(target)
+    return claimed
+
+class WriteBehind:
+    """تغییرات فوراً در حافظه اعمال و در پس‌زمینه روی دیسک نوشته می‌شوند
+
+    هر sink باید متدهای pending_count() و flush() داشته باشد. flush در یک
+    executor تک‌نخی اجرا می‌شود تا event loop هیچ‌وقت منتظر دیسک نماند.
+    """
+
+    def __init__(self, interval=FLUSH_INTERVAL, threshold=FLUSH_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self._sinks = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="write-behind")
+        self._flush_lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    def register(self, sink):
+        self._sinks.append(sink)
+        return sink
+
+    def pending(self):
+        return sum(sink.pending_count() for sink in self._sinks)
+
+    def mark_dirty(self):
+        """بیدار کردن flusher وقتی حجم تغییرات از آستانه گذشت"""
+        if self._wakeup is not None and self.pending() >= self.threshold:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def flush_all(self):
+        with self._flush_lock:
+            for sink in self._sinks:
+                try:
+                    sink.flush()
+                except Exception as e:
+                    logging.error(f"خطا در flush {type(sink).__name__}: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self.pending():
+                await self._loop.run_in_executor(self._executor, self.flush_all)
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._wakeup = None
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.flush_all)
+
+    def close(self):
+        """flush نهایی و همگام هنگام خروج"""
+        self.flush_all()
+        self._executor.shutdown(wait=True)
+
+persistence = WriteBehind()
+
+# ===== ذخیره‌سازی محتوا (SQLite با WAL) =====
+class ContentStore:
+    """نگهداری کدهای لینک در SQLite؛ هر جستجو و درج فقط یک سطر را لمس می‌کند
+
+    مقدار هر کد همان ساختار قدیمی videos.json است (file_id تکی یا دیکشنری
+    package/paid) که به صورت JSON در ستون data ذخیره می‌شود. درج‌های جدید
+    تا flush بعدی در _pending می‌مانند و خواندن‌ها اول از آنجا جواب می‌گیرند.
+    """
+
+    def __init__(self, path, writer=None):
+        self.path = path
+        self.writer = writer
+        self._conn = None
+        self._wconn = None
+        self._lock = threading.Lock()
+        self._wlock = threading.Lock()
+        self._pending = {}
+        self._flushing = {}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def open(self):
+        with self._lock:
+            if self._conn is not None:
+                return
+            wconn = self._connect()
+            wconn.execute(
+                "CREATE TABLE IF NOT EXISTS content ("
+                "code TEXT PRIMARY KEY, kind TEXT NOT NULL, data TEXT NOT NULL"
+                ") WITHOUT ROWID"
+            )
+            wconn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            # اتصال خواندن (event loop) و نوشتن (executor) جداست تا WAL هم‌زمانی بدهد
+            self._wconn = wconn
+            self._conn = self._connect()
+
+    def close(self):
+        self.flush()
+        with self._lock, self._wlock:
+            for conn in (self._conn, self._wconn):
+                if conn is not None:
+                    conn.close()
+            self._conn = self._wconn = None
+
+    @staticmethod
+    def _kind(entry):
+        if isinstance(entry, dict):
+            return entry.get("type", "package")
+        return "video"
+
+    def _buffered(self, code):
+        entry = self._pending.get(code)
+        if entry is None:
+            entry = self._flushing.get(code)
+        return entry
+
+    def get(self, code, default=None):
+        with self._lock:
+            entry = self._buffered(code)
+            if entry is not None:
+                metrics.inc("bot_content_lookups_total", source="buffer")
+                return entry
+            row = self._conn.execute("SELECT data FROM content WHERE code = ?", (code,)).fetchone()
+        metrics.inc("bot_content_lookups_total", source="sqlite" if row else "miss")
+        return json.loads(row[0]) if row else default
+
+    def __contains__(self, code):
+        return self.get(code) is not None
+
+    def __len__(self):
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM content").fetchone()[0]
+            for code in set(self._pending).union(self._flushing):
+                if self._conn.execute("SELECT 1 FROM content WHERE code = ?", (code,)).fetchone() is None:
+                    count += 1
+        return count
+
+    def put(self, code, entry):
+        """ثبت در حافظه؛ نوشتن روی دیسک با flush بعدی"""
+        with self._lock:
+            self._pending[code] = entry
+        if self.writer is not None:
+            self.writer.mark_dirty()
+        else:
+            self.flush()
+
+    def put_many(self, items):
+        """نوشتن مستقیم چند کد در یک تراکنش"""
+        rows = [(code, self._kind(entry), json.dumps(entry, ensure_ascii=False)) for code, entry in items]
+        with self._wlock:
+            self._wconn.execute("BEGIN")
+            try:
+                self._wconn.executemany(
+                    "INSERT OR REPLACE INTO content (code, kind, data) VALUES (?, ?, ?)", rows
+                )
+                self._wconn.execute("COMMIT")
+            except Exception:
+                self._wconn.execute("ROLLBACK")
+                raise
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+        try:
+            self.put_many(self._flushing.items())
+        except Exception:
+            with self._lock:
+                # برگرداندن تغییرات برای تلاش بعدی (بدون پاک کردن درج‌های جدیدتر)
+                for code, entry in self._flushing.items():
+                    self._pending.setdefault(code, entry)
+            raise
+        finally:
+            with self._lock:
+                self._flushing = {}
+
+    @staticmethod
+    def _import_key(path):
+        return f"imported:{os.path.basename(path)}"
+
+    def imported(self, path):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM meta WHERE key = ?", (self._import_key(path),)).fetchone() is not None
+
+    def import_json(self, path):
+        """ورود یک‌باره‌ی videos.json قدیمی (ساختار ترکیبی رشته/دیکشنری)
+
+        نشانه‌ی ورود در همان تراکنش درج‌ها ثبت می‌شود؛ اگر ورود شکست بخورد یا
+        نیمه‌کاره بماند، اجرای بعدی دوباره تلاش می‌کند. کدهای موجود بازنویسی نمی‌شوند.
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        rows = [(code, self._kind(entry), json.dumps(entry, ensure_ascii=False)) for code, entry in data.items()]
+        with self._wlock:
+            self._wconn.execute("BEGIN")
+            try:
+                self._wconn.executemany("INSERT OR IGNORE INTO content (code, kind, data) VALUES (?, ?, ?)", rows)
+                self._wconn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                    (self._import_key(path), str(len(rows))))
+                self._wconn.execute("COMMIT")
+            except Exception:
+                self._wconn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+content_store = persistence.register(ContentStore(VIDEO_SQLITE_FILE, writer=persistence))
+
+def migrate_videos_json():
+    """انتقال videos.json قدیمی به SQLite (فقط یک بار)
+
+    وجود videos.db نشانه‌ی انتقال نیست (open آن را قبل از ورود می‌سازد)؛
+    نشانه‌ی ورود داخل خود دیتابیس است.
+    """
+    if not os.path.exists(VIDEO_DB_FILE):
+        return
+    try:
+        content_store.open()
+        if content_store.imported(VIDEO_DB_FILE):
+            return
+        count = content_store.import_json(VIDEO_DB_FILE)
+        logging.warning(f"🎬 {count} کد از {VIDEO_DB_FILE} منتقل شد")
+    except Exception as e:
+        logging.error(f"خطا در انتقال ویدیوها: {e}")
+
+def load_videos():
+    """دسترسی به جدول محتوا بدون کپی کردن کل کاتالوگ"""
+    content_store.open()
+    return content_store
+
+def save_videos(data):
+    """درج/به‌روزرسانی کدها (نوشتن روی دیسک در پس‌زمینه)"""
+    try:
+        store = load_videos()
+        for code, entry in data.items():
+            store.put(code, entry)
+    except Exception as e:
+        logging.error(f"خطا در ذخیره ویدیوها: {e}")
+
+def get_video(code):
+    """خواندن یک کد"""
+    try:
+        return load_videos().get(code)
+    except Exception as e:
+        logging.error(f"خطا در لود ویدیو {code}: {e}")
+        return None
+
+def put_video(code, entry):
+    """ذخیره یک کد بدون بازنویسی بقیه"""
+    save_videos({code: entry})
+
+# ===== رجیستری کاربران (آرایه مرتب + لاگ append-only) =====
+class UserRegistry:
+    """نگهداری شناسه کاربران با تست عضویت سریع و ذخیره‌سازی افزایشی
+
+    شناسه‌های قدیمی در یک آرایه مرتب int64 (فایل snapshot) و شناسه‌های جدید
+    در یک set نگه داشته می‌شوند. هر کاربر جدید فقط یک خط به فایل لاگ اضافه
+    می‌کند و وقتی تعداد افزوده‌ها از آستانه گذشت، لاگ در snapshot ادغام می‌شود.
+    حذف کاربر در لاگ با شناسه‌ی منفی ثبت می‌شود (شناسه کاربران تلگرام مثبت است).
+    """
+
+    def __init__(self, snapshot_path, log_path, compact_threshold=USERS_COMPACT_THRESHOLD, writer=None):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.compact_threshold = compact_threshold
+        self.writer = writer
+        self._base = array("q")
+        self._recent = set()
+        self._unflushed = []
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self.loaded = False
+
+    def load(self):
+        """خواندن snapshot و اعمال لاگ روی آن
+
+        خواندن بیرون از قفل انجام می‌شود تا لود در پس‌زمینه (FAST_START)
+        افزودن کاربر در event loop را معطل نکند؛ کاربرانی که در این فاصله
+        اضافه شده‌اند هنگام جایگزینی حفظ می‌شوند.
+        """
+        base = array("q")
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                base.frombytes(f.read())
+        recent, removed = set(), set()
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        uid = int(line)
+                    except ValueError:
+                        # خط ناقص ناشی از قطع ناگهانی
+                        continue
+                    if uid < 0:
+                        if -uid in recent:
+                            recent.discard(-uid)
+                        elif self._in_base(-uid, base):
+                            removed.add(-uid)
+                    elif uid in removed:
+                        removed.discard(uid)
+                    elif not self._in_base(uid, base):
+                        recent.add(uid)
+        if removed:
+            base = array("q", (uid for uid in base if uid not in removed))
+        with self._lock:
+            recent.update(uid for uid in self._recent if not self._in_base(uid, base))
+            self._base = base
+            self._recent = recent
+            self.loaded = True
+        if len(self._recent) >= self.compact_threshold:
+            self.compact()
+
+    def _in_base(self, user_id, base=None):
+        base = self._base if base is None else base
+        i = bisect.bisect_left(base, user_id)
+        return i < len(base) and base[i] == user_id
+
+    def __contains__(self, user_id):
+        return user_id in self._recent or self._in_base(user_id)
+
+    def __len__(self):
+        return len(self._base) + len(self._recent)
+
+    def __iter__(self):
+        yield from self._base
+        yield from sorted(self._recent)
+
+    def iter_from(self, after, limit):
+        """حداکثر limit شناسه‌ی مرتب بزرگ‌تر از after (برای پیمایش تکه‌تکه)"""
+        with self._lock:
+            i = bisect.bisect_right(self._base, after)
+            chunk = list(self._base[i:i + limit])
+            chunk.extend(uid for uid in self._recent if uid > after)
+        chunk.sort()
+        return chunk[:limit]
+
+    def count_after(self, after):
+        with self._lock:
+            return len(self._base) - bisect.bisect_right(self._base, after) + \
+                sum(1 for uid in self._recent if uid > after)
+
+    def _discard_locked(self, user_id):
+        if user_id in self._recent:
+            self._recent.discard(user_id)
+            return True
+        i = bisect.bisect_left(self._base, user_id)
+        if i < len(self._base) and self._base[i] == user_id:
+            del self._base[i]
+            return True
+        return False
+
+    def remove(self, user_id):
+        """حذف کاربر (مثلاً کاربری که ربات را بلاک کرده)"""
+        with self._lock:
+            if not self._discard_locked(user_id):
+                return False
+            self._unflushed.append(-user_id)
+        if self.writer is not None:
+            self.writer.mark_dirty()
+        else:
+            self.flush()
+        return True
+
+    def add(self, user_id):
+        """افزودن کاربر؛ True اگر کاربر جدید بود"""
+        with self._lock:
+            if user_id in self:
+                return False
+            self._recent.add(user_id)
+            self._unflushed.append(user_id)
+        if self.writer is not None:
+            self.writer.mark_dirty()
+        else:
+            self.flush()
+        return True
+
+    def pending_count(self):
+        return len(self._unflushed)
+
+    def flush(self):
+        """اضافه کردن شناسه‌های جدید به لاگ و در صورت نیاز فشرده‌سازی"""
+        with self._io_lock:
+            with self._lock:
+                batch, self._unflushed = self._unflushed, []
+            if batch:
+                try:
+                    with open(self.log_path, "a", encoding="utf-8") as f:
+                        f.write("".join(f"{uid}\n" for uid in batch))
+                except Exception:
+                    with self._lock:
+                        self._unflushed[:0] = batch
+                    raise
+            # قبل از لود، حافظه فقط کاربران تازه را دارد و snapshot نباید با آن بازنویسی شود
+            if self.loaded and len(self._recent) >= self.compact_threshold:
+                self._compact_locked()
+
+    def compact(self):
+        """ادغام افزوده‌ها در snapshot و خالی کردن لاگ"""
+        with self._io_lock:
+            self._compact_locked()
+
+    def _compact_locked(self):
+        with self._lock:
+            base = array("q", self._base)
+            recent = set(self._recent)
+            # شناسه‌هایی که هنوز به لاگ نرسیده‌اند بعد از کوتاه شدن لاگ نوشته می‌شوند
+            recent.difference_update(self._unflushed)
+        merged = array("q", sorted(set(base).union(recent)))
+        _atomic_write(self.snapshot_path, merged.tobytes())
+        # ترتیب مهم است: اول snapshot، بعد لاگ؛ تکرار شناسه‌ها هنگام load حذف می‌شود
+        open(self.log_path, "w").close()
+        with self._lock:
+            self._base = merged
+            self._recent.difference_update(recent)
+            # تغییراتی که حین فشرده‌سازی رخ داده‌اند به ترتیب دوباره اعمال می‌شوند
+            for uid in self._unflushed:
+                if uid < 0:
+                    self._discard_locked(-uid)
+                elif uid not in self:
+                    self._recent.add(uid)
+
+    def import_json(self, path):
+        """ورود یک‌باره‌ی لیست کاربران از users.json قدیمی"""
+        with open(path, "r", encoding="utf-8") as f:
+            ids = json.load(f)
+        with self._lock:
+            for uid in ids:
+                try:
+                    uid = int(uid)
+                except (ValueError, TypeError):
+                    continue
+                if not self._in_base(uid):
+                    self._recent.add(uid)
+        self.compact()
+        return len(self)
+
+class SQLiteUserRegistry:
+    """رجیستری کاربران روی جدول users در state.db برای حالت چند worker
+
+    رابطش همان UserRegistry است؛ درج‌ها و حذف‌ها به صورت دسته‌ای در flush
+    (INSERT OR IGNORE / DELETE) نوشته می‌شوند و همه‌ی workerها یک جدول را می‌بینند.
+    flush روی اتصال پس‌زمینه‌ی backend اجرا می‌شود و کاربرانی که یک بار پیدا
+    شده‌اند تا USERS_KNOWN_TTL بدون کوئری شناخته می‌شوند (هر /start یک add است).
+    """
+
+    def __init__(self, backend, writer=None):
+        self.backend = backend
+        self.writer = writer
+        self._unflushed = []
+        self._pending_ids = set()
+        self._known = StateNamespace("users_known", USERS_KNOWN_TTL, USERS_KNOWN_MAX)
+        self.loaded = False
+
+    def load(self):
+        self.backend.conn
+        self.loaded = True
+
+    def _query(self, sql, params=()):
+        with self.backend.lock:
+            return self.backend.conn.execute(sql, params).fetchall()
+
+    def __contains__(self, user_id):
+        if user_id in self._pending_ids or user_id in self._known:
+            return True
+        found = bool(self._query("SELECT 1 FROM users WHERE id = ?", (user_id,)))
+        if found:
+            self._known[user_id] = True
+        return found
+
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM users")[0][0] + len(self._pending_ids)
+
+    def __iter__(self):
+        after = 0
+        while True:
+            chunk = self.iter_from(after, 1000)
+            if not chunk:
+                return
+            yield from chunk
+            after = chunk[-1]
+
+    def iter_from(self, after, limit):
+        return [row[0] for row in self._query("SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?", (after, limit))]
+
+    def count_after(self, after):
+        return self._query("SELECT COUNT(*) FROM users WHERE id > ?", (after,))[0][0]
+
+    def _queue(self, op):
+        self._unflushed.append(op)
+        if self.writer is not None:
+            self.writer.mark_dirty()
+        else:
+            self.flush()
+
+    def add(self, user_id):
+        if user_id in self:
+            return False
+        self._pending_ids.add(user_id)
+        self._queue(user_id)
+        return True
+
+    def remove(self, user_id):
+        self._pending_ids.discard(user_id)
+        self._known.pop(user_id, None)
+        self._queue(-user_id)
+        return True
+
+    def pending_count(self):
+        return len(self._unflushed)
+
+    def flush(self):
+        batch, self._unflushed = self._unflushed, []
+        if not batch:
+            return
+        try:
+            with self.backend.transaction(background=True) as conn:
+                for op in batch:
+                    if op < 0:
+                        conn.execute("DELETE FROM users WHERE id = ?", (-op,))
+                    else:
+                        conn.execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (op,))
+        except Exception:
+            self._unflushed[:0] = batch
+            raise
+        self._pending_ids.difference_update(op for op in batch if op > 0)
+
+    def compact(self):
+        pass
+
+    def import_ids(self, ids):
+        with self.backend.transaction(background=True) as conn:
+            conn.executemany("INSERT OR IGNORE INTO users (id) VALUES (?)", ((int(uid),) for uid in ids))
+        return len(self)
+
+    def import_json(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return self.import_ids(json.load(f))
+
+def migrate_users_json():
+    """انتقال users.json قدیمی به رجیستری جدید (فقط یک بار)"""
+    user_registry = default_tenant.users
+    try:
+        if SHARED_STATE:
+            user_registry.load()
+            if len(user_registry):
+                return
+            if os.path.exists(USERS_SNAPSHOT_FILE):
+                # رجیستری فایلی حالت تک‌پروسه به جدول مشترک منتقل می‌شود
+                legacy = UserRegistry(USERS_SNAPSHOT_FILE, USERS_LOG_FILE)
+                legacy.load()
+                count = user_registry.import_ids(legacy)
+            elif os.path.exists(USERS_FILE):
+                count = user_registry.import_json(USERS_FILE)
+            else:
+                return
+        else:
+            if os.path.exists(USERS_SNAPSHOT_FILE) or not os.path.exists(USERS_FILE):
+                return
+            count = user_registry.import_json(USERS_FILE)
+        logging.warning(f"👥 {count} کاربر به رجیستری منتقل شد")
+    except Exception as e:
+        logging.error(f"خطا در انتقال کاربران: {e}")
+
+def load_users(tenant=None):
+    """رجیستری کاربران ربات جاری (لود در اولین استفاده)
+
+    در FAST_START لود در پس‌زمینه انجام می‌شود (_warm_caches) و تا آن موقع
+    رجیستری فقط کاربران تازه را دارد؛ کارهایی که کل لیست را لازم دارند
+    باید loaded را چک کنند.
+    """
+    registry = (tenant or current_tenant()).users
+    if not registry.loaded and not FAST_START:
+        _load_registry(registry)
+    return registry
+
+def _load_registry(registry):
+    try:
+        registry.load()
+    except Exception as e:
+        logging.error(f"خطا در لود کاربران: {e}")
+
+def generate_code(length=6):
+    """کد کوتاه‌تر برای صرفه‌جویی"""
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+
+def add_user(user_id):
+    """افزودن کاربر با بهینه‌سازی"""
+    try:
+        load_users().add(user_id)
+    except Exception as e:
+        logging.error(f"خطا در ذخیره کاربر {user_id}: {e}")
+
+# ===== بررسی عضویت بهینه‌شده =====
+class MembershipCache:
+    """کش نتیجه‌ی get_chat_member با TTL جدا برای عضو/غیرعضو
+
+    درخواست‌های هم‌زمان برای یک (chat_id, user_id) به یک فراخوانی API
+    تبدیل می‌شوند. خطاها کش نمی‌شوند تا قطعی شبکه کاربر را قفل نکند.
+    """
+
+    def __init__(self, positive_ttl=MEMBER_CACHE_POSITIVE_TTL, negative_ttl=MEMBER_CACHE_NEGATIVE_TTL,
+                 max_size=MEMBER_CACHE_MAX_SIZE):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = {}
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def _key(chat_id, user_id):
+        return (str(chat_id), user_id)
+
+    def peek(self, chat_id, user_id):
+        """مقدار معتبر کش یا None"""
+        entry = self._entries.get(self._key(chat_id, user_id))
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires <= time.monotonic():
+            self._entries.pop(self._key(chat_id, user_id), None)
+            return None
+        return value
+
+    def set(self, chat_id, user_id, value):
+        ttl = self.positive_ttl if value else self.negative_ttl
+        if len(self._entries) >= self.max_size:
+            self._evict()
+        self._entries[self._key(chat_id, user_id)] = (value, time.monotonic() + ttl)
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [k for k, (_, exp) in self._entries.items() if exp <= now]:
+            del self._entries[key]
+        # اگر هنوز پر است، قدیمی‌ترین درج‌ها حذف می‌شوند
+        while len(self._entries) >= self.max_size:
+            self._entries.pop(next(iter(self._entries)))
+
+    def invalidate(self, chat_id=None, user_id=None):
+        """حذف ورودی‌ها؛ بدون آرگومان کل کش پاک می‌شود"""
+        if chat_id is None and user_id is None:
+            self._entries.clear()
+            return
+        if chat_id is not None and user_id is not None:
+            self._entries.pop(self._key(chat_id, user_id), None)
+            return
+        for key in list(self._entries):
+            if (chat_id is None or key[0] == str(chat_id)) and (user_id is None or key[1] == user_id):
+                del self._entries[key]
+
+    async def get_or_fetch(self, chat_id, user_id, fetch):
+        value = self.peek(chat_id, user_id)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        key = self._key(chat_id, user_id)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        self.misses += 1
+        task = asyncio.ensure_future(fetch())
+        self._inflight[key] = task
+        try:
+            value = await asyncio.shield(task)
+        finally:
+            if task.done():
+                self._inflight.pop(key, None)
+            else:
+                task.add_done_callback(lambda _t: self._inflight.pop(key, None))
+        self.set(chat_id, user_id, value)
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "size": len(self._entries),
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0
+        }
+
+membership_cache = MembershipCache()
+
+class MembershipIndex:
+    """ایندکس محلی اعضای کانال‌ها که با آپدیت‌های chat_member به‌روز می‌ماند
+
+    فقط عضو بودن از ایندکس جواب داده می‌شود؛ برای کاربران ناشناخته یا
+    غیرعضو همچنان get_chat_member (از طریق کش) صدا زده می‌شود تا اگر
+    رویداد عضویتی از دست رفته باشد کاربر پشت دکمه‌ی بررسی گیر نکند.
+    برای هر عضو زمان آخرین تأیید نگه داشته می‌شود و بعد از MEMBER_INDEX_TTL
+    ناشناخته حساب می‌شود، چون رویداد left زمان خاموشی ربات دوباره نمی‌رسد.
+    ذخیره‌سازی مثل رجیستری کاربران است: snapshot + لاگ append-only.
+    """
+
+    def __init__(self, snapshot_path, log_path, compact_threshold=MEMBER_INDEX_COMPACT_THRESHOLD, writer=None,
+                 ttl=MEMBER_INDEX_TTL):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.compact_threshold = compact_threshold
+        self.ttl = ttl
+        self.writer = writer
+        self._members = {}
+        self._aliases = {}
+        self._unflushed = []
+        self._log_lines = 0
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self.loaded = False
+
+    def _resolve(self, chat_id):
+        key = str(chat_id).lower()
+        return self._aliases.get(key, key)
+
+    def lookup(self, chat_id, user_id):
+        """True اگر کاربر عضو شناخته‌شده است، وگرنه None"""
+        if not self.loaded:
+            metrics.inc("bot_membership_index_total", result="cold")
+            return None
+        members = self._members.get(self._resolve(chat_id))
+        confirmed = members.get(user_id) if members is not None else None
+        if confirmed is None:
+            metrics.inc("bot_membership_index_total", result="miss")
+            return None
+        if time.time() - confirmed >= self.ttl:
+            metrics.inc("bot_membership_index_total", result="stale")
+            return None
+        metrics.inc("bot_membership_index_total", result="hit")
+        return True
+
+    def _apply(self, members, aliases, op, chat, value, confirmed=0.0):
+        if op == "=":
+            aliases[chat] = value
+            # اعضایی که قبلاً با @username ثبت شده‌اند به شناسه عددی منتقل می‌شوند
+            moved = members.pop(chat, None)
+            if moved:
+                members.setdefault(value, {}).update(moved)
+            return
+        chat = aliases.get(chat, chat)
+        if op == "+":
+            # خطوط قدیمی لاگ زمان ندارند و منقضی حساب می‌شوند
+            members.setdefault(chat, {})[int(value)] = float(confirmed)
+        elif op == "-":
+            bucket = members.get(chat)
+            if bucket is not None:
+                bucket.pop(int(value), None)
+
+    def _record(self, op, chat, value, *extra):
+        with self._lock:
+            self._apply(self._members, self._aliases, op, chat, value, *extra)
+            if self.snapshot_path is None:
+                return
+            self._unflushed.append((op, chat, str(value), *map(str, extra)))
+        if self.writer is not None:
+            self.writer.mark_dirty()
+
+    def observe_chat(self, chat_id, username):
+        """ثبت نام کاربری کانال تا @username و شناسه عددی یکی شوند"""
+        if not username:
+            return
+        alias = f"@{username}".lower()
+        if self._aliases.get(alias) != str(chat_id):
+            self._record("=", alias, str(chat_id))
+
+    def record(self, chat_id, user_id, is_member):
+        chat = self._resolve(chat_id)
+        bucket = self._members.get(chat)
+        now = time.time()
+        if is_member and (bucket is None or now - bucket.get(user_id, 0.0) >= self.ttl / 2):
+            # تأیید تازه فقط وقتی نوشته می‌شود که نیمی از TTL گذشته باشد
+            self._record("+", chat, user_id, round(now, 1))
+        elif not is_member and bucket is not None and user_id in bucket:
+            self._record("-", chat, user_id)
+
+    def load(self):
+        """خواندن snapshot و لاگ؛ تغییرات ثبت‌شده قبل از لود حفظ می‌شوند"""
+        if self.snapshot_path is None:
+            self.loaded = True
+            return
+        members, aliases, lines = {}, {}, 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            aliases.update(data.get("aliases", {}))
+            for chat, ids in data.get("members", {}).items():
+                # snapshot قدیمی فقط فهرست شناسه‌ها بود؛ آن اعضا منقضی حساب می‌شوند
+                members[chat] = {int(uid): float(ts) for uid, ts in ids.items()} if isinstance(ids, dict) \
+                    else dict.fromkeys(ids, 0.0)
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) not in (3, 4):
+                        continue
+                    try:
+                        self._apply(members, aliases, *parts)
+                    except ValueError:
+                        continue
+                    lines += 1
+        with self._lock:
+            for entry in self._unflushed:
+                self._apply(members, aliases, *entry)
+            self._members, self._aliases = members, aliases
+            self._log_lines = lines
+            self.loaded = True
+
+    def pending_count(self):
+        return len(self._unflushed) if self.loaded else 0
+
+    def flush(self):
+        if not self.loaded:
+            return
+        with self._io_lock:
+            with self._lock:
+                batch, self._unflushed = self._unflushed, []
+            if batch:
+                try:
+                    with open(self.log_path, "a", encoding="utf-8") as f:
+                        f.write("".join("\t".join(entry) + "\n" for entry in batch))
+                except Exception:
+                    with self._lock:
+                        self._unflushed[:0] = batch
+                    raise
+                self._log_lines += len(batch)
+            if self._log_lines >= self.compact_threshold:
+                self._compact_locked()
+
+    def _compact_locked(self):
+        with self._lock:
+            # تغییرات flush‌نشده هم در snapshot می‌آیند؛ تکرارشان در لاگ بی‌اثر است
+            members = {chat: {str(uid): ts for uid, ts in sorted(ids.items())} for chat, ids in self._members.items()}
+            aliases = dict(self._aliases)
+        _atomic_write_json(self.snapshot_path, {
+            "aliases": aliases,
+            "members": members
+        })
+        open(self.log_path, "w").close()
+        self._log_lines = 0
+
+    def stats(self):
+        return {chat: len(ids) for chat, ids in self._members.items()}
+
+if SHARED_STATE:
+    # با چند worker هر پروسه ایندکس خودش را فقط در حافظه نگه می‌دارد؛
+    # فایل‌های مشترک با فشرده‌سازی‌های هم‌زمان خراب می‌شدند
+    membership_index = MembershipIndex(None, None)
+else:
+    membership_index = persistence.register(
+        MembershipIndex(MEMBER_INDEX_SNAPSHOT_FILE, MEMBER_INDEX_LOG_FILE, writer=persistence)
+    )
+
+async def is_member(chat_id, user_id, context):
+    """بررسی عضویت: اول ایندکس محلی، بعد کش و در نهایت API"""
+    if membership_index.lookup(chat_id, user_id):
+        return True
+
+    async def fetch():
+        member = await context.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+        return member.status in ["member", "administrator", "creator"]
+
+    try:
+        result = await membership_cache.get_or_fetch(chat_id, user_id, fetch)
+    except Exception as e:
+        logging.warning(f"خطا در بررسی عضویت {user_id}: {e}")
+        return False
+    if result:
+        membership_index.record(chat_id, user_id, True)
+    return result
+
+def _is_tracked_channel(chat):
+    tenant = current_tenant()
+    usernames = {(tenant.channel_username or "").lower(), (tenant.second_channel_username or "").lower()} - {""}
+    return str(chat.id) == str(tenant.channel_id) or (chat.username or "").lower() in usernames \
+        or f"@{chat.username}".lower() == str(tenant.channel_id).lower()
+
+async def handle_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """به‌روزرسانی ایندکس عضویت از رویدادهای join/leave کانال‌ها"""
+    change = update.chat_member
+    if not change or not _is_tracked_channel(change.chat):
+        return
+    new = change.new_chat_member
+    joined = new.status in ["member", "administrator", "creator"] or \
+        (new.status == "restricted" and getattr(new, "is_member", False))
+    membership_index.observe_chat(change.chat.id, change.chat.username)
+    membership_index.record(change.chat.id, new.user.id, joined)
+    membership_cache.invalidate(user_id=new.user.id)
+
+# ===== هماهنگی درخواست‌های هر کاربر =====
+class UserGate:
+    """single-flight، debounce و اجرای ترتیبی هندلرها برای هر کاربر
+
+    با concurrent_updates هر ضربه‌ی کاربر موازی اجرا می‌شود. درخواست تکراری
+    (همان کاربر و همان کلید) تا وقتی اولی در جریان است و تا USER_DEBOUNCE_SECONDS
+    بعد از آن دور ریخته می‌شود، چون نتیجه‌ی اولی به کاربر می‌رسد. درخواست‌های
+    متفاوت یک کاربر با یک قفل پشت سر هم اجرا می‌شوند تا وضعیتش را هم‌زمان تغییر ندهند.
+    اگر هندلر خطا داد یا RETRYABLE برگرداند (مثلاً پیام عضویت یا خطای ارسال) debounce
+    ثبت نمی‌شود تا تکرار فوری کاربر اجرا شود. به پیام‌های دورریخته یک بار (در هر
+    پنجره‌ی debounce) جواب کوتاه داده می‌شود.
+    """
+
+    RETRYABLE = object()
+
+    def __init__(self, debounce=USER_DEBOUNCE_SECONDS, max_entries=USER_GATE_MAX_ENTRIES):
+        self._inflight = set()
+        self._recent = StateNamespace("user_gate", ttl=debounce, max_entries=max_entries)
+        self._notified = StateNamespace("user_gate_notified", ttl=debounce, max_entries=max_entries)
+        self._locks = {}
+        self.passed = 0
+        self.collapsed = 0
+        self.debounced = 0
+
+    @contextmanager
+    def _claim(self, user_id):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    def guard(self, key_fn):
+        """دکوریتور هندلر؛ key_fn(update, context) درخواست‌های یکسان را مشخص می‌کند"""
+        def decorator(callback):
+            @functools.wraps(callback)
+            async def wrapper(update, context):
+                user = update.effective_user
+                if user is None:
+                    return await callback(update, context)
+                key = (callback.__name__, context.bot.id, user.id, key_fn(update, context))
+                if key in self._inflight or key in self._recent:
+                    result = "collapsed" if key in self._inflight else "debounced"
+                    setattr(self, result, getattr(self, result) + 1)
+                    metrics.inc("bot_user_gate_total", result=result)
+                    await self._notify(update, context, key, result)
+                    return
+                self.passed += 1
+                metrics.inc("bot_user_gate_total", result="passed")
+                self._inflight.add(key)
+                outcome = self.RETRYABLE
+                try:
+                    with self._claim(user.id) as lock:
+                        async with lock:
+                            outcome = await callback(update, context)
+                            return outcome
+                finally:
+                    self._inflight.discard(key)
+                    if outcome is not self.RETRYABLE:
+                        self._recent[key] = True
+            return wrapper
+        return decorator
+
+    async def _notify(self, update, context, key, result):
+        # shortcutهای Message در PTB 20 پارامتر rate_limit_args ندارند؛ مستقیم از bot
+        try:
+            if update.callback_query:
+                await context.bot.answer_callback_query(update.callback_query.id, text=USER_GATE_CHECKING_TEXT,
+                                                        rate_limit_args=PRIORITY_INTERACTIVE)
+            elif update.effective_chat and key not in self._notified:
+                text = USER_GATE_INFLIGHT_TEXT if result == "collapsed" else USER_GATE_DEBOUNCED_TEXT
+                # تا ارسال تمام نشده تکرارهای بعدی پیام دوم نگیرند؛ اگر شکست، علامت برداشته می‌شود
+                self._notified[key] = False
+                await context.bot.send_message(chat_id=update.effective_chat.id, text=text,
+                                               rate_limit_args=PRIORITY_INTERACTIVE)
+                self._notified[key] = True
+        except Exception as e:
+            self._notified.pop(key, None)
+            logging.warning(f"خطا در ارسال پیام تکراری‌بودن درخواست: {e}")
+
+    def stats(self):
+        return {
+            "passed": self.passed,
+            "collapsed": self.collapsed,
+            "debounced": self.debounced,
+            "in_flight": len(self._inflight),
+            "users_locked": len(self._locks)
+        }
+
+user_gate = UserGate()
+
+# ===== پنل ادمین بهینه‌شده =====
+async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = current_tenant()
+    activity_monitor.record_activity()
+    if update.effective_user.id != tenant.admin_id:
+        await update.message.reply_text("❌ فقط ادمین دسترسی دارد.")
+        return
+
+    keyboard = [
+        [InlineKeyboardButton("📤 آپلود ویدیو", callback_data="upload_video"),
+         InlineKeyboardButton("📦 آپلود پکیج", callback_data="upload_package")],
+        [InlineKeyboardButton("💳 پکیج پولی", callback_data="upload_paid_package"),
+         InlineKeyboardButton("🗂 آلبوم‌ها ← پکیج", callback_data="upload_bulk")],
+        [InlineKeyboardButton(f"🧾 فیش‌ها ({tenant.receipts.depth()})", callback_data="rcpt_page_0")]
+    ]
+    await update.message.reply_text("پنل مدیریت:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def handle_admin_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = current_tenant()
+    activity_monitor.record_activity()
+    query = update.callback_query
+    await query.answer()
+
+    if query.from_user.id != tenant.admin_id:
+        await query.edit_message_text("❌ فقط ادمین دسترسی دارد.")
+        return
+
+    user_id = query.from_user.id
+    data = query.data or ""
+
+    if data == "upload_video":
+        tenant.user_state[user_id] = "uploading"
+        await query.edit_message_text("🎬 لطفاً ویدیو رو ارسال کن شومبول طلا.\n(آلبوم یا چند ویدیو با هم = برای هر ویدیو یک لینک)")
+
+    elif data == "upload_package":
+        tenant.user_state[user_id] = "uploading_package"
+        tenant.admin_temp_packages[user_id] = []
+        keyboard = [
+            [InlineKeyboardButton("✅ پایان و ثبت پکیج", callback_data="finish_package"),
+             InlineKeyboardButton("❌ لغو", callback_data="cancel_upload")]
+        ]
+        await query.edit_message_text(
+            f"📦 اکنون ویدیوها را تکی، آلبومی یا فوروارد دسته‌ای ارسال کن (حداکثر {MAX_PACKAGE_SIZE}). پس از اتمام 'پایان و ثبت پکیج' را بزن.",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+    elif data == "upload_paid_package":
+        tenant.user_state[user_id] = "uploading_paid_package"
+        tenant.admin_temp_packages[user_id] = []
+        keyboard = [
+            [InlineKeyboardButton("✅ پایان و ثبت پکیج پولی", callback_data="finish_paid_package"),
+             InlineKeyboardButton("❌ لغو", callback_data="cancel_upload")]
+        ]
+        await query.edit_message_text(
+            f"💳 حالا ویدیوهای پکیج ویژه رو تکی یا آلبومی بفرست (حداکثر {MAX_PACKAGE_SIZE}). بعد 'پایان و ثبت پکیج پولی' رو بزن.",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+    elif data == "upload_bulk":
+        tenant.user_state[user_id] = "uploading_bulk"
+        keyboard = [[InlineKeyboardButton("✅ پایان", callback_data="finish_bulk")]]
+        await query.edit_message_text(
+            "🗂 آلبوم‌ها را بفرست یا فوروارد کن؛ هر آلبوم یک پکیج می‌شود و ویدیوهای تکیِ پشت‌سرهم هم یک پکیج.\n"
+            "بعد از هر دسته لینک‌ها یکجا ارسال می‌شوند.",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+    elif data == "finish_bulk":
+        await admin_ingest.flush(context.bot, user_id, query.message.chat.id, _ingest_batch)
+        tenant.user_state.pop(user_id, None)
+        await query.edit_message_text("✅ آپلود دسته‌ای تمام شد.")
+
+    elif data == "finish_package":
+        await admin_ingest.flush(context.bot, user_id, query.message.chat.id, _ingest_batch)
+        temp = tenant.admin_temp_packages.get(user_id, [])
+        if not temp:
+            await query.edit_message_text("⚠️ هیچ ویدیویی برای ثبت وجود ندارد.")
+            return
+
+        code = generate_code()
+        put_video(code, {"type": "package", "files": temp.copy()})
+        link = f"https://t.me/{context.bot.username}?start={code}"
+        tenant.user_state.pop(user_id, None)
+        tenant.admin_temp_packages.pop(user_id, None)
+        await query.edit_message_text(f"✅ پکیج ذخیره شد! ({len(temp)} ویدیو)\n🔗 لینک: {link}")
+
+    elif data == "finish_paid_package":
+        await admin_ingest.flush(context.bot, user_id, query.message.chat.id, _ingest_batch)
+        temp = tenant.admin_temp_packages.get(user_id, [])
+        if not temp:
+            await query.edit_message_text("⚠️ هیچ ویدیویی برای ثبت وجود ندارد.")
+            return
+
+        code = generate_code()
+        put_video(code, {
+            "type": "paid",
+            "files": temp.copy(),
+            "price": 99000,
+            "card": "6037991775906427",
+            "currency": "IRR"
+        })
+        link = f"https://t.me/{context.bot.username}?start={code}"
+        tenant.user_state.pop(user_id, None)
+        tenant.admin_temp_packages.pop(user_id, None)
+        await query.edit_message_text(f"✅ پکیج پولی ذخیره شد! ({len(temp)} ویدیو)\n🔗 لینک: {link}\nقیمت: ۹۹٬۰۰۰ تومان\nکارت: 6037991775906427")
+
+    elif data == "cancel_upload":
+        await admin_ingest.flush(context.bot, user_id, query.message.chat.id, _ingest_batch)
+        tenant.user_state.pop(user_id, None)
+        tenant.admin_temp_packages.pop(user_id, None)
+        await query.edit_message_text("❌ آپلود کنسل شد.")
+
+# ===== دریافت ویدیو از ادمین با بهینه‌سازی =====
+# پکیج‌ها در آلبوم‌های ۱۰تایی ارسال می‌شوند، پس سقف فقط برای کنترل حجم است
+MAX_PACKAGE_SIZE = 50
+MEDIA_GROUP_SIZE = 10
+# آلبوم‌ها و فورواردهای دسته‌ای به صورت چند آپدیت پشت‌سرهم می‌رسند
+INGEST_QUIET_WINDOW = 1.5
+MAX_MESSAGE_LENGTH = 4000
+
+class AdminIngest:
+    """جمع‌کردن ویدیوهای پشت‌سرهم ادمین و پردازش یکجای آن‌ها
+
+    هر ویدیو به دسته‌ی همان ادمین (در همان ربات) اضافه می‌شود و تا INGEST_QUIET_WINDOW ثانیه
+    بعد از آخرین ویدیو صبر می‌شود؛ سپس کل دسته (با media_group_id هر ویدیو)
+    یک‌جا به on_flush داده می‌شود.
+
+    دسته در namespace «admin_ingest» وضعیت همان ربات است، نه حافظه‌ی پروسه؛ با
+    STATE_BACKEND=sqlite تکه‌های یک آلبوم که به workerهای مختلف رسیده‌اند یک دسته
+    می‌شوند. هر worker که ویدیویی دیده یک تایمر دارد که پنجره‌ی سکوت را از زمان
+    آخرین ویدیوی دسته‌ی مشترک حساب می‌کند و دسته را با pop اتمیک برمی‌دارد،
+    پس فقط یکی از workerها آن را پردازش می‌کند.
+    """
+
+    def __init__(self, window=INGEST_QUIET_WINDOW):
+        self.window = window
+        self._timers = {}
+
+    def add(self, user_id, chat_id, bot, media_group_id, file_id, on_flush):
+        # یک ادمین ممکن است ادمین چند ربات باشد؛ دسته‌ها از هم جدا می‌مانند
+        current_tenant().admin_ingest.extend(user_id, [[media_group_id, file_id, time.time()]])
+        key = (bot.id, user_id)
+        timer = self._timers.get(key)
+        if timer is None or timer["taken"]:
+            timer = self._timers[key] = {"chat_id": chat_id, "bot": bot, "wakeup": asyncio.Event(),
+                                         "force": False, "taken": False}
+            timer["task"] = asyncio.get_running_loop().create_task(self._flush_later(key, timer, on_flush))
+
+    async def _flush_later(self, key, timer, on_flush):
+        batches = current_tenant().admin_ingest
+        try:
+            while True:
+                items = batches.get(key[1])
+                if not items:
+                    # worker دیگری (یا flush) دسته را برداشته
+                    return
+                delay = max(item[2] for item in items) + self.window - time.time()
+                if delay > 0 and not timer["force"]:
+                    try:
+                        await asyncio.wait_for(timer["wakeup"].wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    timer["wakeup"].clear()
+                    continue
+                # بین علامت زدن و pop هیچ await نیست؛ ویدیوی بعدی تایمر تازه می‌سازد
+                timer["taken"] = True
+                try:
+                    items = batches.pop(key[1], None)
+                except StateBusyError:
+                    timer["taken"] = False
+                    await asyncio.sleep(self.window)
+                    continue
+                break
+            if items:
+                await self._process(timer["bot"], timer["chat_id"], key[1], items, on_flush)
+        finally:
+            if self._timers.get(key) is timer:
+                del self._timers[key]
+
+    @staticmethod
+    async def _process(bot, chat_id, user_id, items, on_flush):
+        try:
+            await on_flush(bot, chat_id, user_id, [(media_group_id, file_id) for media_group_id, file_id, _ in items])
+        except Exception as e:
+            logging.error(f"خطا در ثبت دسته‌ای ویدیوها: {e}")
+            try:
+                await bot.send_message(chat_id=chat_id, text="❌ خطا در ثبت ویدیوها. دوباره ارسال کن.")
+            except Exception:
+                pass
+
+    async def flush(self, bot, user_id, chat_id, on_flush):
+        """پردازش فوری دسته‌ی در انتظار این ادمین و صبر تا پایان آن
+
+        قبل از «پایان» یا «لغو» صدا زده می‌شود تا آلبومی که هنوز در پنجره‌ی سکوت است
+        قبل از خواندن admin_temp_packages ثبت شده باشد؛ شامل تکه‌هایی که فقط
+        worker دیگری دیده است.
+        """
+        timer = self._timers.get((bot.id, user_id))
+        if timer is not None:
+            timer["force"] = True
+            timer["wakeup"].set()
+            # لغو هندلر «پایان» نباید ثبت ویدیوها را نیمه‌کاره بگذارد
+            await asyncio.shield(timer["task"])
+        items = current_tenant().admin_ingest.pop(user_id, None)
+        if items:
+            await self._process(bot, chat_id, user_id, items, on_flush)
+
+    def pending(self):
+        return len(self._timers)
+
+admin_ingest = AdminIngest()
+
+def _new_codes(count):
+    """تولید کدهای یکتا (بدون تکرار در همین دسته و در دیتابیس)"""
+    codes = set()
+    while len(codes) < count:
+        code = generate_code()
+        if code not in codes and code not in content_store:
+            codes.add(code)
+    return list(codes)
+
+async def _store_entries(entries):
+    """ثبت همه‌ی کدهای یک دسته در یک تراکنش، بیرون از event loop"""
+    await asyncio.get_running_loop().run_in_executor(None, content_store.put_many, entries)
+
+async def _send_lines(bot, chat_id, lines):
+    """ارسال خلاصه در کمترین تعداد پیام با رعایت سقف طول پیام تلگرام"""
+    chunk = ""
+    for line in lines:
+        if chunk and len(chunk) + len(line) + 1 > MAX_MESSAGE_LENGTH:
+            await bot.send_message(chat_id=chat_id, text=chunk, disable_web_page_preview=True)
+            chunk = ""
+        chunk = f"{chunk}\n{line}" if chunk else line
+    if chunk:
+        await bot.send_message(chat_id=chat_id, text=chunk, disable_web_page_preview=True)
+
+async def _ingest_batch(bot, chat_id, user_id, items):
+    tenant = current_tenant()
+    state = tenant.user_state.get(user_id)
+    file_ids = [file_id for _, file_id in items]
+
+    if state == "uploading":
+        # هر ویدیو (حتی داخل آلبوم) یک لینک جدا
+        codes = _new_codes(len(file_ids))
+        await _store_entries(list(zip(codes, file_ids)))
+        tenant.user_state.pop(user_id, None)
+        lines = [f"✅ {len(codes)} ویدیو ذخیره شد!"]
+        lines += [f"{i}. 🔗 https://t.me/{bot.username}?start={code}" for i, code in enumerate(codes, 1)]
+        await _send_lines(bot, chat_id, lines)
+
+    elif state in ("uploading_package", "uploading_paid_package"):
+        current = len(tenant.admin_temp_packages.get(user_id) or [])
+        accepted = file_ids[:max(MAX_PACKAGE_SIZE - current, 0)]
+        tmp = tenant.admin_temp_packages.extend(user_id, accepted) if accepted else tenant.admin_temp_packages.get(user_id) or []
+        label = "ویدیوی پکیج پولی" if state == "uploading_paid_package" else "ویدیو"
+        text = f"{len(accepted)} {label} دریافت شد ({len(tmp)}/{MAX_PACKAGE_SIZE})."
+        if len(accepted) < len(file_ids):
+            text += f"\n⚠️ حداکثر {MAX_PACKAGE_SIZE} ویدیو؛ {len(file_ids) - len(accepted)} ویدیو ثبت نشد."
+        await bot.send_message(chat_id=chat_id, text=text)
+
+    elif state == "uploading_bulk":
+        # هر آلبوم یک پکیج؛ ویدیوهای بدون آلبوم (فوروارد دسته‌ای) با هم یک پکیج
+        groups = {}
+        for media_group_id, file_id in items:
+            groups.setdefault(media_group_id, []).append(file_id)
+        packages = []
+        for files in groups.values():
+            for i in range(0, len(files), MAX_PACKAGE_SIZE):
+                packages.append(files[i:i + MAX_PACKAGE_SIZE])
+        codes = _new_codes(len(packages))
+        await _store_entries([(code, {"type": "package", "files": files}) for code, files in zip(codes, packages)])
+        lines = [f"✅ {len(codes)} پکیج از {len(file_ids)} ویدیو ذخیره شد!"]
+        lines += [f"{i}. 📦 {len(files)} ویدیو: https://t.me/{bot.username}?start={code}"
+                  for i, (code, files) in enumerate(zip(codes, packages), 1)]
+        await _send_lines(bot, chat_id, lines)
+
+    else:
+        # حالت آپلود قبل از رسیدن این دسته تمام یا لغو شده؛ بی‌صدا دور ریخته نشود
+        await bot.send_message(
+            chat_id=chat_id,
+            text=f"⚠️ آپلودی در جریان نیست؛ {len(file_ids)} ویدیو ثبت نشد. دوباره از پنل ادمین شروع کن."
+        )
+
+async def handle_video_from_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = current_tenant()
+    activity_monitor.record_activity()
+    user = update.effective_user
+    if user.id != tenant.admin_id:
+        return
+
+    video = update.message.video or update.message.document
+    if not video:
+        await update.message.reply_text("فیلمتو بفرس دودول طلا😁😘.")
         return
 
-    success_count = 0
-    for fid in files:
+    if tenant.user_state.get(user.id) not in ("uploading", "uploading_package", "uploading_paid_package", "uploading_bulk"):
+        return
+    # پاسخ بعد از رسیدن کل دسته داده می‌شود، نه برای هر ویدیو
+    admin_ingest.add(user.id, update.message.chat.id, context.bot, update.message.media_group_id,
+                     video.file_id, _ingest_batch)
+
+# ===== هندل فرمان /start بهینه‌شده =====
+@user_gate.guard(lambda update, context: context.args[0] if context.args else "")
+async def start_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = current_tenant()
+    activity_monitor.record_activity()
+    user = update.effective_user
+    if not user:
+        return
+
+    add_user(user.id)
+    tenant.analytics.record_user(user.id)
+    args = context.args
+
+    if not args:
+        await update.message.reply_text("سلام عزیزم برای دریافت ویدیو ها، عضو دو کانال شو.")
+        return
+
+    code = args[0]
+    entry = get_video(code)
+
+    if entry is None:
+        await update.message.reply_text("❌ لینک نامعتبر است.")
+        return
+    tenant.analytics.record_request(code)
+
+    # اگر پکیج پولی است -> درخواست فیش از کاربر
+    if isinstance(entry, dict) and entry.get("type") == "paid":
+        receipt_id = tenant.payment_receipts.get(user.id)
+        if receipt_id is not None:
+            receipt = tenant.receipts.get(receipt_id)
+            if receipt and receipt["status"] == "pending" and receipt["code"] == code:
+                await update.message.reply_text("⏳ فیش شما در صف بررسی است؛ پس از تایید، پکیج ارسال می‌شود.")
+                return
+        card = entry.get("card", "6037991775906427")
+        price = entry.get("price", 99000)
+        tenant.pending_payments[user.id] = code
+        await update.message.reply_text(
+            f"🔒 این پکیج پولی است.\nلطفاً مبلغ {price:,} تومان را به کارت {card} واریز کنید و فیش واریزی را همین‌جا ارسال کنید.\nبلافاصله پس از تایید تراکنش توسط ادمین، پکیج ویژه در اختیار شما قرار خواهد گرفت."
+        )
+        return
+
+    # ادامه‌ی بررسی عضویت برای پکیج‌های رایگان یا ویدیوی تکی
+    user_id = user.id
+    is_in_first, is_in_second = await asyncio.gather(
+        is_member(tenant.channel_id, user_id, context),
+        is_member(f"@{tenant.second_channel_username}", user_id, context)
+    )
+
+    if not (is_in_first and is_in_second):
+        tenant.pending_users[user_id] = code
+        buttons = []
+        if not is_in_first:
+            buttons.append([InlineKeyboardButton("📢 سکسولوژی", url=f"https://t.me/{tenant.channel_username}")])
+        if not is_in_second:
+            buttons.append([InlineKeyboardButton("📢 سکسی لند", url=f"https://t.me/{tenant.second_channel_username}")])
+        buttons.append([InlineKeyboardButton("✅ بررسی عضویت", callback_data=f"check_{code}")])
+        await update.message.reply_text("🔒 لطفاً در کانال‌ها عضو شو:", reply_markup=InlineKeyboardMarkup(buttons))
+        # کاربر بعد از عضویت ممکن است فوراً دوباره /start بزند
+        return UserGate.RETRYABLE
+
+    return await _deliver_content(update, context, code, entry)
+
+async def _deliver_content(update: Update, context: ContextTypes.DEFAULT_TYPE, code: str, entry=None):
+    """تحویل محتوا با مدیریت خطا"""
+    tenant = current_tenant()
+    if entry is None:
+        entry = get_video(code)
+    if not entry:
+        await update.message.reply_text("❌ محتوای مورد نظر یافت نشد.")
+        return
+
+    try:
+        if isinstance(entry, dict) and entry.get("type") == "package":
+            delivered = await send_package(update, context, entry.get("files", []))
+        else:
+            delivered = await send_video(update, context, entry)
+    except Exception as e:
+        logging.error(f"خطا در ارسال محتوا: {e}")
+        await update.message.reply_text("❌ خطا در ارسال محتوا. لطفاً مجدداً تلاش کنید.")
+        return UserGate.RETRYABLE
+    if not delivered:
+        # کاربر پیام خطا را گرفته؛ تکرار فوری‌اش نباید debounce شود
+        return UserGate.RETRYABLE
+    tenant.analytics.record_delivery(code)
+
+# ===== دکمه بررسی عضویت بهینه‌شده =====
+@user_gate.guard(lambda update, context: update.callback_query.data)
+async def handle_check_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = current_tenant()
+    activity_monitor.record_activity()
+    query = update.callback_query
+    user_id = query.from_user.id
+    tenant.analytics.record_user(user_id)
+    await query.answer()
+
+    code = tenant.pending_users.get(user_id)
+    if code is None:
+        await query.edit_message_text("❌ لینک پیدا نشد یا منقضی شده.")
+        return
+
+    entry = get_video(code)
+
+    if entry is None:
+        await query.edit_message_text("❌ لینک معتبر نیست.")
+        return
+
+    is_in_first, is_in_second = await asyncio.gather(
+        is_member(tenant.channel_id, user_id, context),
+        is_member(f"@{tenant.second_channel_username}", user_id, context)
+    )
+
+    if not (is_in_first and is_in_second):
+        buttons = []
+        if not is_in_first:
+            buttons.append([InlineKeyboardButton("📢 سکسولوژی", url=f"https://t.me/{tenant.channel_username}")])
+        if not is_in_second:
+            buttons.append([InlineKeyboardButton("📢 سکسی لند", url=f"https://t.me/{tenant.second_channel_username}")])
+        buttons.append([InlineKeyboardButton("✅ بررسی مجدد", callback_data=f"check_{code}")])
+        await query.edit_message_text("⛔ هنوز عضویت کامل نشده.", reply_markup=InlineKeyboardMarkup(buttons))
+        return UserGate.RETRYABLE
+
+    tenant.pending_users.pop(user_id, None)
+    try:
+        # کاربر منتظر محتواست؛ این حذف نباید پشت صف حذف‌های پس‌زمینه بماند
+        await context.bot.delete_message(chat_id=query.message.chat.id, message_id=query.message.message_id,
+                                         rate_limit_args=PRIORITY_INTERACTIVE)
+    except:
+        pass
+
+    return await _deliver_content(Update(update.update_id, message=query.message), context, code, entry)
+
+# ===== ارسال ویدیو با مدیریت خطا =====
+async def send_video(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: str):
+    """ارسال ویدیو با یک تلاش دوباره؛ خروجی: آیا ویدیو رسید"""
+    tenant = current_tenant()
+    try:
+        msg = await update.message.reply_video(
+            file_id,
+            caption="🎥 ❌ویدیو تا ۲۰ ثانیه قابل مشاهده است❌."
+        )
+        tenant.deletions.schedule(msg.chat.id, msg.message_id)
+        return True
+    except Exception as e:
+        logging.error(f"خطا در ارسال ویدیو: {e}")
+        try:
+            msg = await context.bot.send_video(
+                chat_id=update.message.chat.id,
+                video=file_id,
+                caption="🎥 ویدیو تا ۲۰ ثانیه قابل مشاهده است."
+            )
+            tenant.deletions.schedule(msg.chat.id, msg.message_id)
+            return True
+        except Exception as e2:
+            logging.error(f"خطای دوم در ارسال ویدیو: {e2}")
+            await update.message.reply_text("❌ خطا در ارسال ویدیو.")
+            return False
+
+# ===== زمان‌بندی آپدیت‌های ورودی =====
+class UpdateScheduler(BaseUpdateProcessor):
+    """اجرای آپدیت‌ها با سقف هم‌زمانی و صف اولویت‌دار
+
+    ترتیب اولویت: ادمین > callback > /start > بقیه. وقتی همه‌ی جایگاه‌ها پر
+    است آپدیت در صف کلاس خودش منتظر می‌ماند و هر جایگاهی که آزاد شود به
+    پراولویت‌ترین منتظر داده می‌شود. اگر صف کلاسی پر باشد یا آپدیت بیش از
+    UPDATE_MAX_WAIT منتظر مانده باشد، اجرا نمی‌شود و کاربر فوراً پیام «شلوغ است» می‌گیرد.
+    آپدیت‌های chat_member سبک‌اند و ایندکس عضویت به آن‌ها وابسته است، پس از صف عبور نمی‌کنند.
+    """
+
+    def __init__(self, limit=UPDATE_CONCURRENCY, queue_limits=UPDATE_QUEUE_LIMITS, max_wait=UPDATE_MAX_WAIT):
+        # سمافور خود PTB فقط سقف کلی taskهاست؛ پذیرش و صف‌بندی اینجا انجام می‌شود
+        super().__init__(limit + sum(q for q in queue_limits if q) + UPDATE_ADMIT_SLACK)
+        self.limit = limit
+        self.queue_limits = queue_limits
+        self.max_wait = max_wait
+        self._active = 0
+        self._waiting = [deque() for _ in queue_limits]
+        self._busy_notified = StateNamespace("busy_notices", ttl=UPDATE_BUSY_NOTICE_TTL, max_entries=USER_GATE_MAX_ENTRIES)
+        self._busy_sending = set()
+        self.shed = [0] * len(queue_limits)
+
+    @staticmethod
+    def classify(update):
+        if not isinstance(update, Update) or update.chat_member or update.my_chat_member:
+            return None
+        user = update.effective_user
+        if user is not None and user.id == tenant_for_update(update).admin_id:
+            return UPDATE_CLASS_ADMIN
+        if update.callback_query:
+            return UPDATE_CLASS_CALLBACK
+        message = update.message
+        if message and message.text and message.text.startswith("/start"):
+            return UPDATE_CLASS_START
+        return UPDATE_CLASS_OTHER
+
+    async def do_process_update(self, update, coroutine):
+        cls = self.classify(update)
+        if cls is None:
+            await coroutine
+            return
+
+        if self._active < self.limit and not any(self._waiting):
+            self._active += 1
+        else:
+            limit = self.queue_limits[cls]
+            if limit is not None and len(self._waiting[cls]) >= limit:
+                self._shed(update, coroutine, cls, "queue_full")
+                return
+            try:
+                fresh = await self._wait_turn(cls)
+            except asyncio.CancelledError:
+                coroutine.close()
+                raise
+            if not fresh:
+                self._shed(update, coroutine, cls, "stale")
+                return
+
+        try:
+            await coroutine
+        finally:
+            self._release()
+
+    async def _wait_turn(self, cls):
+        """انتظار برای جایگاه؛ False یعنی آپدیت کهنه شده و جایگاه به نفر بعد رسید"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[cls].append(future)
+        queued = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                try:
+                    self._waiting[cls].remove(future)
+                except ValueError:
+                    pass
+            raise
+        waited = time.monotonic() - queued
+        metrics.observe("bot_update_wait_seconds", waited, kind=UPDATE_CLASS_NAMES[cls])
+        if waited > self.max_wait:
+            self._release()
+            return False
+        return True
+
+    def _release(self):
+        """جایگاه آزادشده مستقیم به پراولویت‌ترین منتظر داده می‌شود"""
+        for queue in self._waiting:
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    return
+        self._active -= 1
+
+    def _shed(self, update, coroutine, cls, reason):
+        coroutine.close()
+        self.shed[cls] += 1
+        metrics.inc("bot_updates_shed_total", kind=UPDATE_CLASS_NAMES[cls], reason=reason)
+        user = update.effective_user
+        # هر کاربر در هر UPDATE_BUSY_NOTICE_TTL ثانیه فقط یک پیام «شلوغ است» می‌گیرد
+        if user is None or user.id in self._busy_notified or user.id in self._busy_sending:
+            return
+        self._busy_sending.add(user.id)
+        asyncio.get_running_loop().create_task(self._notify_busy(update, user.id))
+
+    async def _notify_busy(self, update, user_id):
+        try:
+            if await send_busy_notice(update.get_bot(), update):
+                # فقط بعد از ارسال موفق؛ اگر ارسال شکست، آپدیت بعدی دوباره تلاش می‌کند
+                self._busy_notified[user_id] = True
+        except Exception as e:
+            logging.warning(f"خطا در ارسال پیام شلوغی به {user_id}: {e}")
+        finally:
+            self._busy_sending.discard(user_id)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        return {
+            "active": self._active,
+            "limit": self.limit,
+            "queued": {name: len(q) for name, q in zip(UPDATE_CLASS_NAMES, self._waiting)},
+            "shed": dict(zip(UPDATE_CLASS_NAMES, self.shed))
+        }
+
+update_scheduler = UpdateScheduler()
+
+async def send_busy_notice(bot, update):
+    """پیام «شلوغ است»؛ خروجی: آیا جایی برای جواب بود
+
+    shortcutهای Message/CallbackQuery در PTB 20 پارامتر rate_limit_args ندارند،
+    پس مستقیم از bot فرستاده می‌شود.
+    """
+    if update.callback_query:
+        await bot.answer_callback_query(update.callback_query.id, text=UPDATE_BUSY_TEXT,
+                                        rate_limit_args=PRIORITY_INTERACTIVE)
+    elif update.effective_chat:
+        await bot.send_message(chat_id=update.effective_chat.id, text=UPDATE_BUSY_TEXT,
+                               rate_limit_args=PRIORITY_INTERACTIVE)
+    else:
+        return False
+    return True
+
+# ===== صف ارسال با اولویت و محدودیت نرخ =====
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """ثانیه تا آزاد شدن یک توکن (صفر یعنی الان)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class OutboundDispatcher(BaseRateLimiter):
+    """همه‌ی فراخوانی‌های send/edit/delete از این صف رد می‌شوند
+
+    یک سطل توکن سراسری (~۳۰ پیام در ثانیه) و یک سطل برای هر چت (فقط
+    برای ارسال پیام) داریم. درخواست‌ها بر اساس اولویت صف می‌شوند تا پاسخ
+    به کاربر از حذف‌ها و برادکست جلو بزند؛ ولی هر OUTBOUND_FAIR_EVERY مجوز یک بار
+    قدیمی‌ترین درخواست (از هر صفی) جلو می‌افتد تا صف پس‌زمینه گرسنه نماند. RetryAfter کل صف را به اندازه‌ی
+    زمان اعلام‌شده متوقف می‌کند و درخواست دوباره در صف قرار می‌گیرد.
+    اولویت با rate_limit_args متدهای bot قابل تعیین است.
+
+    deleteMessage(s) از سطل سراسری سهمی نمی‌گیرند: صف و سطل خودشان
+    (OUTBOUND_DELETE_RATE) را دارند تا موج حذف‌های زمان‌دار جای ارسال‌ها را نگیرد.
+
+    صف در هر پروسه جداست: با STATE_BACKEND=sqlite و N worker سقف واقعی
+    N×OUTBOUND_GLOBAL_RATE است و 429های تلگرام را فقط RetryAfter مهار می‌کند.
+    """
+
+    _QUEUED_PREFIXES = ("send", "edit", "delete", "copy", "forward")
+    _CHAT_LIMITED_PREFIXES = ("send", "copy", "forward")
+    _BACKGROUND_ENDPOINTS = {"deleteMessage", "deleteMessages"}
+
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE,
+                 chat_burst=OUTBOUND_CHAT_BURST, max_retries=OUTBOUND_MAX_RETRIES,
+                 delete_rate=OUTBOUND_DELETE_RATE):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._queues = [deque() for _ in range(PRIORITY_BACKGROUND + 1)]
+        self._delete_bucket = TokenBucket(delete_rate, delete_rate)
+        self._delete_queue = deque()
+        self.deletes_granted = 0
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._task = None
+        self._grants = 0
+        self.granted = [0] * len(self._queues)
+        self.wait_total = [0.0] * len(self._queues)
+        self.wait_max = [0.0] * len(self._queues)
+        self.retry_after_hits = 0
+
+    async def initialize(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for queue in (*self._queues, self._delete_queue):
+            while queue:
+                queue.popleft()[1].cancel()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # حذف سطل‌های پر (چت‌هایی که مدتی پیامی نداشته‌اند)
+                now = time.monotonic()
+                for key in [k for k, b in self._chats.items() if b.wait_time(now) == 0 and b.tokens >= b.capacity]:
+                    del self._chats[key]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _acquire(self, priority, chat_id, delete=False):
+        fut = asyncio.get_running_loop().create_future()
+        queue = self._delete_queue if delete else self._queues[priority]
+        queue.append((chat_id, fut, time.monotonic()))
+        self._wakeup.set()
+        await fut
+
+    def _order(self):
+        """ترتیب بررسی صف‌ها: معمولاً اولویت سخت‌گیرانه، هر OUTBOUND_FAIR_EVERY بار قدیمی‌ترین صف اول"""
+        order = range(len(self._queues))
+        if self._grants % OUTBOUND_FAIR_EVERY == OUTBOUND_FAIR_EVERY - 1:
+            order = sorted(order, key=lambda p: self._queues[p][0][2] if self._queues[p] else float("inf"))
+        return order
+
+    def _grant(self, now):
+        """اجازه دادن به اولین درخواست قابل ارسال؛ خروجی: زمان انتظار یا None"""
+        soonest = None
+        for priority in self._order():
+            queue = self._queues[priority]
+            i = 0
+            while i < len(queue) and i < OUTBOUND_SCAN_LIMIT:
+                chat_id, fut, enqueued = queue[i]
+                if fut.done():
+                    del queue[i]
+                    continue
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+                wait = bucket.wait_time(now) if bucket is not None else 0.0
+                if wait > 0:
+                    soonest = wait if soonest is None else min(soonest, wait)
+                    i += 1
+                    continue
+                del queue[i]
+                self._global.take()
+                if bucket is not None:
+                    bucket.take()
+                waited = now - enqueued
+                metrics.observe("bot_outbound_wait_seconds", waited, priority=PRIORITY_NAMES[priority])
+                self.granted[priority] += 1
+                self.wait_total[priority] += waited
+                self.wait_max[priority] = max(self.wait_max[priority], waited)
+                self._grants += 1
+                fut.set_result(None)
+                return 0.0
+        return soonest
+
+    def _grant_delete(self, now):
+        """خط حذف‌ها: به ترتیب ورود و فقط با سطل خودش؛ خروجی مثل _grant"""
+        queue = self._delete_queue
+        while queue and queue[0][1].done():
+            queue.popleft()
+        if not queue:
+            return None
+        wait = self._delete_bucket.wait_time(now)
+        if wait > 0:
+            return wait
+        _, fut, enqueued = queue.popleft()
+        self._delete_bucket.take()
+        metrics.observe("bot_outbound_wait_seconds", now - enqueued, priority="delete")
+        self.deletes_granted += 1
+        fut.set_result(None)
+        return 0.0
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            if not any(self._queues) and not self._delete_queue:
+                await self._wakeup.wait()
+                continue
+            if now < self._paused_until:
+                delay = self._paused_until - now
+            else:
+                delay = self._grant_delete(now)
+                if delay != 0.0 and any(self._queues):
+                    sends = self._global.wait_time(now) or self._grant(now)
+                    if delay is None or (sends is not None and sends < delay):
+                        delay = sends
+            if delay == 0.0:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay if delay is not None else 1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        queued = self._task is not None and endpoint.startswith(self._QUEUED_PREFIXES)
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        elif endpoint in self._BACKGROUND_ENDPOINTS:
+            priority = PRIORITY_BACKGROUND
+        else:
+            priority = PRIORITY_INTERACTIVE
+        delete = endpoint in self._BACKGROUND_ENDPOINTS
+        chat_id = data.get("chat_id") if endpoint.startswith(self._CHAT_LIMITED_PREFIXES) else None
+
+        for attempt in range(self.max_retries + 1):
+            if queued:
+                await self._acquire(priority, chat_id, delete)
+            calls = _api_calls.get()
+            if calls is not None:
+                calls[0] += 1
+            start = time.perf_counter()
+            pool_token = _request_pool.set("background" if priority == PRIORITY_BACKGROUND else "interactive")
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                metrics.inc("bot_api_errors_total", method=endpoint, exception="RetryAfter")
+                self.retry_after_hits += 1
+                if attempt == self.max_retries:
+                    raise
+                pause = float(exc.retry_after) + 0.1
+                logging.warning(f"⏳ محدودیت تلگرام ({endpoint})؛ توقف {pause:.1f} ثانیه")
+                if queued:
+                    self._paused_until = max(self._paused_until, time.monotonic() + pause)
+                    self._wakeup.set()
+                else:
+                    await asyncio.sleep(pause)
+            except Exception as e:
+                metrics.inc("bot_api_errors_total", method=endpoint, exception=type(e).__name__)
+                raise
+            finally:
+                _request_pool.reset(pool_token)
+                metrics.observe("bot_api_request_duration_seconds", time.perf_counter() - start, method=endpoint)
+
+    def stats(self):
+        names = PRIORITY_NAMES
+        return {
+            "queue_depth": {**{names[p]: len(q) for p, q in enumerate(self._queues)}, "delete": len(self._delete_queue)},
+            "granted": {**{names[p]: n for p, n in enumerate(self.granted)}, "delete": self.deletes_granted},
+            "wait_avg": {
+                names[p]: round(self.wait_total[p] / n, 4) if n else 0.0 for p, n in enumerate(self.granted)
+            },
+            "wait_max": {names[p]: round(w, 4) for p, w in enumerate(self.wait_max)},
+            "retry_after": self.retry_after_hits,
+            "paused": max(0.0, round(self._paused_until - time.monotonic(), 2))
+        }
+
+# ===== اتصال HTTP به Bot API =====
+# PTB برای timeoutهایی که فراخواننده تعیین نکرده DefaultValue می‌فرستد
+_DefaultValue = type(BaseRequest.DEFAULT_NONE)
+
+class HTTPPool(HTTPXRequest):
+    """یک استخر اتصال httpx با keep-alive قابل تنظیم و متریک اشباع
+
+    جلوی استخر یک سمافور به اندازه‌ی همان استخر است تا انتظار برای اتصال
+    آزاد اندازه‌گیری شود و pool timeout به جای خطای مبهم httpx شمرده شود.
+    چند Bot می‌توانند یک استخر را مشترک استفاده کنند؛ initialize/shutdown
+    شمارش می‌شود تا خاموش شدن یک ربات اتصال‌های بقیه را نبندد.
+    """
+
+    def __init__(self, name, size, read_timeout=HTTP_READ_TIMEOUT, http_version=HTTP_VERSION,
+                 keepalive_expiry=HTTP_KEEPALIVE_EXPIRY):
+        self.name = name
+        self.size = size
+        self.keepalive_expiry = keepalive_expiry
+        self._slots = asyncio.Semaphore(size)
+        self._users = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.timeouts = 0
+        kwargs = dict(connection_pool_size=size, read_timeout=read_timeout, write_timeout=HTTP_WRITE_TIMEOUT,
+                      connect_timeout=HTTP_CONNECT_TIMEOUT, pool_timeout=HTTP_POOL_TIMEOUT)
         try:
-            msg = await context.bot.send_video(
-                chat_id=update.message.chat.id,
-                video=fid,
-                caption="🎥فیلم ها بعد از 20 ثانیه به طور خودکار حذف خواهند شد❌"
-            )
-            asyncio.create_task(_del_after(context, msg.chat.id, msg.message_id, 20))
-            success_count += 1
-            await asyncio.sleep(0.2)
-        except Exception as e:
-            logging.warning(f"خطا در ارسال ویدیو از پکیج: {e}")
-            continue
+            super().__init__(http_version=http_version, **kwargs)
+        except RuntimeError as e:
+            # HTTP/2 به بسته‌ی h2 نیاز دارد
+            logging.warning(f"⚠️ HTTP/{http_version} در دسترس نیست، استفاده از HTTP/1.1: {e}")
+            super().__init__(http_version="1.1", **kwargs)
+
+    def _build_client(self):
+        kwargs = dict(self._client_kwargs)
+        kwargs["limits"] = httpx.Limits(max_connections=self.size, max_keepalive_connections=self.size,
+                                        keepalive_expiry=self.keepalive_expiry)
+        return httpx.AsyncClient(**kwargs)
+
+    async def initialize(self):
+        self._users += 1
+        await super().initialize()
+
+    async def shutdown(self):
+        self._users = max(self._users - 1, 0)
+        if self._users == 0:
+            await super().shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        if isinstance(pool_timeout, _DefaultValue):
+            pool_timeout = self._client.timeout.pool
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), pool_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            metrics.inc("bot_http_pool_timeouts_total", pool=self.name)
+            raise TimedOut(f"Pool timeout: all {self.size} connections of the {self.name} pool are busy") from None
+        finally:
+            self.waiting -= 1
+        metrics.observe("bot_http_pool_wait_seconds", time.perf_counter() - start, pool=self.name)
+        self.in_flight += 1
+        try:
+            return await super().do_request(url, method, request_data, read_timeout, write_timeout,
+                                            connect_timeout, pool_timeout)
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "timeouts": self.timeouts,
+            "http_version": self.http_version
+        }
+
+class BotTransport(BaseRequest):
+    """request همه‌ی فراخوانی‌های Bot API به جز getUpdates
+
+    فراخوانی‌های پس‌زمینه (حذف‌ها و برادکست؛ از روی اولویت OutboundDispatcher)
+    به استخر background می‌روند تا ارسال ویدیو به کاربر پشت آن‌ها منتظر نماند.
+    read timeout متدهای سنگین از HTTP_METHOD_TIMEOUTS می‌آید، مگر فراخواننده
+    خودش مقدار داده باشد.
+    """
+
+    def __init__(self, interactive, background):
+        self.pools = {"interactive": interactive, "background": background}
+
+    async def initialize(self):
+        for pool in self.pools.values():
+            await pool.initialize()
+
+    async def shutdown(self):
+        for pool in self.pools.values():
+            await pool.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        if isinstance(read_timeout, _DefaultValue):
+            read_timeout = HTTP_METHOD_TIMEOUTS.get(url.rsplit("/", 1)[-1], read_timeout)
+        pool = self.pools[_request_pool.get()]
+        return await pool.do_request(url, method, request_data, read_timeout, write_timeout,
+                                     connect_timeout, pool_timeout)
+
+# استخرهای ساخته‌شده برای متریک و health
+http_pools = {}
 
+def build_transport(bots=1):
+    """استخرهای مشترک همه‌ی ربات‌ها؛ خروجی: (request، get_updates_request)"""
+    interactive = HTTPPool("interactive", HTTP_POOL_INTERACTIVE)
+    background = HTTPPool("background", HTTP_POOL_BACKGROUND)
+    # هر getUpdates یک اتصال را تا پایان long-poll نگه می‌دارد
+    updates = HTTPPool("updates", bots)
+    http_pools.update((pool.name, pool) for pool in (interactive, background, updates))
+    return BotTransport(interactive, background), updates
+
+# ===== زمان‌بند حذف پیام‌ها =====
+class DeletionScheduler:
+    """یک heap و یک worker برای همه‌ی حذف‌های زمان‌دار
+
+    حذف‌هایی که موعدشان در بازه‌ی DELETE_BATCH_WINDOW به هم نزدیک است با هم
+    و گروه‌بندی‌شده بر اساس چت ارسال می‌شوند. صف در یک ژورنال کوچک روی دیسک
+    نگه داشته می‌شود تا بعد از ری‌استارت، ویدیوها باز هم حذف شوند.
+    """
+
+    def __init__(self, journal_path, writer=None, batch_window=DELETE_BATCH_WINDOW):
+        self.base_path = journal_path
+        self.writer = writer
+        self.batch_window = batch_window
+        self._heap = []
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._task = None
+        self._bot = None
+        self.deleted = 0
+        self.failed = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_avg = 0.0
+
+    def schedule(self, chat_id, message_id, delay=AUTO_DELETE_SECONDS):
+        deadline = time.time() + delay
+        with self._lock:
+            heapq.heappush(self._heap, (deadline, chat_id, message_id))
+            self._dirty = True
+            is_head = self._heap[0][0] == deadline
+        if is_head and self._wakeup is not None:
+            self._wakeup.set()
+        if self.writer is not None:
+            self.writer.mark_dirty()
+
+    @property
+    def journal_path(self):
+        # بعد از fork در gunicorn باید pid خود worker استفاده شود
+        return _worker_file(self.base_path)
+
+    def load(self):
+        """بازخوانی حذف‌های معوق از ژورنال (و ژورنال workerهای مرده)"""
+        claimed = _claim_orphan_files(self.base_path) if SHARED_STATE else []
+        count = 0
+        for path in [self.journal_path] + claimed:
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                items = json.load(f)
+            with self._lock:
+                for deadline, chat_id, message_id in items:
+                    heapq.heappush(self._heap, (deadline, chat_id, message_id))
+            count += len(items)
+        if claimed:
+            # اول ژورنال خودمان نوشته شود، بعد فایل‌های برداشته‌شده پاک شوند
+            self._dirty = True
+            self.flush()
+            for path in claimed:
+                os.remove(path)
+        return count
+
+    def pending_count(self):
+        return 1 if self._dirty else 0
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            items = list(self._heap)
+            self._dirty = False
+        try:
+            _atomic_write_json(self.journal_path, items)
+        except Exception:
+            self._dirty = True
+            raise
+
+    def start(self, bot):
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _pop_due(self):
+        horizon = time.time() + self.batch_window
+        due = {}
+        with self._lock:
+            while self._heap and self._heap[0][0] <= horizon:
+                deadline, chat_id, message_id = heapq.heappop(self._heap)
+                due.setdefault(chat_id, []).append((deadline, message_id))
+            if due:
+                self._dirty = True
+        return due
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            due = self._pop_due()
+            if self.writer is not None:
+                self.writer.mark_dirty()
+            await asyncio.gather(*(self._delete_chat(chat_id, items) for chat_id, items in due.items()))
+
+    async def _delete_chat(self, chat_id, items):
+        for deadline, message_id in items:
+            self._record_lag(max(0.0, time.time() - deadline))
+            try:
+                await self._bot.delete_message(chat_id=chat_id, message_id=message_id)
+                self.deleted += 1
+            except Exception as e:
+                self.failed += 1
+                logging.debug(f"خطا در حذف پیام: {e}")
+
+    def _record_lag(self, lag):
+        metrics.observe("bot_deletion_lag_seconds", lag)
+        self.lag_last = lag
+        self.lag_max = max(self.lag_max, lag)
+        self.lag_avg = lag if not self.deleted and not self.failed else self.lag_avg * 0.9 + lag * 0.1
+
+    def stats(self):
+        return {
+            "pending": len(self._heap),
+            "deleted": self.deleted,
+            "failed": self.failed,
+            "lag_last": round(self.lag_last, 3),
+            "lag_avg": round(self.lag_avg, 3),
+            "lag_max": round(self.lag_max, 3)
+        }
+
+# ===== ارسال پکیج بهینه‌شده =====
+async def send_package(update: Update, context: ContextTypes.DEFAULT_TYPE, files: list):
+    """خروجی: تعداد ویدیوهای ارسال‌شده"""
+    if not files:
+        await update.message.reply_text("❌ پکیج خالی یا منقضی شده.")
+        return 0
+
+    success_count = await deliver_package(context.bot, update.message.chat.id, files)
     if success_count == 0:
         await update.message.reply_text("❌ خطا در ارسال تمام ویدیوهای پکیج.")
     elif success_count < len(files):
         await update.message.reply_text(f"⚠️ {success_count} از {len(files)} ویدیو ارسال شد.")
+    return success_count
+
+async def deliver_package(bot, chat_id, files):
+    """ارسال ویدیوهای پکیج در آلبوم‌های ۱۰تایی؛ تعداد ویدیوهای ارسال‌شده را برمی‌گرداند"""
+    caption = "🎥فیلم ها بعد از 20 ثانیه به طور خودکار حذف خواهند شد❌"
+    success_count = 0
+    for i in range(0, len(files), MEDIA_GROUP_SIZE):
+        success_count += await _send_album(bot, chat_id, files[i:i + MEDIA_GROUP_SIZE], caption)
+    return success_count
+
+async def _send_album(bot, chat_id, chunk, caption):
+    """ارسال یک آلبوم؛ در صورت خطا هر ویدیو جداگانه ارسال می‌شود"""
+    tenant = current_tenant()
+    if len(chunk) > 1:
+        media = [InputMediaVideo(fid, caption=caption if i == 0 else None) for i, fid in enumerate(chunk)]
+        try:
+            msgs = await bot.send_media_group(chat_id=chat_id, media=media)
+            for msg in msgs:
+                tenant.deletions.schedule(msg.chat.id, msg.message_id)
+            return len(msgs)
+        except Exception as e:
+            logging.warning(f"خطا در ارسال آلبوم پکیج، ارسال تکی: {e}")
+
+    sent = 0
+    for fid in chunk:
+        try:
+            msg = await bot.send_video(chat_id=chat_id, video=fid, caption=caption)
+            tenant.deletions.schedule(msg.chat.id, msg.message_id)
+            sent += 1
+        except Exception as e:
+            logging.warning(f"خطا در ارسال ویدیو از پکیج: {e}")
+    return sent
+
+# ===== صف فیش‌های پرداخت =====
+class ReceiptQueue:
+    """صف بررسی فیش‌های واریزی پکیج‌های پولی در SQLite
+
+    وضعیت هر فیش: pending -> approved -> delivering -> delivered/failed و یا
+    pending -> rejected/superseded. تایید و تحویل جدا ثبت می‌شوند تا اگر پروسه
+    وسط ارسال بمیرد، فیش‌های تاییدشده بعد از ری‌استارت دوباره تحویل شوند.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self.last_notice = 0.0
+
+    def open(self):
+        with self._lock:
+            if self._conn is not None:
+                return
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS receipts ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, "
+                "code TEXT NOT NULL, file_id TEXT NOT NULL, kind TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', created REAL NOT NULL, "
+                "decided REAL, delivered REAL, worker INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS receipts_status ON receipts (status, id)")
+            self._conn = conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def submit(self, user_id, chat_id, code, file_id, kind):
+        """ثبت فیش؛ فیش در انتظار قبلی همان کاربر برای همان کد کنار گذاشته می‌شود"""
+        now = time.time()
+        with self._transaction() as conn:
+            replaced = conn.execute(
+                "UPDATE receipts SET status = 'superseded', decided = ? "
+                "WHERE user_id = ? AND code = ? AND status = 'pending'",
+                (now, user_id, code)
+            ).rowcount
+            receipt_id = conn.execute(
+                "INSERT INTO receipts (user_id, chat_id, code, file_id, kind, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, chat_id, code, file_id, kind, now)
+            ).lastrowid
+        return receipt_id, replaced > 0
+
+    def get(self, receipt_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM receipts WHERE id = ?", (receipt_id,)).fetchone()
+        return dict(row) if row else None
+
+    def page(self, after_id=0, limit=RECEIPT_PAGE_SIZE):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM receipts WHERE status = 'pending' AND id > ? ORDER BY id LIMIT ?",
+                (after_id, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def depth(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM receipts WHERE status = 'pending'").fetchone()[0]
+
+    def decide(self, first_id, last_id, status):
+        """تایید/رد همه‌ی فیش‌های در انتظار در بازه‌ی [first_id, last_id]؛ فقط ردیف‌های تغییرکرده برمی‌گردند"""
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "UPDATE receipts SET status = ?, decided = ? "
+                "WHERE status = 'pending' AND id BETWEEN ? AND ? RETURNING *",
+                (status, time.time(), first_id, last_id)
+            ).fetchall()
+        return sorted((dict(row) for row in rows), key=lambda row: row["id"])
+
+    def claim_approved(self, ids=None):
+        """برداشتن اتمیک فیش‌های تاییدشده برای تحویل (بین چند worker هم یکتا)"""
+        query = "UPDATE receipts SET status = 'delivering', worker = ? WHERE status = 'approved'"
+        params = [os.getpid()]
+        if ids is not None:
+            if not ids:
+                return []
+            query += f" AND id IN ({','.join('?' * len(ids))})"
+            params.extend(ids)
+        with self._transaction() as conn:
+            rows = conn.execute(query + " RETURNING *", params).fetchall()
+        return [dict(row) for row in rows]
+
+    def finish(self, receipt_id, delivered):
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE receipts SET status = ?, delivered = ? WHERE id = ?",
+                ("delivered" if delivered else "failed", time.time() if delivered else None, receipt_id)
+            )
+
+    def recover(self):
+        """تحویل‌های نیمه‌کاره‌ی workerهای مرده دوباره approved می‌شوند"""
+        with self._transaction() as conn:
+            workers = [row[0] for row in conn.execute(
+                "SELECT DISTINCT worker FROM receipts WHERE status = 'delivering'"
+            )]
+            dead = [pid for pid in workers if pid is None or pid == os.getpid() or not _pid_alive(pid)]
+            recovered = 0
+            for pid in dead:
+                recovered += conn.execute(
+                    "UPDATE receipts SET status = 'approved', worker = NULL "
+                    "WHERE status = 'delivering' AND worker IS ?", (pid,)
+                ).rowcount
+            approved = conn.execute("SELECT COUNT(*) FROM receipts WHERE status = 'approved'").fetchone()[0]
+        if recovered:
+            logging.warning(f"🧾 {recovered} تحویل نیمه‌کاره‌ی فیش بازیابی شد")
+        return approved
+
+    def stats(self):
+        with self._lock:
+            if self._conn is None:
+                return {}
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM receipts GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+def _receipt_caption(row):
+    entry = get_video(row["code"])
+    price = entry.get("price", 99000) if isinstance(entry, dict) else 0
+    waited = int(time.time() - row["created"]) // 60
+    return (f"🧾 فیش #{row['id']}\n👤 کاربر: {row['user_id']}\n📦 کد: {row['code']}\n"
+            f"💰 مبلغ: {price:,} تومان\n🕒 {waited} دقیقه پیش")
+
+async def handle_payment_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """دریافت عکس/فایل فیش از کاربری که پرداخت در انتظار دارد"""
+    tenant = current_tenant()
+    activity_monitor.record_activity()
+    user = update.effective_user
+    message = update.message
+    code = tenant.pending_payments.get(user.id)
+    if code is None:
+        return
+
+    if message.photo:
+        file_id, kind = message.photo[-1].file_id, "photo"
+    else:
+        file_id, kind = message.document.file_id, "document"
+
+    receipt_id, replaced = tenant.receipts.submit(user.id, message.chat.id, code, file_id, kind)
+    tenant.payment_receipts[user.id] = receipt_id
+    metrics.inc("bot_receipts_total", event="submitted")
+    note = "\n🔁 فیش قبلی شما با این فیش جایگزین شد." if replaced else ""
+    await message.reply_text(
+        f"✅ فیش شما دریافت شد و در صف بررسی است.\nپس از تایید ادمین، پکیج برایتان ارسال می‌شود.{note}"
+    )
+
+    # در هجوم فیش‌ها ادمین فقط هر RECEIPT_NOTIFY_INTERVAL ثانیه یک اعلان می‌گیرد
+    if tenant.admin_id and time.monotonic() - tenant.receipts.last_notice > RECEIPT_NOTIFY_INTERVAL:
+        tenant.receipts.last_notice = time.monotonic()
+        keyboard = [[InlineKeyboardButton("🧾 بررسی فیش‌ها", callback_data="rcpt_page_0")]]
+        try:
+            await context.bot.send_message(
+                chat_id=tenant.admin_id,
+                text=f"📥 فیش جدید دریافت شد. در صف بررسی: {tenant.receipts.depth()}",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+        except Exception as e:
+            logging.warning(f"خطا در اعلان فیش به ادمین: {e}")
+
+async def send_receipt_page(bot, chat_id, after_id=0):
+    """نمایش یک صفحه فیش در انتظار با دکمه‌های تایید/رد تکی و گروهی"""
+    tenant = current_tenant()
+    rows = tenant.receipts.page(after_id)
+    if not rows:
+        await bot.send_message(chat_id=chat_id, text="📭 فیشی در انتظار بررسی نیست.")
+        return
+
+    for row in rows:
+        keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ تایید", callback_data=f"rcpt_ok_{row['id']}"),
+            InlineKeyboardButton("❌ رد", callback_data=f"rcpt_no_{row['id']}")
+        ]])
+        send = bot.send_photo if row["kind"] == "photo" else bot.send_document
+        try:
+            await send(chat_id, row["file_id"], caption=_receipt_caption(row), reply_markup=keyboard,
+                       rate_limit_args=PRIORITY_INTERACTIVE)
+        except Exception as e:
+            logging.warning(f"خطا در نمایش فیش {row['id']}: {e}")
+
+    first, last = rows[0]["id"], rows[-1]["id"]
+    depth = tenant.receipts.depth()
+    buttons = [[
+        InlineKeyboardButton("✅ تایید همه", callback_data=f"rcpt_okall_{first}_{last}"),
+        InlineKeyboardButton("❌ رد همه", callback_data=f"rcpt_noall_{first}_{last}")
+    ]]
+    if depth > len(rows):
+        buttons.append([InlineKeyboardButton("➡️ صفحه‌ی بعد", callback_data=f"rcpt_page_{last}")])
+    await bot.send_message(
+        chat_id=chat_id,
+        text=f"🧾 فیش‌های #{first} تا #{last} ({len(rows)} از {depth} در صف)",
+        reply_markup=InlineKeyboardMarkup(buttons),
+        rate_limit_args=PRIORITY_INTERACTIVE
+    )
+
+async def receipts_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = current_tenant()
+    activity_monitor.record_activity()
+    if update.effective_user.id != tenant.admin_id:
+        return
+    await send_receipt_page(context.bot, update.effective_chat.id)
+
+async def handle_receipt_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = current_tenant()
+    activity_monitor.record_activity()
+    query = update.callback_query
+    if query.from_user.id != tenant.admin_id:
+        await query.answer("❌ فقط ادمین دسترسی دارد.")
+        return
+
+    parts = (query.data or "").split("_")
+    action = parts[1]
+    if action == "page":
+        await query.answer()
+        await send_receipt_page(context.bot, query.message.chat.id, int(parts[2]))
+        return
+
+    first = int(parts[2])
+    last = int(parts[3]) if len(parts) > 3 else first
+    approve = action in ("ok", "okall")
+    rows = tenant.receipts.decide(first, last, "approved" if approve else "rejected")
+    if not rows:
+        await query.answer("ℹ️ قبلاً بررسی شده.")
+        return
+    await query.answer(f"{'✅ تایید' if approve else '❌ رد'} شد: {len(rows)} فیش")
+
+    for row in rows:
+        metrics.inc("bot_receipts_total", event="approved" if approve else "rejected")
+        if tenant.payment_receipts.get(row["user_id"]) == row["id"]:
+            tenant.payment_receipts.pop(row["user_id"], None)
+        # بعد از رد، کاربر می‌تواند فیش درست را دوباره بفرستد
+        if approve and tenant.pending_payments.get(row["user_id"]) == row["code"]:
+            tenant.pending_payments.pop(row["user_id"], None)
+
+    mark = "✅ تایید شد" if approve else "❌ رد شد"
+    try:
+        if query.message.caption is not None:
+            await query.edit_message_caption(caption=f"{query.message.caption}\n\n{mark}")
+        else:
+            await query.edit_message_text(f"{query.message.text}\n\n{mark}: {len(rows)} فیش")
+    except Exception as e:
+        logging.debug(f"خطا در به‌روزرسانی پیام فیش: {e}")
+
+    if approve:
+        context.application.create_task(
+            deliver_approved_receipts(context.bot, [row["id"] for row in rows], report_chat_id=query.message.chat.id)
+        )
+    else:
+        await asyncio.gather(*(_notify_rejected(context.bot, row) for row in rows))
+
+async def _notify_rejected(bot, row):
+    try:
+        await bot.send_message(
+            chat_id=row["chat_id"],
+            text="❌ فیش شما تایید نشد.\nدر صورت واریز، لطفاً فیش صحیح را دوباره همین‌جا ارسال کنید."
+        )
+    except Exception as e:
+        logging.warning(f"خطا در اطلاع رد فیش به {row['user_id']}: {e}")
+
+async def deliver_approved_receipts(bot, ids=None, report_chat_id=None):
+    """تحویل هم‌زمان پکیج فیش‌های تاییدشده از همان مسیر ارسال پکیج"""
+    tenant = current_tenant()
+    rows = tenant.receipts.claim_approved(ids)
+    if not rows:
+        return
+    semaphore = asyncio.Semaphore(RECEIPT_DELIVERY_CONCURRENCY)
+
+    async def deliver(row):
+        async with semaphore:
+            entry = get_video(row["code"])
+            files = entry.get("files", []) if isinstance(entry, dict) else []
+            sent = 0
+            try:
+                await bot.send_message(chat_id=row["chat_id"], text="✅ پرداخت شما تایید شد. پکیج ویژه در حال ارسال است...")
+                sent = await deliver_package(bot, row["chat_id"], files)
+            except Exception as e:
+                logging.warning(f"خطا در تحویل پکیج فیش {row['id']}: {e}")
+            tenant.receipts.finish(row["id"], sent > 0)
+            if sent > 0:
+                tenant.analytics.record_delivery(row["code"])
+                metrics.inc("bot_receipts_total", event="delivered")
+                metrics.observe("bot_receipt_delivery_seconds", time.time() - row["created"])
+            else:
+                metrics.inc("bot_receipts_total", event="failed")
+            return sent > 0
+
+    results = await asyncio.gather(*(deliver(row) for row in rows))
+    delivered = sum(results)
+    logging.warning(f"🧾 تحویل فیش‌ها: {delivered} موفق، {len(rows) - delivered} ناموفق")
+    if report_chat_id is not None:
+        try:
+            await bot.send_message(
+                chat_id=report_chat_id,
+                text=f"📦 تحویل پکیج‌ها: ✅ {delivered} | ❌ {len(rows) - delivered}"
+            )
+        except Exception as e:
+            logging.debug(f"خطا در گزارش تحویل فیش‌ها: {e}")
 
 # ===== نمایش اعضا =====
 async def show_member_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = current_tenant()
     activity_monitor.record_activity()
-    if update.effective_user.id != ADMIN_ID:
+    if update.effective_user.id != tenant.admin_id:
         return
     users = load_users()
+    if not users.loaded:
+        await update.message.reply_text(USERS_LOADING_TEXT)
+        return
     await update.message.reply_text(f"👥 اعضای ربات: {len(users)} نفر")
 
-# ===== اجرای اصلی بهینه‌شده =====
-def main():
-    if not BOT_TOKEN:
-        logging.error("❌ BOT_TOKEN تنظیم نشده!")
+# ===== آمار استفاده =====
+class HyperLogLog:
+    """تخمین تعداد کاربران یکتا با حافظه‌ی ثابت (2^p بایت، خطای حدود 1.04/√2^p)"""
+
+    def __init__(self, p=ANALYTICS_HLL_PRECISION, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+
+    def add(self, user_id):
+        h = int.from_bytes(hashlib.blake2b(str(user_id).encode(), digest_size=8).digest(), "big")
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+class Analytics:
+    """شمارنده‌ی درخواست/تحویل هر کد و HyperLogLog کاربران یکتای هر روز
+
+    همه چیز در حافظه جمع می‌شود و هر ANALYTICS_FLUSH_INTERVAL ثانیه از طریق
+    write-behind در SQLite ادغام می‌شود: شمارنده‌ها به صورت delta جمع و
+    sketchها با max رجیسترها merge می‌شوند، پس چند worker روی یک فایل درست کار می‌کنند.
+    """
+
+    def __init__(self, path, writer=None, interval=ANALYTICS_FLUSH_INTERVAL):
+        self.path = path
+        self.writer = writer
+        self.interval = interval
+        self._conn = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._codes = {}
+        self._days = {}
+        self._dirty_days = set()
+        self._last_flush = time.monotonic()
+
+    def open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS code_stats ("
+            "code TEXT PRIMARY KEY, requests INTEGER NOT NULL DEFAULT 0, deliveries INTEGER NOT NULL DEFAULT 0"
+            ") WITHOUT ROWID"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS daily_users (day TEXT PRIMARY KEY, registers BLOB NOT NULL)")
+        self._conn = conn
+
+    def close(self):
+        with self._flush_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @staticmethod
+    def day(offset=0):
+        """روز جاری به وقت ایران (UTC+3:30)"""
+        return time.strftime("%Y-%m-%d", time.gmtime(time.time() + ANALYTICS_DAY_OFFSET - offset * 86400))
+
+    def record_user(self, user_id):
+        day = self.day()
+        with self._lock:
+            sketch = self._days.get(day)
+            if sketch is None:
+                sketch = self._days[day] = HyperLogLog()
+                self._prune_days()
+            if sketch.add(user_id):
+                self._dirty_days.add(day)
+
+    def _prune_days(self):
+        for old in sorted(self._days)[:-ANALYTICS_MEMORY_DAYS]:
+            if old not in self._dirty_days:
+                del self._days[old]
+
+    def _count(self, code, field):
+        with self._lock:
+            counters = self._codes.get(code)
+            if counters is None:
+                counters = self._codes[code] = [0, 0]
+            counters[field] += 1
+
+    def record_request(self, code):
+        self._count(code, 0)
+
+    def record_delivery(self, code):
+        self._count(code, 1)
+
+    def pending_count(self):
+        # write-behind هر چند ثانیه می‌پرسد؛ آمار فقط هر interval ثانیه نوشته می‌شود
+        if time.monotonic() - self._last_flush < self.interval:
+            return 0
+        return len(self._codes) + len(self._dirty_days)
+
+    def flush(self):
+        with self._flush_lock:
+            if self._conn is None:
+                return
+            with self._lock:
+                codes, self._codes = self._codes, {}
+                days = {day: bytes(self._days[day].registers) for day in self._dirty_days}
+                self._dirty_days = set()
+            self._last_flush = time.monotonic()
+            if not codes and not days:
+                return
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._conn.executemany(
+                    "INSERT INTO code_stats (code, requests, deliveries) VALUES (?, ?, ?) "
+                    "ON CONFLICT(code) DO UPDATE SET requests = requests + excluded.requests, "
+                    "deliveries = deliveries + excluded.deliveries",
+                    [(code, r, d) for code, (r, d) in codes.items()]
+                )
+                for day, registers in days.items():
+                    row = self._conn.execute("SELECT registers FROM daily_users WHERE day = ?", (day,)).fetchone()
+                    if row:
+                        registers = bytes(HyperLogLog(registers=registers).merge(HyperLogLog(registers=row[0])).registers)
+                    self._conn.execute("INSERT OR REPLACE INTO daily_users (day, registers) VALUES (?, ?)", (day, registers))
+                self._conn.execute(
+                    "DELETE FROM daily_users WHERE day < ?", (self.day(ANALYTICS_RETENTION_DAYS),)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                with self._lock:
+                    # برگرداندن deltaها برای flush بعدی
+                    for code, (r, d) in codes.items():
+                        counters = self._codes.setdefault(code, [0, 0])
+                        counters[0] += r
+                        counters[1] += d
+                    self._dirty_days.update(days)
+                raise
+
+    def report(self, top=ANALYTICS_TOP_CODES):
+        """کدهای پرطرفدار و DAU/WAU؛ قبلش flush شود تا داده‌ی حافظه هم حساب شود"""
+        with self._flush_lock:
+            rows = self._conn.execute(
+                "SELECT code, requests, deliveries FROM code_stats ORDER BY requests DESC LIMIT ?", (top,)
+            ).fetchall()
+            week = [self.day(i) for i in range(7)]
+            sketches = {day: HyperLogLog(registers=registers) for day, registers in self._conn.execute(
+                f"SELECT day, registers FROM daily_users WHERE day IN ({','.join('?' * len(week))})", week
+            )}
+        wau = HyperLogLog()
+        for sketch in sketches.values():
+            wau.merge(sketch)
+        today = sketches.get(week[0])
+        return {
+            "top": rows,
+            "dau": today.count() if today else 0,
+            "yesterday": sketches[week[1]].count() if week[1] in sketches else 0,
+            "wau": wau.count() if sketches else 0
+        }
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats: کدهای پرطرفدار و کاربران یکتای روزانه/هفتگی"""
+    tenant = current_tenant()
+    activity_monitor.record_activity()
+    if update.effective_user.id != tenant.admin_id:
+        return
+    users = load_users()
+    if not users.loaded:
+        await update.message.reply_text(USERS_LOADING_TEXT)
+        return
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, tenant.analytics.flush)
+    report = await loop.run_in_executor(None, tenant.analytics.report)
+
+    lines = [
+        "📊 آمار ربات",
+        f"👥 کل کاربران: {len(users)}",
+        f"📅 امروز: {report['dau']} | دیروز: {report['yesterday']} | ۷ روز: {report['wau']}",
+        "",
+        "🔥 کدهای پرطرفدار:"
+    ]
+    for i, (code, requests, deliveries) in enumerate(report["top"], 1):
+        rate = f" ({deliveries * 100 // requests}٪)" if requests else ""
+        lines.append(f"{i}. <code>{code}</code> — درخواست {requests} | تحویل {deliveries}{rate}")
+    if not report["top"]:
+        lines.append("هنوز آماری ثبت نشده.")
+    await update.message.reply_text("\n".join(lines))
+
+# ===== برادکست =====
+class BroadcastEngine:
+    """ارسال یک پیام به همه‌ی کاربران با قابلیت ادامه بعد از ری‌استارت
+
+    کاربران به ترتیب شناسه و تکه‌به‌تکه از رجیستری خوانده می‌شوند. بعد از هر
+    تکه cursor (آخرین شناسه‌ی پردازش‌شده) در broadcast.json ثبت می‌شود؛ پس
+    بعد از ری‌استارت حداکثر یک تکه دوباره ارسال می‌شود. ارسال‌ها با اولویت
+    پس‌زمینه از OutboundDispatcher رد می‌شوند و کاربرانی که ربات را بلاک
+    کرده‌اند یا حذف شده‌اند از رجیستری پاک می‌شوند.
+    """
+
+    def __init__(self, state_path, writer=None):
+        self.state_path = state_path
+        self.writer = writer
+        self.state = None
+        self._lock_fd = None
+        self._dirty = False
+        self._task = None
+
+    def load(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+        return self.state
+
+    def pending_count(self):
+        return 1 if self._dirty else 0
+
+    def flush(self):
+        if not self._dirty or self.state is None:
+            return
+        self._dirty = False
+        try:
+            _atomic_write_json(self.state_path, dict(self.state))
+        except Exception:
+            self._dirty = True
+            raise
+
+    def _mark_dirty(self):
+        self._dirty = True
+        if self.writer is not None:
+            self.writer.mark_dirty()
+
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def claim(self):
+        """در حالت چند worker فقط پروسه‌ی صاحب قفل برادکست را اجرا می‌کند"""
+        if not SHARED_STATE or self._lock_fd is not None:
+            return True
+        fd = os.open(f"{self.state_path}.lock", os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def _release(self, _task=None):
+        if self._lock_fd is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def start(self, bot, state=None):
+        if state is not None:
+            self.state = state
+        self.state["status"] = "running"
+        self._mark_dirty()
+        self._task = asyncio.get_running_loop().create_task(self._run(bot))
+        self._task.add_done_callback(self._release)
+
+    def cancel(self):
+        if not self.running():
+            return False
+        self.state["status"] = "cancelled"
+        self._mark_dirty()
+        self._task.cancel()
+        return True
+
+    async def stop(self):
+        """توقف هنگام خاموشی؛ وضعیت running می‌ماند تا در اجرای بعدی ادامه یابد"""
+        if self.running():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self, bot):
+        state = self.state
+        registry = load_users()
+        while not registry.loaded:
+            # ادامه‌ی برادکست بعد از ری‌استارت در FAST_START منتظر لود رجیستری می‌ماند
+            await asyncio.sleep(0.5)
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        started = time.monotonic()
+        done_at_start = state["done"]
+        last_report = 0.0
+        try:
+            while state["status"] == "running":
+                chunk = registry.iter_from(state["cursor"], BROADCAST_CHUNK_SIZE)
+                if not chunk:
+                    state["status"] = "done"
+                    break
+                await asyncio.gather(*(self._send_one(bot, sem, uid) for uid in chunk))
+                state["cursor"] = chunk[-1]
+                state["done"] += len(chunk)
+                self._mark_dirty()
+                if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    await self._report(bot, registry, started, done_at_start)
+            self._mark_dirty()
+            await self._report(bot, registry, started, done_at_start)
+        except asyncio.CancelledError:
+            if state["status"] == "cancelled":
+                await self._report(bot, registry, started, done_at_start)
+            raise
+        except Exception as e:
+            logging.error(f"خطا در برادکست: {e}")
+            state["status"] = "failed"
+            self._mark_dirty()
+
+    async def _send_one(self, bot, sem, user_id):
+        state = self.state
+        async with sem:
+            try:
+                await bot.copy_message(
+                    chat_id=user_id,
+                    from_chat_id=state["from_chat_id"],
+                    message_id=state["message_id"],
+                    rate_limit_args=PRIORITY_BACKGROUND
+                )
+                state["sent"] += 1
+            except Forbidden:
+                self._prune(user_id)
+            except BadRequest as e:
+                reason = str(e).lower()
+                if "chat not found" in reason or "deactivated" in reason:
+                    self._prune(user_id)
+                else:
+                    state["failed"] += 1
+            except Exception as e:
+                state["failed"] += 1
+                logging.debug(f"خطا در برادکست به {user_id}: {e}")
+
+    def _prune(self, user_id):
+        self.state["pruned"] += 1
+        load_users().remove(user_id)
+
+    def progress_text(self, registry=None, started=None, done_at_start=0):
+        state = self.state
+        registry = registry or load_users()
+        remaining = registry.count_after(state["cursor"]) if state["status"] == "running" else 0
+        total = state["done"] + remaining
+        lines = [
+            f"📣 برادکست ({state['status']}): {state['done']}/{total}",
+            f"✅ {state['sent']} | ❌ {state['failed']} | 🧹 {state['pruned']}"
+        ]
+        if started is not None:
+            elapsed = max(time.monotonic() - started, 0.001)
+            rate = (state["done"] - done_at_start) / elapsed
+            eta = int(remaining / rate) if rate > 0 else 0
+            lines.append(f"⚡ {rate:.1f} کاربر/ثانیه | ⏱ باقی‌مانده: {eta // 60} دقیقه و {eta % 60} ثانیه")
+        return "\n".join(lines)
+
+    async def _report(self, bot, registry, started, done_at_start):
+        try:
+            await bot.edit_message_text(
+                chat_id=self.state["status_chat_id"],
+                message_id=self.state["status_message_id"],
+                text=self.progress_text(registry, started, done_at_start),
+                rate_limit_args=PRIORITY_NORMAL
+            )
+        except Exception as e:
+            logging.debug(f"خطا در گزارش برادکست: {e}")
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast در جواب یک پیام؛ /broadcast status و /broadcast cancel"""
+    tenant = current_tenant()
+    activity_monitor.record_activity()
+    if update.effective_user.id != tenant.admin_id:
+        return
+
+    action = context.args[0].lower() if context.args else ""
+    if action == "status":
+        if not tenant.broadcast.running():
+            # ممکن است برادکست در worker دیگری اجرا شود
+            tenant.broadcast.load()
+        if tenant.broadcast.state is None:
+            await update.message.reply_text("ℹ️ برادکستی ثبت نشده.")
+        else:
+            await update.message.reply_text(tenant.broadcast.progress_text())
+        return
+    if action == "cancel":
+        if tenant.broadcast.cancel():
+            await update.message.reply_text("🛑 برادکست متوقف شد.")
+        else:
+            await update.message.reply_text("ℹ️ برادکستی در حال اجرا نیست.")
+        return
+
+    source = update.message.reply_to_message
+    if source is None:
+        await update.message.reply_text("📣 روی پیامی که می‌خواهی برای همه ارسال شود ریپلای کن و /broadcast بفرست.")
+        return
+    if not load_users().loaded:
+        await update.message.reply_text(USERS_LOADING_TEXT)
         return
+    if tenant.broadcast.running() or not tenant.broadcast.claim():
+        await update.message.reply_text("⚠️ یک برادکست در حال اجراست. /broadcast status")
+        return
+
+    status = await update.message.reply_text(f"📣 شروع برادکست برای {len(load_users())} کاربر...")
+    tenant.broadcast.start(context.bot, {
+        "from_chat_id": source.chat.id,
+        "message_id": source.message_id,
+        "status_chat_id": status.chat.id,
+        "status_message_id": status.message_id,
+        "cursor": 0,
+        "done": 0,
+        "sent": 0,
+        "failed": 0,
+        "pruned": 0
+    })
+
+# ===== چند ربات در یک پروسه =====
+class Tenant:
+    """تنظیمات و وضعیت مخصوص یک ربات در حالت چند-رباتی
+
+    محتوا، کش و ایندکس عضویت، write-behind، زمان‌بند آپدیت‌ها و استخر اتصال
+    HTTP بین همه‌ی ربات‌ها مشترک است. کاربران، وضعیت گفتگوها، فیش‌ها، آمار،
+    حذف‌ها، برادکست و صف ارسال (محدودیت‌های تلگرام برای هر توکن جداست) مال
+    هر ربات است و فایل‌هایش در data_dir خودش نگه داشته می‌شود. ربات پیش‌فرض
+    همان تنظیمات env است و data_dir خالی دارد تا فایل‌های قبلی سر جایشان بمانند.
+    """
+
+    def __init__(self, name, token, channel_id=None, channel_username=None,
+                 second_channel_username=None, admin_id=0, data_dir=""):
+        self.name = name
+        self.token = token
+        self.channel_id = channel_id
+        self.channel_username = channel_username
+        self.second_channel_username = second_channel_username
+        self.admin_id = admin_id
+        self.data_dir = data_dir
+        if data_dir:
+            os.makedirs(data_dir, exist_ok=True)
+
+        self.state_backend = SQLiteStateBackend(self.path(STATE_DB_FILE)) if SHARED_STATE else MemoryStateBackend()
+        self.state = StateStore(self.state_backend)
+        self.user_state = self.state.namespace("user_state", ttl=3600, max_entries=1000)
+        self.pending_users = self.state.namespace("pending_users", ttl=6 * 3600, max_entries=100000, max_bytes=32 * 1024 * 1024)
+        self.admin_temp_packages = self.state.namespace("admin_temp_packages", ttl=24 * 3600, max_entries=100)
+        self.pending_payments = self.state.namespace("pending_payments", ttl=7 * 24 * 3600, max_entries=100000)
+        self.payment_receipts = self.state.namespace("payment_receipts", ttl=7 * 24 * 3600, max_entries=100000)
+        self.admin_ingest = self.state.namespace("admin_ingest", ttl=3600, max_entries=100)
+
+        if SHARED_STATE:
+            self.users = persistence.register(SQLiteUserRegistry(self.state_backend, writer=persistence))
+        else:
+            self.users = persistence.register(
+                UserRegistry(self.path(USERS_SNAPSHOT_FILE), self.path(USERS_LOG_FILE), writer=persistence)
+            )
+        self.deletions = persistence.register(DeletionScheduler(self.path(DELETE_JOURNAL_FILE), writer=persistence))
+        self.receipts = ReceiptQueue(self.path(RECEIPTS_DB_FILE))
+        self.analytics = persistence.register(Analytics(self.path(ANALYTICS_DB_FILE), writer=persistence))
+        self.broadcast = persistence.register(BroadcastEngine(self.path(BROADCAST_STATE_FILE), writer=persistence))
+        self.outbound = OutboundDispatcher()
+
+    def path(self, filename):
+        if not self.data_dir:
+            return filename
+        return os.path.join(self.data_dir, os.path.basename(filename))
 
-    _ensure_files()
+def _load_tenants():
+    """ربات پیش‌فرض از env و ربات‌های دیگر از فایل BOTS_CONFIG (لیست JSON)
 
-    # راه‌اندازی threads کمکی
+    هر ربات: name و token اجباری؛ کانال‌ها و admin_id اگر نیامده باشند همان
+    مقدارهای ربات پیش‌فرض‌اند و data_dir پیش‌فرض data/<name> است.
+    """
+    loaded = {default_tenant.name: default_tenant}
+    if not os.path.exists(BOTS_CONFIG_FILE):
+        return loaded
     try:
-        threading.Thread(target=internal_keep_alive, daemon=True).start()
-        threading.Thread(target=auto_cleanup, daemon=True).start()
-    except:
-        pass
+        with open(BOTS_CONFIG_FILE, "r", encoding="utf-8") as f:
+            configs = json.load(f)
+    except Exception as e:
+        logging.error(f"خطا در خواندن {BOTS_CONFIG_FILE}: {e}")
+        return loaded
+
+    for config in configs:
+        name, token = config.get("name"), config.get("token")
+        if not name or not token or name in loaded or any(t.token == token for t in loaded.values()):
+            logging.error(f"⚠️ تنظیمات ربات نامعتبر یا تکراری رد شد: {name}")
+            continue
+        try:
+            loaded[name] = Tenant(
+                name, token,
+                config.get("channel_id", CHANNEL_ID),
+                config.get("channel_username", CHANNEL_USERNAME),
+                config.get("second_channel_username", SECOND_CHANNEL_USERNAME),
+                int(config.get("admin_id", ADMIN_ID)),
+                config.get("data_dir") or os.path.join(TENANT_DATA_DIR, name)
+            )
+        except Exception as e:
+            logging.error(f"خطا در ساخت ربات {name}: {e}")
+    return loaded
+
+default_tenant = Tenant("default", BOT_TOKEN, CHANNEL_ID, CHANNEL_USERNAME, SECOND_CHANNEL_USERNAME, ADMIN_ID)
+tenants = _load_tenants()
+
+def current_tenant():
+    """ربات آپدیت جاری؛ بیرون از هندلرها ربات پیش‌فرض"""
+    return _current_tenant.get() or default_tenant
+
+def tenant_for_update(update):
+    """ربات صاحب آپدیت برای جاهایی که context ندارند (مثل UpdateScheduler)"""
+    try:
+        token = update.get_bot().token
+    except RuntimeError:
+        return default_tenant
+    for tenant in tenants.values():
+        if tenant.token == token:
+            return tenant
+    return default_tenant
+
+# ===== collectorهای متریک =====
+@metrics.collector
+def _collect_runtime_metrics(m):
+    for result in ("hits", "misses", "coalesced"):
+        m.set("bot_membership_cache_total", getattr(membership_cache, result), result=result)
+    for tenant in tenants.values():
+        for name, depth in tenant.outbound.stats()["queue_depth"].items():
+            m.set("bot_outbound_queue_depth", depth, priority=name, bot=tenant.name)
+        for name, ns in tenant.state.stats().items():
+            m.set("bot_state_entries", ns["entries"], namespace=name, bot=tenant.name)
+            m.set("bot_state_bytes", ns["bytes"], namespace=name, bot=tenant.name)
+        m.set("bot_deletions_pending", len(tenant.deletions._heap), bot=tenant.name)
+        m.set("bot_receipts_pending", tenant.receipts.stats().get("pending", 0), bot=tenant.name)
+    for name, pool in http_pools.items():
+        m.set("bot_http_pool_size", pool.size, pool=name)
+        m.set("bot_http_pool_in_flight", pool.in_flight, pool=name)
+        m.set("bot_http_pool_waiting", pool.waiting, pool=name)
+    m.set("bot_write_behind_pending", persistence.pending())
+    m.set("bot_loop_pending_tasks", loop_monitor.pending_tasks)
+    for name, depth in update_scheduler.stats()["queued"].items():
+        m.set("bot_update_queue_depth", depth, kind=name)
+
+# ===== چرخه‌ی عمر برنامه =====
+# Applicationهایی که post_init شده‌اند؛ سرویس‌های مشترک با اولی شروع و با آخری متوقف می‌شوند
+_active_applications = set()
+
+async def _post_init(application):
+    tenant = application.bot_data["tenant"]
+    token = _current_tenant.set(tenant)
+    try:
+        if not _active_applications:
+            loop_monitor.start()
+            persistence.start()
+            # کش‌ها در پس‌زمینه گرم می‌شوند؛ تا آن موقع is_member از API استفاده می‌کند
+            asyncio.get_running_loop().run_in_executor(None, _warm_caches)
+        _active_applications.add(application)
+        tenant.state.start()
+        try:
+            replayed = tenant.deletions.load()
+            if replayed:
+                logging.warning(f"🗑 {replayed} حذف معوق از ژورنال بازیابی شد ({tenant.name})")
+        except Exception as e:
+            logging.error(f"خطا در لود ژورنال حذف: {e}")
+        tenant.deletions.start(application.bot)
+        try:
+            state = tenant.broadcast.load()
+            if state and state.get("status") == "running" and tenant.broadcast.claim():
+                logging.warning(f"📣 ادامه‌ی برادکست از کاربر {state['cursor']} ({tenant.name})")
+                tenant.broadcast.start(application.bot)
+        except Exception as e:
+            logging.error(f"خطا در بازیابی برادکست: {e}")
+        try:
+            if tenant.receipts.recover():
+                application.create_task(deliver_approved_receipts(application.bot))
+        except Exception as e:
+            logging.error(f"خطا در بازیابی صف فیش‌ها: {e}")
+    finally:
+        _current_tenant.reset(token)
+    startup_report.mark("ready")
+
+def _warm_caches():
+    try:
+        membership_index.load()
+    except Exception as e:
+        logging.error(f"خطا در لود ایندکس عضویت: {e}")
+    for tenant in list(tenants.values()):
+        if not tenant.users.loaded:
+            _load_registry(tenant.users)
+    startup_report.mark("caches")
+
+async def _post_shutdown(application):
+    tenant = application.bot_data["tenant"]
+    _active_applications.discard(application)
+    if not _active_applications:
+        await loop_monitor.stop()
+    await tenant.state.stop()
+    await tenant.broadcast.stop()
+    await tenant.deletions.stop()
+    if not _active_applications:
+        await persistence.stop()
+
+# ===== اجرای اصلی بهینه‌شده =====
+def build_application(tenant=None, base_url=None, transport=None):
+    """ساخت Application برای یک ربات؛ base_url برای اجرای bench.py روی Bot API جعلی است
 
+    transport خروجی build_transport است و در حالت چند-رباتی بین همه مشترک است.
+    """
+    tenant = tenant or default_tenant
+    request, get_updates_request = transport or build_transport()
     defaults = Defaults(parse_mode="HTML")
-    app_bot = ApplicationBuilder()\
-        .token(BOT_TOKEN)\
-        .concurrent_updates(True)\
+    builder = ApplicationBuilder()\
+        .token(tenant.token)\
+        .concurrent_updates(update_scheduler)\
         .defaults(defaults)\
-        .pool_timeout(5)\
-        .connect_timeout(5)\
-        .read_timeout(5)\
-        .write_timeout(5)\
-        .get_updates_read_timeout(5)\
-        .build()
+        .request(request)\
+        .get_updates_request(get_updates_request)\
+        .rate_limiter(tenant.outbound)\
+        .job_queue(None)\
+        .post_init(_post_init)\
+        .post_shutdown(_post_shutdown)
+    if base_url:
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    app_bot = builder.build()
+    app_bot.bot_data["tenant"] = tenant
 
     handlers = [
         CommandHandler("admin", admin_panel),
         CallbackQueryHandler(handle_admin_buttons, pattern="^upload_video$"),
         CallbackQueryHandler(handle_admin_buttons, pattern="^upload_package$"),
         CallbackQueryHandler(handle_admin_buttons, pattern="^upload_paid_package$"),
-        CallbackQueryHandler(handle_admin_buttons, pattern="^(finish_package|finish_paid_package|cancel_upload)$"),
+        CallbackQueryHandler(handle_admin_buttons, pattern="^upload_bulk$"),
+        CallbackQueryHandler(handle_admin_buttons, pattern="^(finish_package|finish_paid_package|finish_bulk|cancel_upload)$"),
         CallbackQueryHandler(handle_check_button, pattern="^check_"),
+        CallbackQueryHandler(handle_receipt_buttons, pattern="^rcpt_"),
+        # قبل از هندلر ویدیوی ادمین، وگرنه فیش‌هایی که فایل ویدیویی‌اند به آن می‌رسند
+        MessageHandler(
+            filters.ChatType.PRIVATE & (filters.PHOTO | filters.Document.ALL) & ~filters.User(user_id=tenant.admin_id),
+            handle_payment_receipt
+        ),
         MessageHandler(filters.VIDEO | filters.Document.VIDEO, handle_video_from_admin),
         CommandHandler("start", start_link),
-        CommandHandler("member", show_member_count)
+        CommandHandler("member", show_member_count),
+        CommandHandler("broadcast", broadcast_command),
+        CommandHandler("receipts", receipts_command),
+        CommandHandler("stats", stats_command),
+        ChatMemberHandler(handle_chat_member, ChatMemberHandler.CHAT_MEMBER)
     ]
 
     for handler in handlers:
+        handler.callback = instrument_handler(handler.callback)
         app_bot.add_handler(handler)
+    return app_bot
+
+def build_applications(base_url=None):
+    """یک Application برای هر ربات توکن‌دار، همه روی استخرهای اتصال HTTP مشترک"""
+    active = [tenant for tenant in tenants.values() if tenant.token]
+    transport = build_transport(len(active))
+    return {tenant.name: build_application(tenant, base_url, transport) for tenant in active}
+
+def run_webhook(applications):
+    """سرو کردن webhook همه‌ی ربات‌ها و مسیرهای health با uvicorn در همین پروسه"""
+    import uvicorn
+
+    if not WEBHOOK_URL:
+        logging.error("❌ WEBHOOK_URL تنظیم نشده!")
+        return
+    _bot_applications.update(applications)
+    http_app = create_http_app()
+    logging.warning(f"🌐 Webhook mode on {HTTP_HOST}:{HTTP_PORT}/{WEBHOOK_PATH} ({len(applications)} ربات)")
+    uvicorn.run(http_app, host=HTTP_HOST, port=HTTP_PORT, log_level="warning", access_log=False)
 
-    logging.warning("🤖 Bot is running... (Anti-Sleep Optimized)")
+def run_polling(app_bot):
     app_bot.run_polling(
         drop_pending_updates=True,
         allowed_updates=Update.ALL_TYPES,
@@ -573,6 +4371,84 @@ def main():
         bootstrap_retries=3,
     )
 
+async def _poll_all(applications):
+    """همان کار run_polling برای چند ربات روی یک event loop"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    started = []
+    try:
+        for application in applications:
+            await application.initialize()
+            started.append(application)
+            if application.post_init:
+                await application.post_init(application)
+            await application.updater.start_polling(
+                drop_pending_updates=True,
+                allowed_updates=Update.ALL_TYPES,
+                poll_interval=0.1,
+                timeout=5,
+                bootstrap_retries=3,
+            )
+            await application.start()
+        await stop.wait()
+    finally:
+        for application in reversed(started):
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+def run_polling_many(applications):
+    asyncio.run(_poll_all(list(applications.values())))
+
+def _prepare_storage():
+    migrate_videos_json()
+    load_videos()
+    migrate_users_json()
+    for tenant in tenants.values():
+        load_users(tenant)
+        tenant.receipts.open()
+        tenant.analytics.open()
+    startup_report.mark("storage")
+
+def _close_storage():
+    """flush نهایی تضمینی و بستن دیتابیس‌ها"""
+    persistence.close()
+    content_store.close()
+    for tenant in tenants.values():
+        tenant.receipts.close()
+        tenant.analytics.close()
+        if SHARED_STATE:
+            tenant.state_backend.close()
+
+def main():
+    if not any(tenant.token for tenant in tenants.values()):
+        logging.error("❌ BOT_TOKEN تنظیم نشده!")
+        return
+
+    _prepare_storage()
+
+    applications = build_applications()
+
+    logging.warning(f"🤖 Bot is running... (mode: {RUN_MODE}, bots: {', '.join(applications)})")
+    try:
+        if RUN_MODE == "webhook":
+            run_webhook(applications)
+        elif len(applications) == 1:
+            run_polling(next(iter(applications.values())))
+        else:
+            run_polling_many(applications)
+    finally:
+        # flush نهایی تضمینی، حتی اگر اجرا با خطا متوقف شود
+        _close_storage()
+
+startup_report.mark("import")
+
 if __name__ == "__main__":
     print("🚀 راه‌اندازی ربات اصلی با تمام قابلیت‌ها...")
     main()
@@ -0,0 +1,110 @@
+"""تنظیمات مشترک تست‌ها
+
+main.py با فایل‌های نسبی کار می‌کند و تنظیماتش را هنگام import از محیط
+می‌خواند؛ پس قبل از import در یک پوشه‌ی موقت و با توکن جعلی بارگذاری می‌شود
+(مثل bench.py).
+"""
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_TOKEN = "123456:test"
+
+os.environ.update({
+    "BOT_TOKEN": TEST_TOKEN,
+    "CHANNEL_ID": "@test_one",
+    "CHANNEL_USERNAME": "test_one",
+    "SECOND_CHANNEL_USERNAME": "test_two",
+    "ADMIN_ID": "1",
+    "STATE_BACKEND": "memory",
+    "RUN_MODE": "polling"
+})
+os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+class SpyBot:
+    """Bot جعلی: هر متد async است، فراخوانی‌ها ثبت می‌شوند و متدهای fail خطا می‌دهند
+
+    results برای متدهایی که خروجی خاص لازم دارند (مثلاً get_chat_member)؛
+    بقیه یک پیام با message_id و chat برمی‌گردانند.
+    """
+
+    defaults = None
+
+    def __init__(self, token=TEST_TOKEN, fail=(), results=None):
+        self.token = token
+        self.id = int(token.split(":")[0])
+        self.username = "test_bot"
+        self.calls = []
+        self.results = results or {}
+        self.fail = dict.fromkeys(fail, Exception("simulated failure")) if not isinstance(fail, dict) else fail
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        async def method(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            if name in self.fail:
+                raise self.fail[name]
+            if name in self.results:
+                return self.results[name]
+            chat = SimpleNamespace(id=kwargs.get("chat_id"))
+            if name == "send_media_group":
+                return [SimpleNamespace(message_id=len(self.calls) * 100 + i, chat=chat) for i in range(len(kwargs["media"]))]
+            return SimpleNamespace(message_id=len(self.calls), chat=chat)
+        return method
+
+    def called(self, name):
+        return [kwargs for method, _, kwargs in self.calls if method == name]
+
+
+@pytest.fixture
+def bot():
+    return SpyBot()
+
+
+@pytest.fixture(scope="session")
+def storage():
+    import main
+    main._prepare_storage()
+    yield main
+    main._close_storage()
+
+
+def member_bot(**kwargs):
+    """ربات جعلی که همه را عضو هر دو کانال می‌داند"""
+    return SpyBot(results={"get_chat_member": SimpleNamespace(status="member")}, **kwargs)
+
+
+def user_payload(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+
+
+def message_payload(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": text,
+            "chat": {"id": user_id, "type": "private"}, "from": user_payload(user_id)
+        }
+    }
+
+
+def callback_payload(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "chat_instance": "1", "data": data, "from": user_payload(user_id),
+            "message": {
+                "message_id": update_id, "date": 0, "text": "prompt",
+                "chat": {"id": user_id, "type": "private"}, "from": user_payload(user_id)
+            }
+        }
+    }
@@ -0,0 +1,76 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from conftest import SpyBot
+
+
+@pytest.fixture
+def tenants(tmp_path):
+    """دو worker با backend جدا روی یک فایل وضعیت"""
+    path = str(tmp_path / "state.db")
+    backends = [main.SQLiteStateBackend(path), main.SQLiteStateBackend(path)]
+    yield [SimpleNamespace(admin_ingest=b.namespace("admin_ingest", 3600, 100)) for b in backends]
+    for backend in backends:
+        backend.close()
+
+
+def _on(tenant, coro_fn):
+    async def run(*args):
+        token = main._current_tenant.set(tenant)
+        try:
+            return await coro_fn(*args)
+        finally:
+            main._current_tenant.reset(token)
+    return run
+
+
+def test_album_split_across_workers_flushes_once(tenants):
+    flushed = []
+
+    async def on_flush(bot, chat_id, user_id, items):
+        flushed.append(sorted(items))
+
+    async def scenario():
+        ingests = [main.AdminIngest(window=0.2), main.AdminIngest(window=0.2)]
+        bots = [SpyBot(), SpyBot()]
+
+        async def add(i, file_id):
+            ingests[i].add(1, 1, bots[i], "album", file_id, on_flush)
+
+        await _on(tenants[0], add)(0, "a")
+        await _on(tenants[1], add)(1, "b")
+        await asyncio.sleep(0.1)
+        await _on(tenants[0], add)(0, "c")
+        await asyncio.sleep(0.6)
+        return [ingest.pending() for ingest in ingests]
+
+    assert asyncio.run(scenario()) == [0, 0]
+    assert flushed == [[("album", "a"), ("album", "b"), ("album", "c")]]
+
+
+def test_finish_flushes_parts_seen_by_other_worker(tenants):
+    flushed = []
+
+    async def on_flush(bot, chat_id, user_id, items):
+        flushed.append(sorted(items))
+
+    async def scenario():
+        other = main.AdminIngest(window=30)
+        mine = main.AdminIngest(window=30)
+
+        async def add():
+            other.add(1, 1, SpyBot(), "album", "a", on_flush)
+
+        await _on(tenants[1], add)()
+        # «پایان» روی workerی زده شده که هیچ تکه‌ای از آلبوم را ندیده
+        await _on(tenants[0], mine.flush)(SpyBot(), 1, 1, on_flush)
+        # تایمر worker دیگر بعد از بیدار شدن دسته‌ی خالی می‌بیند و کاری نمی‌کند
+        other._timers[(123456, 1)]["wakeup"].set()
+        await asyncio.sleep(0.05)
+        return other.pending()
+
+    assert asyncio.run(scenario()) == 0
+    assert flushed == [[("album", "a")]]
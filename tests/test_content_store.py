@@ -0,0 +1,41 @@
+import json
+
+import main
+
+
+def _use_store(monkeypatch, tmp_path):
+    store = main.ContentStore(str(tmp_path / "videos.db"))
+    monkeypatch.setattr(main, "content_store", store)
+    monkeypatch.setattr(main, "VIDEO_SQLITE_FILE", str(tmp_path / "videos.db"))
+    monkeypatch.setattr(main, "VIDEO_DB_FILE", str(tmp_path / "videos.json"))
+    return store
+
+
+def test_failed_migration_is_retried(monkeypatch, tmp_path):
+    store = _use_store(monkeypatch, tmp_path)
+    legacy = tmp_path / "videos.json"
+    legacy.write_text('{"A": "file-a", ', encoding="utf-8")
+
+    main.migrate_videos_json()
+    assert (tmp_path / "videos.db").exists()
+    assert store.get("A") is None
+
+    legacy.write_text(json.dumps({"A": "file-a", "P": {"type": "package", "files": ["x"]}}), encoding="utf-8")
+    main.migrate_videos_json()
+    assert store.get("A") == "file-a"
+    assert store.get("P") == {"type": "package", "files": ["x"]}
+    store.close()
+
+
+def test_migration_runs_once_and_keeps_newer_codes(monkeypatch, tmp_path):
+    store = _use_store(monkeypatch, tmp_path)
+    legacy = tmp_path / "videos.json"
+    legacy.write_text(json.dumps({"A": "file-a"}), encoding="utf-8")
+    main.migrate_videos_json()
+
+    store.put("A", "file-new")
+    legacy.write_text(json.dumps({"A": "file-a", "B": "file-b"}), encoding="utf-8")
+    main.migrate_videos_json()
+    assert store.get("A") == "file-new"
+    assert store.get("B") is None
+    store.close()
@@ -0,0 +1,70 @@
+import asyncio
+from types import SimpleNamespace
+
+from telegram import Update
+
+import main
+from conftest import member_bot, message_payload
+
+
+def _start(bot, update_id, user_id, code):
+    update = Update.de_json(message_payload(update_id, user_id, f"/start {code}"), bot)
+    return main.start_link(update, SimpleNamespace(bot=bot, args=[code]))
+
+
+def test_failed_video_allows_immediate_retry(storage):
+    main.put_video("DLV1", "file-1")
+    bot = member_bot(fail=["send_video"])
+
+    async def scenario():
+        await _start(bot, 1, 700, "DLV1")
+        bot.fail = {}
+        await _start(bot, 2, 700, "DLV1")
+
+    asyncio.run(scenario())
+    # دو تلاش ناموفق در اجرای اول، یک ارسال موفق در اجرای دوم
+    assert len(bot.called("send_video")) == 3
+    texts = [m["text"] for m in bot.called("send_message")]
+    assert texts == ["❌ خطا در ارسال ویدیو."]
+
+
+def test_delivered_video_is_debounced(storage):
+    main.put_video("DLV2", "file-2")
+    bot = member_bot()
+
+    async def scenario():
+        await _start(bot, 1, 701, "DLV2")
+        await _start(bot, 2, 701, "DLV2")
+
+    asyncio.run(scenario())
+    assert len(bot.called("send_video")) == 1
+    assert [m["text"] for m in bot.called("send_message")] == [main.USER_GATE_DEBOUNCED_TEXT]
+
+
+def test_failed_package_allows_immediate_retry(storage):
+    main.put_video("DLP1", {"type": "package", "files": ["p1", "p2"]})
+    bot = member_bot(fail=["send_media_group", "send_video"])
+
+    async def scenario():
+        await _start(bot, 1, 702, "DLP1")
+        bot.fail = {}
+        await _start(bot, 2, 702, "DLP1")
+
+    asyncio.run(scenario())
+    assert len(bot.called("send_media_group")) == 2
+    assert [m["text"] for m in bot.called("send_message")] == ["❌ خطا در ارسال تمام ویدیوهای پکیج."]
+
+
+def test_only_confirmed_deliveries_are_counted(storage):
+    main.put_video("DLA1", "file-a")
+    bot = member_bot(fail=["send_video"])
+    analytics = main.default_tenant.analytics
+
+    async def scenario():
+        await _start(bot, 1, 703, "DLA1")
+        assert analytics._codes["DLA1"] == [1, 0]
+        bot.fail = {}
+        await _start(bot, 2, 703, "DLA1")
+
+    asyncio.run(scenario())
+    assert analytics._codes["DLA1"] == [2, 1]
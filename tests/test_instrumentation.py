@@ -0,0 +1,37 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from telegram import Update
+
+import main
+from conftest import SpyBot, message_payload, user_payload
+
+
+def _chat_member_payload(update_id, user_id):
+    member = {"user": user_payload(user_id), "status": "member"}
+    return {
+        "update_id": update_id,
+        "chat_member": {
+            "chat": {"id": -100, "type": "channel", "title": "test_one"},
+            "from": user_payload(user_id), "date": 0,
+            "old_chat_member": dict(member, status="left"), "new_chat_member": member
+        }
+    }
+
+
+def test_first_update_ignores_chat_member(monkeypatch):
+    report = main.StartupReport(time.perf_counter())
+    monkeypatch.setattr(main, "startup_report", report)
+    bot = SpyBot()
+    context = SimpleNamespace(bot=bot, application=SimpleNamespace(bot_data={}))
+
+    async def handler(update, context):
+        pass
+
+    wrapped = main.instrument_handler(handler)
+    asyncio.run(wrapped(Update.de_json(_chat_member_payload(1, 5), bot), context))
+    assert "first_update" not in report.phases
+
+    asyncio.run(wrapped(Update.de_json(message_payload(2, 5, "/start"), bot), context))
+    assert "first_update" in report.phases
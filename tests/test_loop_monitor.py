@@ -0,0 +1,34 @@
+import asyncio
+import threading
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+def _watchdogs():
+    return [t for t in threading.enumerate() if t.name == "loop-watchdog" and t.is_alive()]
+
+
+def test_single_watchdog_across_restarts():
+    async def scenario():
+        monitor = main.LoopMonitor(interval=0.05)
+        monitor.start()
+        # post_init ربات دوم یا شروع دوباره
+        monitor.start()
+        running = len(_watchdogs())
+        await monitor.stop()
+        monitor.start()
+        restarted = len(_watchdogs())
+        await monitor.stop()
+        return running, restarted, len(_watchdogs())
+
+    assert asyncio.run(scenario()) == (1, 1, 0)
+
+
+def test_keep_alive_reports_stalled_loop(monkeypatch):
+    client = TestClient(main.create_http_app())
+    monkeypatch.setattr(main.loop_monitor, "responsive", lambda: True)
+    assert client.get("/keep-alive").status_code == 200
+    monkeypatch.setattr(main.loop_monitor, "responsive", lambda: False)
+    assert client.get("/keep-alive").status_code == 503
@@ -0,0 +1,33 @@
+import asyncio
+
+import main
+
+
+def test_deletes_skip_the_global_send_budget():
+    async def scenario():
+        dispatcher = main.OutboundDispatcher(global_rate=1, delete_rate=50)
+        await dispatcher.initialize()
+        # سهم ارسال این ثانیه مصرف شده
+        dispatcher._global.tokens = 0
+        done = []
+
+        async def call(endpoint):
+            async def callback():
+                done.append(endpoint)
+            await dispatcher.process_request(callback, (), {}, endpoint, {"chat_id": 5}, None)
+
+        tasks = [asyncio.create_task(call("sendMessage"))]
+        tasks += [asyncio.create_task(call("deleteMessage")) for _ in range(10)]
+        await asyncio.sleep(0.3)
+        first = list(done)
+        await asyncio.gather(*tasks)
+        stats = dispatcher.stats()
+        await dispatcher.shutdown()
+        return first, stats, dispatcher._global.tokens
+
+    first, stats, tokens = asyncio.run(scenario())
+    assert first == ["deleteMessage"] * 10
+    assert stats["granted"]["delete"] == 10
+    assert stats["granted"]["background"] == 0
+    # فقط همان یک ارسال از سطل سراسری کم شده
+    assert tokens < 1
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+import main
+from conftest import SpyBot
+
+
+@pytest.fixture
+def receipts(tmp_path, monkeypatch):
+    queue = main.ReceiptQueue(str(tmp_path / "receipts.db"))
+    queue.open()
+    monkeypatch.setattr(main.default_tenant, "receipts", queue)
+    yield queue
+    queue.close()
+
+
+def test_new_receipt_supersedes_pending_one(receipts):
+    first, replaced = receipts.submit(800, 800, "PAY1", "photo-1", "photo")
+    assert not replaced
+    second, replaced = receipts.submit(800, 800, "PAY1", "photo-2", "photo")
+    assert replaced
+    assert receipts.get(first)["status"] == "superseded"
+    assert [row["id"] for row in receipts.page()] == [second]
+
+
+def test_decide_only_touches_pending_rows(receipts):
+    ids = [receipts.submit(810 + i, 810 + i, "PAY2", f"f{i}", "photo")[0] for i in range(3)]
+    assert [row["id"] for row in receipts.decide(ids[0], ids[0], "rejected")] == [ids[0]]
+    approved = receipts.decide(ids[0], ids[-1], "approved")
+    assert [row["id"] for row in approved] == ids[1:]
+    assert receipts.depth() == 0
+
+
+def test_approved_receipt_is_claimed_by_one_worker(receipts, tmp_path):
+    other = main.ReceiptQueue(receipts.path)
+    other.open()
+    try:
+        receipt_id, _ = receipts.submit(820, 820, "PAY3", "f", "photo")
+        receipts.decide(receipt_id, receipt_id, "approved")
+        claimed = receipts.claim_approved() + other.claim_approved()
+    finally:
+        other.close()
+    assert [row["id"] for row in claimed] == [receipt_id]
+
+
+def test_recover_requeues_deliveries_of_dead_worker(receipts):
+    receipt_id, _ = receipts.submit(830, 830, "PAY4", "f", "photo")
+    receipts.decide(receipt_id, receipt_id, "approved")
+    receipts.claim_approved()
+    # پروسه‌ای که وسط تحویل مرده؛ همین pid بعد از ری‌استارت هم بازیابی می‌شود
+    assert receipts.recover() == 1
+    assert receipts.get(receipt_id)["status"] == "approved"
+
+
+def test_delivery_outcome_is_recorded(storage, receipts):
+    main.put_video("PAY5", {"type": "package", "price": 99000, "files": ["p1", "p2"]})
+    ok, _ = receipts.submit(840, 840, "PAY5", "f", "photo")
+    failed, _ = receipts.submit(841, 841, "PAY5", "f", "photo")
+    receipts.decide(ok, failed, "approved")
+    bot = SpyBot()
+
+    def failing_for(chat_id, method):
+        async def send(**kwargs):
+            if kwargs["chat_id"] == chat_id:
+                raise Exception("simulated failure")
+            return await method(**kwargs)
+        return send
+
+    # کاربر 841 هیچ ویدیویی دریافت نمی‌کند (نه آلبوم، نه ارسال تکی)
+    bot.send_media_group = failing_for(841, bot.send_media_group)
+    bot.send_video = failing_for(841, bot.send_video)
+    asyncio.run(main.deliver_approved_receipts(bot, report_chat_id=1))
+    assert receipts.get(ok)["status"] == "delivered"
+    assert receipts.get(failed)["status"] == "failed"
+    assert bot.called("send_message")[-1]["text"] == "📦 تحویل پکیج‌ها: ✅ 1 | ❌ 1"
@@ -0,0 +1,133 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from telegram import Update
+
+import main
+from conftest import SpyBot, message_payload
+
+
+@pytest.fixture
+def workers(tmp_path):
+    """دو backend روی یک فایل، مثل دو worker پشت یک webhook"""
+    path = str(tmp_path / "state.db")
+    backends = [main.SQLiteStateBackend(path), main.SQLiteStateBackend(path)]
+    for backend in backends:
+        # مثل load هنگام شروع: جدول‌ها قبل از رقابت روی قفل ساخته می‌شوند
+        backend.conn
+    yield path, [b.namespace("pending_users", 60, 100) for b in backends]
+    for backend in backends:
+        backend.close()
+
+
+@pytest.fixture
+def write_lock(workers):
+    """worker سومی که قفل نوشتن را نگه داشته"""
+    conn = sqlite3.connect(workers[0], isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    held = []
+
+    def hold():
+        conn.execute("BEGIN IMMEDIATE")
+        held.append(True)
+
+    def release():
+        if held:
+            conn.execute("COMMIT")
+            held.clear()
+
+    yield hold, release
+    release()
+    conn.close()
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_write_does_not_wait_for_lock(workers, write_lock):
+    _, (mine, other) = workers
+    hold, release = write_lock
+    hold()
+    started = time.perf_counter()
+    mine[42] = "CODE"
+    assert time.perf_counter() - started < 0.05
+    assert mine.get(42) == "CODE"
+    assert other.get(42) is None
+    release()
+    assert _wait_for(lambda: other.get(42) == "CODE")
+    assert _wait_for(lambda: mine.stats()["pending_writes"] == 0)
+
+
+def test_pop_of_pending_write_is_local(workers, write_lock):
+    _, (mine, other) = workers
+    hold, release = write_lock
+    hold()
+    mine[7] = "A"
+    assert mine.pop(7) == "A"
+    assert mine.pop(7, None) is None
+    release()
+    assert _wait_for(lambda: mine.stats()["pending_writes"] == 0)
+    assert other.get(7) is None
+
+
+def test_atomic_update_under_lock_fails_fast(workers, write_lock):
+    _, (mine, other) = workers
+    other[5] = "B"
+    assert _wait_for(lambda: mine.get(5) == "B")
+    hold, _ = write_lock
+    hold()
+    started = time.perf_counter()
+    with pytest.raises(main.StateBusyError):
+        mine.pop(5)
+    assert time.perf_counter() - started < main.STATE_LOOP_BUSY_TIMEOUT + 0.5
+
+
+def test_extend_is_shared_between_workers(workers):
+    _, (mine, other) = workers
+    mine.extend("pkg", ["a"])
+    other.extend("pkg", ["b"])
+    assert mine.get("pkg") == ["a", "b"]
+
+
+def test_stats_do_not_take_backend_lock(workers):
+    _, (mine, _) = workers
+    mine.backend.conn
+    taken = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with mine.backend.lock:
+            taken.set()
+            release.wait()
+
+    threading.Thread(target=hold).start()
+    taken.wait()
+    try:
+        started = time.perf_counter()
+        mine.stats()
+        assert time.perf_counter() - started < 0.05
+    finally:
+        release.set()
+
+
+def test_busy_state_is_reported_to_user():
+    bot = SpyBot()
+
+    @main.instrument_handler
+    async def handler(update, context):
+        raise main.StateBusyError("pending_users")
+
+    update = Update.de_json(message_payload(1, 800, "/start X"), bot)
+    context = SimpleNamespace(bot=bot, application=SimpleNamespace(bot_data={}))
+    asyncio.run(handler(update, context))
+    assert [m["text"] for m in bot.called("send_message")] == [main.UPDATE_BUSY_TEXT]
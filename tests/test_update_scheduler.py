@@ -0,0 +1,57 @@
+import asyncio
+
+from telegram import Update
+
+import main
+from conftest import SpyBot, callback_payload, message_payload
+
+
+async def _shed(scheduler, update):
+    ran = []
+
+    async def handler():
+        ran.append(update.update_id)
+
+    await scheduler.do_process_update(update, handler())
+    # پیام «شلوغ است» در یک task جدا فرستاده می‌شود
+    await asyncio.sleep(0.01)
+    return ran
+
+
+def test_shed_message_sends_busy_notice():
+    bot = SpyBot()
+    scheduler = main.UpdateScheduler(limit=0, queue_limits=[None, 0, 0, 0])
+
+    async def scenario():
+        update = Update.de_json(message_payload(1, 500, "/start X"), bot)
+        assert await _shed(scheduler, update) == []
+        # تا TTL پیام دوم فرستاده نمی‌شود
+        await _shed(scheduler, Update.de_json(message_payload(2, 500, "/start X"), bot))
+
+    asyncio.run(scenario())
+    sent = bot.called("send_message")
+    assert len(sent) == 1
+    assert sent[0]["chat_id"] == 500 and sent[0]["text"] == main.UPDATE_BUSY_TEXT
+    assert sent[0]["rate_limit_args"] == main.PRIORITY_INTERACTIVE
+    assert scheduler.shed[main.UPDATE_CLASS_START] == 2
+
+
+def test_shed_callback_answers_query():
+    bot = SpyBot()
+    scheduler = main.UpdateScheduler(limit=0, queue_limits=[None, 0, 0, 0])
+    asyncio.run(_shed(scheduler, Update.de_json(callback_payload(3, 501, "check_X"), bot)))
+    answered = bot.called("answer_callback_query")
+    assert len(answered) == 1 and answered[0]["text"] == main.UPDATE_BUSY_TEXT
+
+
+def test_failed_busy_notice_is_retried():
+    bot = SpyBot(fail=["send_message"])
+    scheduler = main.UpdateScheduler(limit=0, queue_limits=[None, 0, 0, 0])
+
+    async def scenario():
+        await _shed(scheduler, Update.de_json(message_payload(4, 502, "hi"), bot))
+        bot.fail = {}
+        await _shed(scheduler, Update.de_json(message_payload(5, 502, "hi"), bot))
+
+    asyncio.run(scenario())
+    assert len(bot.called("send_message")) == 2
@@ -0,0 +1,97 @@
+import asyncio
+from types import SimpleNamespace
+
+from telegram import Update
+
+import main
+from conftest import SpyBot, callback_payload, message_payload
+
+
+def _gated(gate, outcome=None, delay=0.05):
+    calls = []
+
+    @gate.guard(lambda update, context: "KEY")
+    async def handler(update, context):
+        calls.append(update.update_id)
+        await asyncio.sleep(delay)
+        return outcome
+
+    return handler, calls
+
+
+def test_collapsed_start_gets_one_notice():
+    bot = SpyBot()
+    gate = main.UserGate()
+    handler, calls = _gated(gate)
+    context = SimpleNamespace(bot=bot)
+
+    async def scenario():
+        updates = [Update.de_json(message_payload(i, 600, "/start KEY"), bot) for i in range(1, 4)]
+        await asyncio.gather(*(handler(u, context) for u in updates))
+
+    asyncio.run(scenario())
+    assert calls == [1]
+    sent = bot.called("send_message")
+    assert [(m["chat_id"], m["text"]) for m in sent] == [(600, main.USER_GATE_INFLIGHT_TEXT)]
+    assert gate.collapsed == 2
+
+
+def test_debounced_start_after_success_is_answered():
+    bot = SpyBot()
+    gate = main.UserGate()
+    handler, calls = _gated(gate, delay=0)
+    context = SimpleNamespace(bot=bot)
+
+    async def scenario():
+        await handler(Update.de_json(message_payload(1, 601, "/start KEY"), bot), context)
+        await handler(Update.de_json(message_payload(2, 601, "/start KEY"), bot), context)
+
+    asyncio.run(scenario())
+    assert calls == [1]
+    assert [m["text"] for m in bot.called("send_message")] == [main.USER_GATE_DEBOUNCED_TEXT]
+
+
+def test_failed_notice_does_not_block_next_one():
+    bot = SpyBot(fail=["send_message"])
+    gate = main.UserGate()
+    handler, _ = _gated(gate, delay=0)
+    context = SimpleNamespace(bot=bot)
+
+    async def scenario():
+        await handler(Update.de_json(message_payload(1, 602, "/start KEY"), bot), context)
+        await handler(Update.de_json(message_payload(2, 602, "/start KEY"), bot), context)
+        bot.fail = {}
+        await handler(Update.de_json(message_payload(3, 602, "/start KEY"), bot), context)
+
+    asyncio.run(scenario())
+    assert len(bot.called("send_message")) == 2
+
+
+def test_duplicate_tap_is_answered():
+    bot = SpyBot()
+    gate = main.UserGate()
+    handler, calls = _gated(gate)
+    context = SimpleNamespace(bot=bot)
+
+    async def scenario():
+        taps = [Update.de_json(callback_payload(i, 603, "check_KEY"), bot) for i in range(1, 3)]
+        await asyncio.gather(*(handler(u, context) for u in taps))
+
+    asyncio.run(scenario())
+    assert calls == [1]
+    assert [a["text"] for a in bot.called("answer_callback_query")] == [main.USER_GATE_CHECKING_TEXT]
+
+
+def test_retryable_outcome_skips_debounce():
+    bot = SpyBot()
+    gate = main.UserGate()
+    handler, calls = _gated(gate, outcome=main.UserGate.RETRYABLE, delay=0)
+    context = SimpleNamespace(bot=bot)
+
+    async def scenario():
+        await handler(Update.de_json(message_payload(1, 604, "/start KEY"), bot), context)
+        await handler(Update.de_json(message_payload(2, 604, "/start KEY"), bot), context)
+
+    asyncio.run(scenario())
+    assert calls == [1, 2]
+    assert bot.called("send_message") == []